@@ -1 +1,18 @@
-from .arq_dispatcher import ConcurrencyAwareArqDispatcher
+from .arq_dispatcher import (DEFERRED, ENQUEUED, PRIORITY_HIGH, PRIORITY_LOW,
+                             PRIORITY_NORMAL, REJECTED,
+                             ConcurrencyAwareArqDispatcher)
+from .admission import AdmissionEngine, AdmissionRequest
+from .backpressure import Backpressure, BackpressureConfig, Overloaded
+from .coalescing import (ATTACHED, CACHED, OWNER, Claim, TaskCoalescer,
+                         coalescing_key)
+from .codec import (Codec, EncodedPayload, JsonCodec, MsgpackCodec,
+                    OrjsonCodec, get_codec)
+from .delayed_queue import DelayedQueue
+from .fair_queue import DeficitRoundRobin
+from .leases import SlotLeases
+from .partitions import (PartitionConfig, PartitionedQueue,
+                         PartitionLeaseManager)
+from .quota import QuotaConfig, QuotaLeases
+from .task_status import (FINAL_TASK_STATES, TASK_COMPLETE, TASK_DEFERRED,
+                          TASK_ENQUEUED, TASK_EXPIRED, TASK_RUNNING,
+                          TaskStatusStore)
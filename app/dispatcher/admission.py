@@ -0,0 +1,600 @@
+from functools import partial
+from typing import NamedTuple
+
+from arq import ArqRedis
+from arq.constants import job_key_prefix, result_key_prefix
+from arq.jobs import serialize_job
+from arq.utils import timestamp_ms
+from redis import Redis
+
+from .backpressure import (BACKLOG_DRAINED_KEY, BACKLOG_KEY,
+                           BACKLOG_TOTAL_KEY, Backpressure)
+from .codec import PAYLOAD_SLOT, Codec, EncodedPayload
+from .delayed_queue import DelayedQueue
+from .leases import (LEASE_DIMENSIONS_KEY, LEASE_USAGE_KEY, lease_cost_key,
+                     lease_key)
+from .partitions import SCRIPT_HELPERS_LUA, PartitionedQueue
+from .task_status import (TaskStatusStore, task_status_channel,
+                          task_status_key)
+
+# Admission is decided and applied in a single atomic call so that concurrent
+# dispatchers can never both admit the last free units of a dimension. A task
+# is admitted when the cost of the task fits in what is left of the limit of
+# every dimension, expired leases are given back by the reclaim pass. A
+# blocked task is parked in the wait list of its tenant and priority lane on
+# the dimension that blocked it, in the partition of that dimension, the tenant is
+# added to the tenants waiting on the dimension, and that dimension is dropped from the ready index
+# of the partition since it has no free capacity.
+#
+# A wait list is a sorted set ranked by deadline, earliest first, then by
+# submission time for the tasks without a deadline, which come after all the
+# others. A task blocked again keeps its rank, so it stays at the head of its
+# wait list. A task past its deadline is never admitted.
+#
+# Rate limits are enforced with GCRA, keeping the theoretical arrival time of
+# the next token (TAT) in us per dimension. A task out of tokens reserves the
+# next token of each dimension that limited it, and is deferred to the time
+# that token is available. A reservation is kept until the task is admitted,
+# or for a grace period past that time, so that deferred tasks are admitted
+# one token after the other instead of all retrying for the same token.
+#
+# The payload of the task is only sent once, at the end of the encoded
+# dispatch args, and the arq job is put together around it when the task is
+# admitted, so that a task parked again costs no job.
+#
+# KEYS[1]            inflight set
+# KEYS[2]            arq job key
+# KEYS[3]            arq result key
+# KEYS[4]            arq queue
+# KEYS[5]            leased dimensions index
+# KEYS[6]            usage per dimension
+# KEYS[7]            delayed sorted set
+# KEYS[8]            delayed wakeup list
+# KEYS[9..8+n]       lease sets, one per dimension
+# KEYS[9+n..8+2n]    lease costs, one per dimension
+# KEYS[9+2n..8+3n]   wait lists of the tenant and lane, one per dimension
+# KEYS[9+3n..8+4n]   rate TATs, one per dimension
+# KEYS[9+4n..8+5n]   rate reservations of the task, one per dimension
+# KEYS[9+5n..8+6n]   waiting tenants, one per dimension
+# KEYS[9+6n..8+7n]   ready indexes of the partitions of the dimensions, one per dimension
+# KEYS[9+7n]         status of the task
+# KEYS[10+7n]        backlog per dimension
+# KEYS[11+7n]        total backlog
+# ARGV[1]            job id
+# ARGV[2]            serialized arq job up to the payload
+# ARGV[3]            arq queue score (enqueue time in ms)
+# ARGV[4]            arq job expiry in ms
+# ARGV[5]            encoded dispatch args, parked in a wait list when blocked
+# ARGV[6]            rank of the task in its wait list, see wait_rank
+# ARGV[7]            lease duration in ms
+# ARGV[8..7+n]       limits, one per dimension (-1 means unlimited)
+# ARGV[8+n..7+2n]    costs, one per dimension
+# ARGV[8+2n..7+3n]   dimension names
+# ARGV[8+3n..7+4n]   rate emission intervals in us, one per dimension (-1 means unlimited)
+# ARGV[8+4n..7+5n]   rate bursts, one per dimension
+# ARGV[8+5n]         priority lane and tenant of the task, as `{priority}:{tenant}`
+# ARGV[9+5n]         status duration in ms, 0 to not track the status of the task
+# ARGV[10+5n]        status channel of the task
+# ARGV[11+5n]        total backlog past which the task is shed rather than parked or deferred (-1 means unlimited)
+# ARGV[12+5n]        wait for a rate limit token in us past which the task is shed (-1 means unlimited)
+# ARGV[13+5n..12+6n] backlogs past which the task is shed rather than parked, one per dimension (-1 means unlimited)
+# ARGV[13+6n]        deadline of the task in ms (-1 means none)
+# ARGV[14+6n]        serialized arq job past the payload
+# ARGV[15+6n]        size of the payload, at the end of the encoded dispatch args
+#
+# Returns {1, 0} when admitted, {0, i} when blocked on the i-th dimension,
+# {2, i, eligible-at time in ms} when deferred by the rate limit of the i-th
+# dimension, {3, i, reason, excess} when shed by the backlog limits, {4, 0}
+# when past its deadline and {-1, 0} when a job with the same ID already exists. The status of the task
+# is set to deferred or enqueued along with the outcome, and the change
+# published to the clients waiting on the task.
+ADMIT_SCRIPT = SCRIPT_HELPERS_LUA + """
+local n = (#KEYS - 11) / 7
+
+local function set_status(state, job_id)
+    local ttl = tonumber(ARGV[9 + 5 * n])
+    if ttl <= 0 then
+        return
+    end
+    local key = KEYS[9 + 7 * n]
+    local previous = redis.call('HGET', key, 'state')
+    redis.call('HSET', key, 'state', state, 'updated_at', string.format('%.6f', now_us() / 1000000))
+    if job_id then
+        redis.call('HSET', key, 'job_id', job_id)
+    end
+    redis.call('PEXPIRE', key, ttl)
+    -- A task blocked again on redispatch stays deferred, nothing to tell
+    if previous ~= state then
+        redis.call('PUBLISH', ARGV[10 + 5 * n], state)
+    end
+end
+
+-- Number of tasks over the total backlog limit, counting the deferred ones, 0 if under
+local function total_backlog_excess()
+    local cap = tonumber(ARGV[11 + 5 * n])
+    if cap < 0 then
+        return 0
+    end
+    local backlog = tonumber(redis.call('GET', KEYS[11 + 7 * n]) or 0) + redis.call('ZCARD', KEYS[7])
+    return math.max(backlog - cap + 1, 0)
+end
+
+local deadline = tonumber(ARGV[13 + 6 * n])
+if deadline >= 0 and deadline <= now_ms() then
+    return {4, 0}
+end
+
+for i = 1, n do
+    local limit = tonumber(ARGV[7 + i])
+    local cost = tonumber(ARGV[7 + n + i])
+    local dimension = ARGV[7 + 2 * n + i]
+    if limit >= 0 and tonumber(redis.call('HGET', KEYS[6], dimension) or 0) + cost > limit then
+        local cap = tonumber(ARGV[12 + 5 * n + i])
+        if cap >= 0 then
+            local backlog = tonumber(redis.call('HGET', KEYS[10 + 7 * n], dimension) or 0)
+            if backlog >= cap then
+                return {3, i, 0, backlog - cap + 1}
+            end
+        end
+        local excess = total_backlog_excess()
+        if excess > 0 then
+            return {3, i, 1, excess}
+        end
+        redis.call('ZADD', KEYS[8 + 2 * n + i], ARGV[6], ARGV[5])
+        redis.call('SADD', KEYS[8 + 5 * n + i], ARGV[8 + 5 * n])
+        redis.call('SREM', KEYS[8 + 6 * n + i], dimension)
+        redis.call('HINCRBY', KEYS[10 + 7 * n], dimension, 1)
+        redis.call('INCR', KEYS[11 + 7 * n])
+        set_status('deferred')
+        return {0, i}
+    end
+end
+if redis.call('EXISTS', KEYS[2], KEYS[3]) > 0 then
+    return {-1, 0}
+end
+
+-- Keep a reservation for a while after its token is due, the task may be blocked on a slot meanwhile
+local reservation_grace_us = 60000000
+local now = now_us()
+local tats = {}
+local reserved = {}
+local limited = 0
+local eligible_at = now
+for i = 1, n do
+    local interval = tonumber(ARGV[7 + 3 * n + i])
+    if interval >= 0 and redis.call('EXISTS', KEYS[8 + 4 * n + i]) == 0 then
+        local tat = math.max(tonumber(redis.call('GET', KEYS[8 + 3 * n + i]) or now), now) + interval
+        local allow_at = tat - interval * tonumber(ARGV[7 + 4 * n + i])
+        if allow_at > now then
+            reserved[i] = {tat, allow_at}
+            eligible_at = math.max(eligible_at, allow_at)
+            if limited == 0 then
+                limited = i
+            end
+        else
+            tats[i] = tat
+        end
+    end
+end
+if limited > 0 then
+    -- Shed before reserving anything, the tokens are left to the next tasks
+    local max_wait = tonumber(ARGV[12 + 5 * n])
+    if max_wait >= 0 and eligible_at - now > max_wait then
+        return {3, limited, 2, math.ceil((eligible_at - now - max_wait) / 1000)}
+    end
+    local excess = total_backlog_excess()
+    if excess > 0 then
+        return {3, limited, 1, excess}
+    end
+    for i, reservation in pairs(reserved) do
+        -- Reserve the next token for this task
+        redis.call('SET', KEYS[8 + 3 * n + i], string.format('%.0f', reservation[1]), 'PX', math.ceil((reservation[1] - now) / 1000))
+        redis.call('SET', KEYS[8 + 4 * n + i], 1, 'PX', math.ceil((reservation[2] - now + reservation_grace_us) / 1000))
+    end
+    local score = math.ceil(eligible_at / 1000)
+    redis.call('ZADD', KEYS[7], score, ARGV[5])
+    local first = redis.call('ZRANGE', KEYS[7], 0, 0)
+    if first[1] == ARGV[5] then
+        redis.call('LPUSH', KEYS[8], 1)
+        redis.call('LTRIM', KEYS[8], 0, 0)
+    end
+    set_status('deferred')
+    return {2, limited, score}
+end
+for i = 1, n do
+    if tats[i] then
+        redis.call('SET', KEYS[8 + 3 * n + i], string.format('%.0f', tats[i]), 'PX', math.ceil((tats[i] - now) / 1000))
+    elseif tonumber(ARGV[7 + 3 * n + i]) >= 0 then
+        redis.call('DEL', KEYS[8 + 4 * n + i])
+    end
+end
+
+local lease_deadline = math.floor(now / 1000) + tonumber(ARGV[7])
+for i = 1, n do
+    local dimension = ARGV[7 + 2 * n + i]
+    redis.call('ZADD', KEYS[8 + i], lease_deadline, ARGV[1])
+    redis.call('HSET', KEYS[8 + n + i], ARGV[1], ARGV[7 + n + i])
+    redis.call('HINCRBY', KEYS[6], dimension, ARGV[7 + n + i])
+    redis.call('SADD', KEYS[5], dimension)
+end
+local entry = ARGV[5]
+redis.call('PSETEX', KEYS[2], ARGV[4], ARGV[2] .. string.sub(entry, #entry - tonumber(ARGV[15 + 6 * n]) + 1) .. ARGV[14 + 6 * n])
+redis.call('ZADD', KEYS[4], ARGV[3], ARGV[1])
+redis.call('SADD', KEYS[1], ARGV[1])
+set_status('enqueued', ARGV[1])
+return {1, 0}
+"""
+
+# Releasing the leases of a job gives their cost back, and marks the
+# dimensions that tasks are waiting on as ready in their partition. The
+# cost of a lease already reclaimed is not given back twice. Each release is
+# counted as drained from the dimension, for the drain rate of its backlog.
+#
+# KEYS[1]          usage per dimension
+# KEYS[2]          drained jobs per dimension
+# KEYS[3..2+n]     lease sets, one per dimension
+# KEYS[3+n..2+2n]  lease costs, one per dimension
+# KEYS[3+2n..2+5n] wake keys of the dimensions, see PartitionedQueue.wake_keys
+# ARGV[1]          job id
+# ARGV[2..1+n]     dimension names
+RELEASE_SCRIPT = SCRIPT_HELPERS_LUA + """
+local n = #ARGV - 1
+local base = 2 + 2 * n
+local woken = 0
+for i = 1, n do
+    if redis.call('ZREM', KEYS[2 + i], ARGV[1]) == 1 then
+        local cost = tonumber(redis.call('HGET', KEYS[2 + n + i], ARGV[1]) or 1)
+        redis.call('HDEL', KEYS[2 + n + i], ARGV[1])
+        redis.call('HINCRBY', KEYS[1], ARGV[1 + i], -cost)
+        redis.call('HINCRBY', KEYS[2], ARGV[1 + i], 1)
+    end
+    woken = woken + wake(ARGV[1 + i], KEYS[base + 3 * i - 2], KEYS[base + 3 * i - 1], KEYS[base + 3 * i])
+end
+return woken
+"""
+
+# Pop the next task of a tenant waiting on a ready dimension, dropping the
+# tenant from the waiting tenants once its wait list is drained, and the
+# dimension from the ready index once no tenant is waiting on it. The tasks
+# past their deadline rank first in the wait list, they are dropped on the
+# way, up to a maximum per call, and the next task is only popped once no
+# expired task is left ahead of it.
+#
+# KEYS[1]  ready index of the partition of the dimension
+# KEYS[2]  waiting tenants
+# KEYS[3]  wait list of the tenant and lane
+# KEYS[4]  backlog per dimension
+# KEYS[5]  total backlog
+# ARGV[1]  dimension name
+# ARGV[2]  priority lane and tenant, as `{priority}:{tenant}`
+# ARGV[3]  maximum number of expired tasks dropped
+#
+# Returns {task or false, expired task...}
+POP_WAITING_SCRIPT = SCRIPT_HELPERS_LUA + """
+local now = now_ms()
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now, 'LIMIT', 0, tonumber(ARGV[3]))
+if #expired > 0 then
+    redis.call('ZREM', KEYS[3], unpack(expired))
+end
+local raw = false
+local head = redis.call('ZRANGE', KEYS[3], 0, 0, 'WITHSCORES')
+if head[1] and tonumber(head[2]) > now then
+    raw = head[1]
+    redis.call('ZREM', KEYS[3], raw)
+end
+local taken = #expired + (raw and 1 or 0)
+if taken > 0 then
+    redis.call('HINCRBY', KEYS[4], ARGV[1], -taken)
+    redis.call('DECRBY', KEYS[5], taken)
+end
+if redis.call('ZCARD', KEYS[3]) == 0 then
+    redis.call('SREM', KEYS[2], ARGV[2])
+    if redis.call('SCARD', KEYS[2]) == 0 then
+        redis.call('SREM', KEYS[1], ARGV[1])
+    end
+end
+table.insert(expired, 1, raw)
+return expired
+"""
+
+# Wake the tasks waiting on dimensions that may have capacity again without
+# any release, e.g. after their limit was raised.
+#
+# KEYS[1..3n]  wake keys of the dimensions, see PartitionedQueue.wake_keys
+# ARGV[1..n]   dimension names
+#
+# Returns the number of dimensions with waiting tasks.
+WAKE_SCRIPT = SCRIPT_HELPERS_LUA + """
+local woken = 0
+for i = 1, #ARGV do
+    woken = woken + wake(ARGV[i], KEYS[3 * i - 2], KEYS[3 * i - 1], KEYS[3 * i])
+end
+return woken
+"""
+
+ADMITTED = 1
+BLOCKED = 0
+DUPLICATED = -1
+RATE_LIMITED = 2
+SHED = 3
+EXPIRED = 4
+
+RATE_KEY_PREFIX = "dispatcher:rate:"
+
+# Rank in the wait lists of the tasks without a deadline, added to their submission time in ms,
+# so that they come after the tasks with a deadline
+NO_DEADLINE_RANK_MS = 10 ** 15
+
+
+def rate_key(dimension: str) -> str:
+    """
+    Return the key of the theoretical arrival time of the next token for the dimension.
+    """
+    return RATE_KEY_PREFIX + dimension
+
+
+def rate_reservation_key(dimension: str, task_id: str) -> str:
+    """
+    Return the key of the token reserved by a deferred task on the dimension.
+    """
+    return f"{RATE_KEY_PREFIX}{dimension}:reserved:{task_id}"
+
+
+def wait_rank(deadline: float | None, submitted_at: float) -> int:
+    """
+    Return the rank of a task in its wait list: its deadline in ms, or after every deadline
+    in submission order for a task without a deadline.
+    """
+    if deadline is None:
+        return NO_DEADLINE_RANK_MS + int(submitted_at * 1000)
+    return int(deadline * 1000)
+
+
+class AdmissionRequest(NamedTuple):
+    """
+    Arguments of a single admission.
+    """
+    job_id: str
+    task_name: str
+    task_data: EncodedPayload
+    task_metadata: dict
+    dimensions: list
+    limits: list
+    # Units of capacity the task takes on each dimension
+    costs: list
+    # Rate limit of each dimension, None if unlimited
+    rate_limits: list
+    # Lease duration in seconds, until the worker renews it or the job completes
+    lease_ttl: float
+    # Tenant the task is queued for when it is blocked, to share capacity fairly between tenants
+    tenant: str
+    # Priority lane the task waits in when it is blocked, lower lanes are redispatched first
+    priority: int
+    # Encoded dispatch args, parked in a wait list when the task is blocked, ending with the encoded payload
+    deferred_entry: bytes
+    # Time in epoch seconds past which the task is dropped rather than admitted, None if it has no deadline
+    deadline: float | None = None
+    # Backlog of each dimension past which the task is shed rather than parked, None if unlimited
+    backlog_caps: list | None = None
+    # Total backlog past which the task is shed rather than parked or deferred, None if unlimited
+    total_backlog_cap: int | None = None
+    # Wait in seconds for a rate limit token past which the task is shed, None if unlimited
+    max_rate_wait: float | None = None
+
+
+class AdmissionEngine:
+    """
+    Atomic admission engine backed by server-side Redis scripts.
+
+    Blocked tasks wait in one list per blocking dimension, priority lane and tenant in the partition of the
+    dimension, earliest deadline first, and a ready index per partition keeps track of the dimensions that have free capacity and
+    waiting tasks. Tasks out of rate limit tokens are deferred to the delayed queue until
+    their next token is available.
+    """
+    def __init__(self, arq: ArqRedis, redis_client: Redis, codec: Codec, inflight_key: str, queue: PartitionedQueue, delayed_queue: DelayedQueue, task_status: TaskStatusStore | None = None, backpressure: Backpressure | None = None):
+        """
+        Initialize the admission engine and register its scripts.
+
+        Args:
+            arq (ArqRedis): The Arq Redis client instance, used for its queue name and expiry settings.
+            redis_client (Redis): The Redis client instance the scripts are registered on.
+            codec (Codec): The codec of the arq jobs, the job serializer of the arq pool.
+            inflight_key (str): The key for inflight jobs in Redis.
+            queue (PartitionedQueue): The key layout of the partitioned dispatcher queue.
+            delayed_queue (DelayedQueue): The delayed queue rate limited tasks are deferred to.
+            task_status (TaskStatusStore): The status store the admission outcomes are written to, if any.
+            backpressure (Backpressure): The backlog limits giving the retry delay of the shed tasks, if any.
+        """
+        self.arq = arq
+        self.redis_client = redis_client
+        self.codec = codec
+        self.inflight_key = inflight_key
+        self.queue = queue
+        self.delayed_queue = delayed_queue
+        self.task_status = task_status
+        self.backpressure = backpressure
+        self._admit_script = redis_client.register_script(ADMIT_SCRIPT)
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+        self._pop_waiting_script = redis_client.register_script(POP_WAITING_SCRIPT)
+        self._wake_script = redis_client.register_script(WAKE_SCRIPT)
+
+    async def admit(self, request: AdmissionRequest) -> tuple[int, str | None, float | None]:
+        """
+        Check the cost of the task against what is left of every limit, reserve all of them and write the arq job
+        and the inflight entry in one round trip. When a dimension is full, the deferred entry
+        is parked in the wait list of that dimension instead, and when a rate limit is out of
+        tokens the task is deferred until its next token is available. A task that would take
+        the backlog past the caps of the request is shed instead of parked or deferred.
+
+        Returns:
+            tuple[int, str | None, float | None]: The admission outcome, the blocking dimension, if any,
+                and the retry delay in seconds of a shed task.
+        """
+        keys, args = self._admit_call(request)
+        reply = await self._admit_script(keys=keys, args=args)
+        return self._admit_outcome(request, reply)
+
+    async def admit_many(self, requests: list[AdmissionRequest]) -> list[tuple[int, str | None, float | None]]:
+        """
+        Run a batch of admissions in one pipelined round trip. Each admission stays atomic.
+
+        Returns:
+            list[tuple[int, str | None, float | None]]: The admission outcome, the blocking dimension and the retry delay of each request.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for request in requests:
+                keys, args = self._admit_call(request)
+                await self._admit_script(keys=keys, args=args, client=pipe)
+            replies = await pipe.execute()
+        return [self._admit_outcome(request, reply) for request, reply in zip(requests, replies)]
+
+    def _admit_call(self, request: AdmissionRequest) -> tuple[list, list]:
+        enqueue_time_ms = timestamp_ms()
+        # The job is only put together by the script on admission, with the payload of the dispatch args
+        job_prefix, job_suffix = serialize_job(request.task_name, (PAYLOAD_SLOT, request.task_metadata), {}, None, enqueue_time_ms, serializer=partial(self.codec.encode_split, payload_size=len(request.task_data.data)))
+        keys = [
+            self.inflight_key,
+            job_key_prefix + request.job_id,
+            result_key_prefix + request.job_id,
+            self.arq.default_queue_name,
+            LEASE_DIMENSIONS_KEY,
+            LEASE_USAGE_KEY,
+            self.delayed_queue.delayed_key,
+            self.delayed_queue.wakeup_key,
+            *(lease_key(dimension) for dimension in request.dimensions),
+            *(lease_cost_key(dimension) for dimension in request.dimensions),
+            *(self.queue.wait_key(dimension, request.priority, request.tenant) for dimension in request.dimensions),
+            *(rate_key(dimension) for dimension in request.dimensions),
+            *(rate_reservation_key(dimension, request.task_metadata["_task_id"]) for dimension in request.dimensions),
+            *(self.queue.tenants_key(dimension) for dimension in request.dimensions),
+            *(self.queue.ready_key(self.queue.partition_of(dimension)) for dimension in request.dimensions),
+            task_status_key(request.task_metadata["_task_id"]),
+            BACKLOG_KEY,
+            BACKLOG_TOTAL_KEY,
+        ]
+        args = [
+            request.job_id,
+            job_prefix,
+            enqueue_time_ms,
+            self.arq.expires_extra_ms,
+            request.deferred_entry,
+            wait_rank(request.deadline, request.task_metadata["_submitted_at"]),
+            int(request.lease_ttl * 1000),
+            *(-1 if limit is None else limit for limit in request.limits),
+            *request.costs,
+            *request.dimensions,
+            *(-1 if rate_limit is None else int(1_000_000 / rate_limit.rate) for rate_limit in request.rate_limits),
+            *(1 if rate_limit is None else rate_limit.burst for rate_limit in request.rate_limits),
+            f"{request.priority}:{request.tenant}",
+            int(self.task_status.ttl * 1000) if self.task_status else 0,
+            task_status_channel(request.task_metadata["_task_id"]),
+            -1 if request.total_backlog_cap is None else request.total_backlog_cap,
+            -1 if request.max_rate_wait is None else int(request.max_rate_wait * 1_000_000),
+            *(-1 if cap is None else cap for cap in request.backlog_caps or [None] * len(request.dimensions)),
+            -1 if request.deadline is None else int(request.deadline * 1000),
+            job_suffix,
+            len(request.task_data.data),
+        ]
+        return keys, args
+
+    def _admit_outcome(self, request: AdmissionRequest, reply: list) -> tuple[int, str | None, float | None]:
+        outcome, index, *details = reply
+        blocking_dimension = request.dimensions[index - 1] if outcome in (BLOCKED, RATE_LIMITED, SHED) else None
+        retry_after = None
+        if outcome == SHED:
+            reason, excess = details
+            retry_after = self.backpressure.retry_after(reason, blocking_dimension, excess) if self.backpressure else None
+        return outcome, blocking_dimension, retry_after
+
+    async def release(self, job_id: str, dimensions: list):
+        """
+        Release the leases of a job in one round trip, waking the tasks waiting on them.
+        """
+        if dimensions:
+            keys = [
+                LEASE_USAGE_KEY,
+                BACKLOG_DRAINED_KEY,
+                *(lease_key(dimension) for dimension in dimensions),
+                *(lease_cost_key(dimension) for dimension in dimensions),
+                *self.queue.wake_keys(dimensions),
+            ]
+            await self._release_script(keys=keys, args=[job_id, *dimensions])
+
+    async def ready_dimensions(self, partition: int) -> list[str]:
+        """
+        Return the dimensions that have free capacity and waiting tasks in the partition.
+        """
+        return [dimension.decode() for dimension in await self.redis_client.smembers(self.queue.ready_key(partition))]
+
+    async def waiting_tenants(self, dimension: str) -> dict[int, list[str]]:
+        """
+        Return the tenants that have tasks waiting on the dimension, by priority lane.
+        """
+        lanes = {}
+        for member in await self.redis_client.smembers(self.queue.tenants_key(dimension)):
+            priority, tenant = member.decode().split(":", 1)
+            lanes.setdefault(int(priority), []).append(tenant)
+        return lanes
+
+    async def pop_waiting(self, dimension: str, priority: int, tenant: str, max_expired: int = 100) -> tuple[bytes | None, list[bytes]]:
+        """
+        Pop the next task of the tenant waiting on the dimension in the priority lane, dropping the
+        tasks past their deadline ahead of it.
+
+        Returns:
+            tuple[bytes | None, list[bytes]]: The next task, None if the wait list is drained or more expired
+                tasks are left ahead of it, and the expired tasks dropped.
+        """
+        keys = [self.queue.ready_key(self.queue.partition_of(dimension)), self.queue.tenants_key(dimension), self.queue.wait_key(dimension, priority, tenant), BACKLOG_KEY, BACKLOG_TOTAL_KEY]
+        raw, *expired = await self._pop_waiting_script(keys=keys, args=[dimension, f"{priority}:{tenant}", max_expired])
+        return raw, expired
+
+    async def wait_list_heads(self, dimensions: list) -> list[tuple[str, int, int, bytes | None]]:
+        """
+        Return the length and the head entry of every wait list of the dimensions, as (dimension, priority,
+        length, head) tuples.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for dimension in dimensions:
+                pipe.smembers(self.queue.tenants_key(dimension))
+            members = await pipe.execute()
+            wait_lists = []
+            for dimension, lane_members in zip(dimensions, members):
+                for member in lane_members:
+                    priority, tenant = member.decode().split(":", 1)
+                    wait_lists.append((dimension, int(priority)))
+                    wait_key = self.queue.wait_key(dimension, int(priority), tenant)
+                    pipe.zcard(wait_key)
+                    pipe.zrange(wait_key, 0, 0)
+            replies = await pipe.execute() if wait_lists else []
+        return [
+            (dimension, priority, replies[2 * i], next(iter(replies[2 * i + 1]), None))
+            for i, (dimension, priority) in enumerate(wait_lists)
+        ]
+
+    async def wake(self, partitions: list[int]):
+        """
+        Wake up the dispatchers waiting for a release in the partitions, e.g. for the owner to stop.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for partition in partitions:
+                pipe.lpush(self.queue.wakeup_key(partition), 1)
+                pipe.ltrim(self.queue.wakeup_key(partition), 0, 0)
+            await pipe.execute()
+
+    async def wake_dimensions(self, dimensions: list) -> int:
+        """
+        Mark the dimensions that tasks are waiting on as ready, waking up the owners of their partitions.
+
+        Returns:
+            int: The number of dimensions with waiting tasks.
+        """
+        if not dimensions:
+            return 0
+        return await self._wake_script(keys=self.queue.wake_keys(dimensions), args=dimensions)
+
+    async def wait_for_release(self, partitions: list[int], timeout: float):
+        """
+        Block until a slot with tasks waiting in one of the partitions is released, or until the timeout expires.
+        """
+        await self.redis_client.blpop([self.queue.wakeup_key(partition) for partition in partitions], timeout=timeout)
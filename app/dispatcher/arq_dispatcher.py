@@ -1,17 +1,86 @@
 import asyncio
-import json
+import logging
 import time
+from uuid import uuid4
 
 from arq import ArqRedis
+from metrics import PipelineMetrics
 from redis import Redis
 from throttling.policy_base import ThrottlingPolicy
 
+from .admission import (ADMITTED, BLOCKED, DUPLICATED, EXPIRED, RATE_LIMITED,
+                        SHED, AdmissionEngine, AdmissionRequest)
+from .backpressure import Backpressure, BackpressureConfig, Overloaded
+from .codec import Codec, EncodedPayload
+from .delayed_queue import DelayedQueue
+from .fair_queue import DeficitRoundRobin
+from .leases import SlotLeases
+from .partitions import (PartitionConfig, PartitionedQueue,
+                         PartitionLeaseManager)
+from .quota import QuotaConfig, QuotaLeases
+from .task_status import TASK_DEFERRED, TASK_EXPIRED, TaskStatusStore
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of a dispatch
+ENQUEUED = "enqueued"
+DEFERRED = "deferred"
+REJECTED = "rejected"
+
+# Size of the header size prefix of the queue entries
+ENTRY_HEADER_SIZE_BYTES = 4
+
+# Time in seconds a dispatcher loop waits after a failed pass, and a failed task before it is retried
+LOOP_ERROR_BACKOFF = 1.0
+
+# Priority lanes, lower lanes are redispatched first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Names of the admission outcomes in the metrics
+ADMISSION_OUTCOME_NAMES = {
+    ADMITTED: "admitted",
+    BLOCKED: "blocked",
+    RATE_LIMITED: "rate_limited",
+    DUPLICATED: "duplicated",
+    SHED: "shed",
+    EXPIRED: "expired",
+}
+
 
 class ConcurrencyAwareArqDispatcher:
     """
     ConcurrencyAwareArqDispatcher class to handle concurrent requests.
     """
-    def __init__(self, arq: ArqRedis, redis_client: Redis, throttling_policy: ThrottlingPolicy = None, inflight_key: str = "arq:jobs:inflight", queue_key: str = "dispatcher:queue"):
+    def __init__(
+        self,
+        arq: ArqRedis,
+        redis_client: Redis,
+        throttling_policy: ThrottlingPolicy = None,
+        inflight_key: str = "arq:jobs:inflight",
+        queue_key: str = "dispatcher:queue",
+        redispatch_batch_size: int = 100,
+        idle_timeout: float = 1.0,
+        max_promote_wait: float = 60.0,
+        lease_ttl: float = 3600.0,
+        reclaim_interval: float = 5.0,
+        replica_id: str = None,
+        partition_config: PartitionConfig = None,
+        policy_refresh_interval: float = 1.0,
+        tenant_dimension: str = "account",
+        tenant_weights: dict = None,
+        fair_quantum: float = 1.0,
+        priority_aging: float = 30.0,
+        reserved_capacity: dict = None,
+        codec: Codec = None,
+        metrics: PipelineMetrics = None,
+        quota_config: QuotaConfig = None,
+        backpressure_config: BackpressureConfig = None,
+        task_status_ttl: float = 86400.0,
+        completion_stream_key: str = "arq:jobs:completed",
+        completion_stream_maxlen: int = 100_000,
+    ):
         """
         Initialize the dispatcher with a Redis client.
 
@@ -19,139 +88,763 @@ class ConcurrencyAwareArqDispatcher:
             arq (ArqRedis): The Arq Redis client instance.
             redis_client (Redis): The Redis client instance.
             throttling_policy (ThrottlingPolicy): The throttling policy instance.
-            poll_interval (float): The interval for polling the dispatcher queue.
             inflight_key (str): The key for inflight jobs in Redis.
-            queue_key (str): The key for the dispatcher queue in Redis.
+            queue_key (str): The key prefix for the dispatcher wait lists in Redis.
+            redispatch_batch_size (int): The maximum number of waiting tasks redispatched per partition and pass.
+            idle_timeout (float): The maximum time to wait for a slot release when no task can be redispatched.
+            max_promote_wait (float): The maximum time to wait for a deferred task when none is scheduled.
+            lease_ttl (float): The default slot lease duration in seconds, until the worker renews it when the job starts.
+            reclaim_interval (float): The interval for reclaiming the expired slot leases.
+            replica_id (str): The unique ID of this dispatcher replica.
+            partition_config (PartitionConfig): The partitions of the dispatcher queue, spread over the dispatcher replicas, 8 by default.
+            policy_refresh_interval (float): The interval for reloading the limits the throttling policy shares through Redis.
+            tenant_dimension (str): The dimension type whose value identifies the tenant of a task, e.g. `account` for `account:acct-001`.
+            tenant_weights (dict): The share of each tenant in the capacity of a dimension, 1 for the tenants not listed.
+            fair_quantum (float): The capacity units granted per round robin turn to a tenant of weight 1.
+            priority_aging (float): The maximum time a priority lane with waiting tasks goes without being served, before lanes ahead of it.
+            reserved_capacity (dict): The capacity units of each dimension only available to high priority tasks, e.g. {"cluster": 2}.
+            codec (Codec): The codec of the queue entries, also used by the arq pool as job serializer. The codec of the arq pool by default.
+            metrics (PipelineMetrics): The metrics recording the admission decisions and sampling the occupancy and backlog, if any.
+            quota_config (QuotaConfig): The quota blocks the dimensions with a high limit are admitted locally from, none by default.
+            backpressure_config (BackpressureConfig): The backlog limits past which submissions are shed, none by default.
+            task_status_ttl (float): The time in seconds the status of a task is kept after its last change.
+            completion_stream_key (str): The key of the completion stream the tasks dropped past their deadline are reported on.
+            completion_stream_maxlen (int): The approximate maximum length of the completion stream.
         """
+        self.codec = codec or getattr(arq.job_serializer, "__self__", None)
+        if not isinstance(self.codec, Codec) or arq.job_serializer != self.codec.encode or arq.job_deserializer != self.codec.decode:
+            # The arq jobs embed the payloads encoded by the dispatcher codec
+            raise ValueError("The arq pool must use the dispatcher codec, create it with job_serializer=codec.encode and job_deserializer=codec.decode")
         self.arq = arq
         self.redis_client = redis_client
         self.throttling_policy = throttling_policy
         self.inflight_key = inflight_key
         self.queue_key = queue_key
+        self.redispatch_batch_size = redispatch_batch_size
+        self.idle_timeout = idle_timeout
+        self.max_promote_wait = max_promote_wait
+        self.lease_ttl = lease_ttl
+        self.reclaim_interval = reclaim_interval
+        partition_config = partition_config or PartitionConfig()
+        quota_config = quota_config or QuotaConfig()
+        backpressure_config = backpressure_config or BackpressureConfig()
+        self.partition_lease_ttl = partition_config.lease_ttl
+        self.policy_refresh_interval = policy_refresh_interval
+        self.tenant_dimension = tenant_dimension
+        self.tenant_weights = tenant_weights or {}
+        self.fair_quantum = fair_quantum
+        self.priority_aging = priority_aging
+        self.reserved_capacity = reserved_capacity or {}
+        self.metrics = metrics
+        self.quota_sync_interval = quota_config.sync_interval
+        self.backpressure_sample_interval = backpressure_config.sample_interval
+        self.completion_stream_key = completion_stream_key
+        self.completion_stream_maxlen = completion_stream_maxlen
+        self._fair_queues: dict[tuple[str, int], DeficitRoundRobin] = {}
+        self._lanes_served_at: dict[tuple[str, int], float] = {}
+        self.queue = PartitionedQueue(queue_key, partition_config.count)
+        self.partitions = PartitionLeaseManager(redis_client, partition_config.count, replica_id, partition_config.lease_ttl)
+        self.delayed_queue = DelayedQueue(redis_client, queue_key)
+        self.task_status = TaskStatusStore(redis_client, self.codec, task_status_ttl)
+        self.backpressure = Backpressure(redis_client, backpressure_config.max_backlog, backpressure_config.max_total_backlog, backpressure_config.max_wait)
+        self.admission = AdmissionEngine(arq, redis_client, self.codec, inflight_key, self.queue, self.delayed_queue, self.task_status, self.backpressure)
+        self.leases = SlotLeases(redis_client)
+        self.quota = QuotaLeases(redis_client, self.partitions.replica_id, quota_config.min_limit, quota_config.block_fraction, quota_config.ttl)
+        if throttling_policy:
+            # A raised limit frees capacity without any release to wake the waiting tasks
+            throttling_policy.add_limit_listener(self._on_limits_changed)
         
     async def start(self):
         """
         Start the dispatcher to redispatch tasks.
         """
-        print("[ConcurrencyAwareArqDispatcher] Starting dispatcher...")
+        logger.info("Starting dispatcher...")
         self._running = True
-        lock = self.redis_client.lock("dispatcher:lock", timeout=10)
+        self._stopping = asyncio.Event()
         
         async def run_loop():
+            rebalanced_at = 0
+            reclaimed_at = 0
+            refreshed_at = 0
             while self._running:
-                print("[ConcurrencyAwareArqDispatcher] Acquiring lock...")
-                got_lock = await lock.acquire(blocking_timeout=0.5)
-                if got_lock:
-                    print("[ConcurrencyAwareArqDispatcher] Lock acquired.")
-                    try:
-                        # Get the next task from the dispatcher queue
-                        raw = await self.redis_client.lpop(self.queue_key)
-                        if not raw:
-                            await asyncio.sleep(1)  # Sleep for a while if no task is available
-                            continue
-                        
-                        # Parse the task data
-                        dispatch_args = self._decode_dispatch_args(raw)
-                        task_name, task_data, task_metadata = dispatch_args
-                        
-                        retry_dispatch_interval = task_metadata.get("_retry_dispatch_interval", 10)
-                        dispatched_at = task_metadata.get("_dispatched_at", 0)
-                        now = int(time.time()) # epoch timestamp
-                        if now - dispatched_at < retry_dispatch_interval:
-                            # If the task is not ready to be retried, re-add it to the queue
-                            await self.redis_client.rpush(self.queue_key, raw)
-                            print(f"[ConcurrencyAwareArqDispatcher] Task {task_name} is not ready to be retried. Re-adding to queue.")
+                try:
+                    if self.throttling_policy and time.monotonic() - refreshed_at >= self.policy_refresh_interval:
+                        await self.throttling_policy.refresh()
+                        refreshed_at = time.monotonic()
+                    if time.monotonic() - rebalanced_at >= self.partition_lease_ttl / 3:
+                        # Heartbeat and renew the partition leases well before they expire
+                        owned = set(self.partitions.owned)
+                        if owned != set(await self.partitions.rebalance()):
+                            logger.info("Owning partitions %s.", self.partitions.owned)
+                        rebalanced_at = time.monotonic()
+                    if not self.partitions.owned:
+                        # Every partition is owned by another replica
+                        await self._sleep(self.partition_lease_ttl / 3)
+                        continue
+                
+                    if 0 in self.partitions.owned and time.monotonic() - reclaimed_at >= self.reclaim_interval:
+                        # Give back the slots of the jobs that never reported their completion,
+                        # once per period across the replicas
+                        reclaimed = await self.leases.reclaim(self.queue)
+                        if reclaimed:
+                            logger.info("Reclaimed %d expired slot lease(s).", reclaimed)
+                        reclaimed = await self.quota.reclaim(self.queue)
+                        if reclaimed:
+                            logger.info("Reclaimed %d unit(s) of expired quota blocks.", reclaimed)
+                        reclaimed_at = time.monotonic()
+                
+                    redispatched = 0
+                    for partition in self.partitions.owned:
+                        redispatched += await self._redispatch_ready(partition)
+                    if not redispatched:
+                        # No dimension has both free capacity and waiting tasks, wait for a release
+                        await self.admission.wait_for_release(self.partitions.owned, self.idle_timeout)
+                except Exception:
+                    logger.exception("Failed to redispatch the waiting tasks, retrying in %ss.", LOOP_ERROR_BACKOFF)
+                    await self._sleep(LOOP_ERROR_BACKOFF)
+        
+        async def promote_loop():
+            while self._running:
+                try:
+                    next_due = await self._promote_due()
+                    if next_due is None:
+                        timeout = self.max_promote_wait
+                    else:
+                        timeout = (next_due - int(time.time() * 1000)) / 1000
+                        if timeout <= 0:
                             continue
-                        
-                        # Dispatch the task
-                        await self.dispatch(task_name, task_data, task_metadata)
-                    finally:
-                        print(f"[ConcurrencyAwareArqDispatcher] Releasing lock after processing task.")
-                        await lock.release()
-            print("[ConcurrencyAwareArqDispatcher] Stopped dispatcher.")
-        asyncio.create_task(run_loop())
+                    # Sleep until the next task is due, unless an earlier one is scheduled meanwhile
+                    await self.delayed_queue.wait_for_earlier(min(max(timeout, 0.01), self.max_promote_wait))
+                except Exception:
+                    logger.exception("Failed to promote the deferred tasks, retrying in %ss.", LOOP_ERROR_BACKOFF)
+                    await self._sleep(LOOP_ERROR_BACKOFF)
+        
+        async def quota_loop():
+            while self._running:
+                await self._sleep(self.quota_sync_interval)
+                if not self._running:
+                    break
+                try:
+                    await self.quota.sync(self.queue)
+                except Exception:
+                    logger.exception("Failed to sync the quota blocks, retrying in %ss.", LOOP_ERROR_BACKOFF)
+                    await self._sleep(LOOP_ERROR_BACKOFF)
+        
+        async def backpressure_loop():
+            while self._running:
+                try:
+                    await self.backpressure.sample()
+                except Exception as e:
+                    logger.warning("Failed to sample the backlog: %s", e)
+                await self._sleep(self.backpressure_sample_interval)
+        self._tasks = [asyncio.create_task(run_loop()), asyncio.create_task(promote_loop())]
+        if self.quota.enabled:
+            self._tasks.append(asyncio.create_task(quota_loop()))
+        if self.backpressure.enabled:
+            self._tasks.append(asyncio.create_task(backpressure_loop()))
         
     async def stop(self):
         """
-        Stop the dispatcher.
+        Stop the dispatcher, waiting for its loops to end, then give back the unused quota blocks and
+        the owned partitions, so that the other replicas take them over right away.
         """
-        print("[ConcurrencyAwareArqDispatcher] Stopping dispatcher...")
+        logger.info("Stopping dispatcher...")
         self._running = False
+        self._stopping.set()
+        # The loops may be waiting for a release or an earlier task
+        await self.admission.wake(self.partitions.owned)
+        await self.delayed_queue.wake()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+        if self.quota.enabled:
+            # No task is admitted anymore, leave the units of the running jobs to expire with the blocks
+            await self.quota.sync(self.queue, give_back_all=True)
+        await self.partitions.release_all()
+        logger.info("Stopped dispatcher.")
+    
+    async def _on_limits_changed(self, dimensions: list[str]):
+        """
+        Wake the tasks waiting on the dimensions whose limit changed, for them to be admitted again.
+        """
+        woken = await self.admission.wake_dimensions(dimensions)
+        if woken:
+            logger.info("Woke the tasks waiting on %d dimension(s) after a limit change.", woken)
+    
+    async def _sleep(self, delay: float):
+        """
+        Sleep for the delay, or until the dispatcher stops.
+        """
+        try:
+            await asyncio.wait_for(self._stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
     
-    async def dispatch(self, task_name: str, task_data: dict, task_metadata: dict = None):
+    async def dispatch(self, task_name: str, task_data: dict, task_metadata: dict = None) -> str:
         """
         Dispatch the request to the appropriate handler with concurrency control.
+
+        Admission, slot reservation, job enqueueing and inflight tracking happen atomically
+        in a single Redis round trip. If any dimension is at its limit, the task waits in the
+        wait list of that dimension instead, and if any dimension is out of rate limit tokens,
+        the task is deferred until its next token is available.
+
+        A task takes one unit of each dimension, unless its `_cost` metadata says otherwise,
+        see `_resolve_costs`.
+
+        Tasks with a `_defer_until` (epoch seconds) or `_defer_by` (seconds) metadata are kept
+        in the delayed queue until they are due.
+
+        The task keeps its ID, from the `_task_id` metadata or generated, whether it waits or is
+        enqueued right away. Its status, with the ID of its arq job once enqueued, is kept in
+        the task status store.
+
+        A task that would take the backlog past the backlog limits of the dispatcher is shed, and
+        with a `_no_wait` metadata a task is shed unless it is admitted right away.
+
+        Tasks with a `_deadline` (epoch seconds) or `_max_queue_age` (seconds) metadata wait ahead
+        of the other tasks of their lane, earliest deadline first, and are dropped once past their
+        deadline instead of being admitted. The drop is reported to the result collector, which
+        passes it on with the expired status.
+
+        Returns:
+            str: The ID of the task.
+
+        Raises:
+            Overloaded: If the task is shed, with the estimated delay before a retry is accepted.
+        """
+        task_metadata = self._prepare_metadata(task_metadata)
+        defer_until = self._get_defer_until(task_metadata)
+        if defer_until:
+            # Before deferring, the task may be promoted right away
+            await self.task_status.set(task_metadata["_task_id"], TASK_DEFERRED)
+            await self.delayed_queue.defer(self._encode_dispatch_args(task_name, task_data, task_metadata), int(defer_until * 1000))
+            logger.debug("Task %s is deferred until %s.", task_name, defer_until)
+            return task_metadata["_task_id"]
+        
+        await self._admit(task_name, task_data, task_metadata)
+        return task_metadata["_task_id"]
+    
+    async def dispatch_many(self, tasks: list[tuple[str, dict, dict | None]], chunk_size: int = 500) -> list[dict]:
+        """
+        Dispatch a batch of tasks, admitting and enqueueing each chunk in pipelined round trips.
+
+        Args:
+            tasks (list[tuple[str, dict, dict | None]]): The task name, data and metadata of each task.
+            chunk_size (int): The number of tasks sent per pipelined round trip.
+
+        Returns:
+            list[dict]: The task ID, job ID and outcome (enqueued, deferred or rejected) of each task, in order.
         """
+        results = []
+        for start in range(0, len(tasks), chunk_size):
+            results.extend(await self._dispatch_chunk(tasks[start:start + chunk_size]))
+        return results
+    
+    async def _dispatch_chunk(self, tasks: list[tuple[str, dict, dict | None]]) -> list[dict]:
+        results = [None] * len(tasks)
+        deferrals = []
+        requests = []
+        request_indexes = []
+        for i, (task_name, task_data, task_metadata) in enumerate(tasks):
+            task_metadata = self._prepare_metadata(task_metadata)
+            try:
+                defer_until = self._get_defer_until(task_metadata)
+                if defer_until:
+                    deferrals.append((self._encode_dispatch_args(task_name, task_data, task_metadata), int(defer_until * 1000)))
+                    results[i] = {"task_id": task_metadata["_task_id"], "job_id": None, "outcome": DEFERRED}
+                else:
+                    requests.append(self._prepare_admission(task_name, task_data, task_metadata))
+                    request_indexes.append(i)
+            except (TypeError, ValueError) as e:
+                # The task can not be encoded, reject it without failing the whole batch
+                results[i] = {"task_id": task_metadata["_task_id"], "job_id": None, "outcome": REJECTED, "error": str(e)}
+        
+        if deferrals:
+            await self.task_status.set_many([result["task_id"] for result in results if result and result["outcome"] == DEFERRED], TASK_DEFERRED)
+            await self.delayed_queue.defer_many(deferrals)
+        if requests:
+            admissions = []
+            try:
+                for request in requests:
+                    admissions.append(self._limit_backlog(await self._take_quota(request)))
+                outcomes = await self.admission.admit_many(admissions)
+            except Exception:
+                # None of the tasks is admitted, put back the units taken from the quota blocks
+                for request in admissions:
+                    self._settle_quota(request, None)
+                raise
+            requests = admissions
+            await self._report_expired([request.task_metadata for request, (outcome, _, _) in zip(requests, outcomes) if outcome == EXPIRED], "submit")
+            for i, request, (outcome, _, retry_after) in zip(request_indexes, requests, outcomes):
+                self._settle_quota(request, outcome)
+                self._record_admission(request, outcome, "submit")
+                if outcome == ADMITTED:
+                    results[i] = {"task_id": request.task_metadata["_task_id"], "job_id": request.job_id, "outcome": ENQUEUED}
+                elif outcome in (BLOCKED, RATE_LIMITED):
+                    results[i] = {"task_id": request.task_metadata["_task_id"], "job_id": None, "outcome": DEFERRED}
+                elif outcome == SHED:
+                    results[i] = {"task_id": request.task_metadata["_task_id"], "job_id": None, "outcome": REJECTED, "error": "overloaded", "retry_after": retry_after}
+                elif outcome == EXPIRED:
+                    results[i] = {"task_id": request.task_metadata["_task_id"], "job_id": None, "outcome": REJECTED, "error": "expired"}
+                else:
+                    results[i] = {"task_id": request.task_metadata["_task_id"], "job_id": None, "outcome": REJECTED, "error": "duplicated job"}
+        return results
+    
+    def _prepare_metadata(self, task_metadata: dict | None) -> dict:
+        if task_metadata is None:
+            task_metadata = {}
+        task_metadata.setdefault("_task_id", uuid4().hex)
+        task_metadata.setdefault("_submitted_at", time.time())
+        
+        # Tasks deferred to a later time do not take any slot until they are due
+        defer_by = task_metadata.pop("_defer_by", None)
+        if defer_by:
+            task_metadata["_defer_until"] = time.time() + defer_by
+        
+        # Tasks not admitted within their maximum queueing time are dropped, an explicit deadline prevails
+        max_queue_age = task_metadata.pop("_max_queue_age", None)
+        if max_queue_age:
+            task_metadata.setdefault("_deadline", task_metadata["_submitted_at"] + max_queue_age)
+        return task_metadata
+    
+    def _get_defer_until(self, task_metadata: dict) -> float | None:
+        defer_until = task_metadata.get("_defer_until")
+        if defer_until and defer_until > time.time():
+            return defer_until
+        return None
+    
+    def _prepare_admission(self, task_name: str, task_data: dict | EncodedPayload, task_metadata: dict) -> AdmissionRequest:
+        # Encode the payload once, for both the arq job and the wait list entry
+        task_data = self.codec.encode_payload(task_data)
         now = int(time.time()) # epoch timestamp
         task_metadata["_dispatched_at"] = now
+        # Time of this admission attempt, the enqueue time of the arq job if the task is admitted
+        task_metadata["_enqueued_at"] = time.time()
         
-        concurrency_dimensions = task_metadata.get("_concurrency_dimensions", [])
-        
-        if not self.throttling_policy:
-            # Tracking key across all dispatcher instances
-            await self.increase_concurrency(concurrency_dimensions)
-                
-            # Dispatch the task immediately
-            job = await self.arq.enqueue_job(task_name, task_data, task_metadata)
-            
-            # Add the job ID to the inflight set
-            await self.redis_client.sadd(self.inflight_key, job.job_id)
+        # Deduplicate while keeping order, a dimension must only be reserved once per task
+        concurrency_dimensions = list(dict.fromkeys(task_metadata.get("_concurrency_dimensions", [])))
+        task_metadata["_concurrency_dimensions"] = concurrency_dimensions
+        # Set by _take_quota for this admission only
+        task_metadata.pop("_quota", None)
+        if self.throttling_policy:
+            limits = [self.throttling_policy.get_limit(dimension) for dimension in concurrency_dimensions]
+            rate_limits = [self.throttling_policy.get_rate_limit(dimension) for dimension in concurrency_dimensions]
         else:
-            # If it is not allowed at least one dimension, add the job to dispatcher queue
-            for dimension in concurrency_dimensions:
-                current_value = await self.redis_client.get(f"dispatcher:concurrency:{dimension}")
-                if current_value is None:
-                    current_value = 0
+            limits = [None] * len(concurrency_dimensions)
+            rate_limits = [None] * len(concurrency_dimensions)
+        priority = task_metadata.setdefault("_priority", PRIORITY_NORMAL)
+        if not isinstance(priority, int) or isinstance(priority, bool) or priority < 0:
+            raise ValueError(f"Invalid priority {priority!r}, expected a non-negative integer")
+        if priority != PRIORITY_HIGH:
+            # Leave the reserved capacity to the high priority tasks
+            limits = [
+                limit if limit is None else max(limit - self.reserved_capacity.get(dimension, 0), 0)
+                for dimension, limit in zip(concurrency_dimensions, limits)
+            ]
+        costs = self._resolve_costs(task_metadata.get("_cost", 1), concurrency_dimensions, limits)
+        task_metadata["_concurrency_costs"] = costs
+        deadline = task_metadata.get("_deadline")
+        if deadline is not None and (not isinstance(deadline, (int, float)) or isinstance(deadline, bool)):
+            raise ValueError(f"Invalid deadline {deadline!r}, expected epoch seconds")
+        
+        return AdmissionRequest(
+            job_id=uuid4().hex,
+            task_name=task_name,
+            task_data=task_data,
+            task_metadata=task_metadata,
+            dimensions=concurrency_dimensions,
+            limits=limits,
+            costs=costs,
+            rate_limits=rate_limits,
+            lease_ttl=task_metadata.get("_lease_ttl", self.lease_ttl),
+            tenant=self._get_tenant(concurrency_dimensions),
+            priority=priority,
+            deferred_entry=self._encode_dispatch_args(task_name, task_data, task_metadata),
+            deadline=deadline,
+        )
+    
+    def _get_tenant(self, dimensions: list) -> str:
+        """
+        Return the tenant of a task, the value of its tenant dimension, or "" if it has none.
+        """
+        prefix = f"{self.tenant_dimension}:"
+        return next((dimension[len(prefix):] for dimension in dimensions if dimension.startswith(prefix)), "")
+    
+    def _resolve_costs(self, cost: int | dict, dimensions: list, limits: list) -> list[int]:
+        """
+        Resolve the cost of a task on each dimension.
+
+        The cost is either a number of units taken on every dimension, or a map keyed by
+        dimension name or dimension type (the part before the colon, e.g. `connector`),
+        where missing dimensions cost 1 unit. A cost above the limit of a dimension is capped
+        to the limit, so the task runs alone on it rather than never being admitted.
+        """
+        costs = []
+        for dimension, limit in zip(dimensions, limits):
+            if isinstance(cost, dict):
+                dimension_cost = cost.get(dimension, cost.get(dimension.split(":", 1)[0], 1))
+            else:
+                dimension_cost = cost
+            if not isinstance(dimension_cost, int) or isinstance(dimension_cost, bool) or dimension_cost < 1:
+                raise ValueError(f"Invalid cost {dimension_cost!r} for dimension {dimension}, expected a positive integer")
+            costs.append(dimension_cost if limit is None else min(dimension_cost, max(limit, 1)))
+        return costs
+    
+    async def _admit(self, task_name: str, task_data: dict, task_metadata: dict, source: str = "submit") -> tuple[int, str | None, str]:
+        """
+        Run the admission of a task, parking it in a wait list when it is blocked.
+
+        Returns:
+            tuple[int, str | None, str]: The admission outcome, the blocking dimension and the job ID.
+
+        Raises:
+            Overloaded: If a submission is shed by the backlog limits.
+        """
+        request = self._prepare_admission(task_name, task_data, task_metadata)
+        started_at = time.perf_counter()
+        request = await self._take_quota(request)
+        if source == "submit":
+            request = self._limit_backlog(request)
+        try:
+            outcome, blocking_dimension, retry_after = await self.admission.admit(request)
+        except Exception:
+            # The task is not admitted, put back the units taken from the quota blocks
+            self._settle_quota(request, None)
+            raise
+        self._settle_quota(request, outcome)
+        if self.metrics:
+            self.metrics.admission_duration.observe(time.perf_counter() - started_at, source=source)
+        self._record_admission(request, outcome, source)
+        if outcome == BLOCKED:
+            logger.debug("Task %s is not allowed for dimension %s. Waiting for a free slot.", task_name, blocking_dimension)
+        elif outcome == RATE_LIMITED:
+            logger.debug("Task %s is rate limited for dimension %s. Deferred until its next token.", task_name, blocking_dimension)
+        elif outcome == DUPLICATED:
+            logger.warning("Job %s already exists. Skipped task %s.", request.job_id, task_name)
+        elif outcome == EXPIRED:
+            logger.debug("Task %s is past its deadline. Dropped.", task_name)
+            await self._report_expired([task_metadata], source)
+        elif outcome == SHED:
+            logger.debug("Task %s is shed, the backlog of dimension %s is over its limit.", task_name, blocking_dimension)
+            if task_metadata.get("_no_wait"):
+                raise Overloaded(f"The task is not admissible right away on {blocking_dimension}", retry_after, blocking_dimension)
+            raise Overloaded(f"The backlog of {blocking_dimension} is over capacity", retry_after, blocking_dimension)
+        return outcome, blocking_dimension, request.job_id
+    
+    async def _take_quota(self, request: AdmissionRequest) -> AdmissionRequest:
+        """
+        Admit the task locally on the dimensions that have a quota block of this replica, taking their
+        cost from the blocks, and leave the other dimensions to the admission script.
+
+        A dimension is admitted locally when its limit is at least the quota minimum limit and it has
+        neither a rate limit nor a reserved capacity, which the blocks do not account for. When the
+        limit has no room left for a block, the dimension is admitted in Redis, where the task waits
+        for a release like on any full dimension.
+
+        Returns:
+            AdmissionRequest: The admission of the task on the remaining dimensions.
+        """
+        if not self.quota.enabled:
+            return request
+        taken = []
+        remaining = []
+        try:
+            for i, dimension in enumerate(request.dimensions):
+                if (
+                    dimension not in self.reserved_capacity
+                    and self.quota.eligible(request.limits[i], request.rate_limits[i])
+                    and await self.quota.take(dimension, request.limits[i], request.costs[i])
+                ):
+                    taken.append(dimension)
                 else:
-                    current_value = int(current_value)
-                if not self.throttling_policy.is_allowed(dimension, current_value):
-                    # Add the job to dispatcher queue with dispatching argument used to redispatch
-                    dispatch_args = self._encode_dispatch_args(task_name, task_data, task_metadata)
-                    await self.redis_client.rpush(self.queue_key, dispatch_args)
-                    print(f"[ConcurrencyAwareArqDispatcher] Task {task_name} is not allowed for dimension {dimension}. Added to dispatcher queue.")
-                    return
-                
-            # If all dimensions are allowed, increase concurrency and dispatch the task
-            await self.increase_concurrency(concurrency_dimensions)
-            job = await self.arq.enqueue_job(task_name, task_data, task_metadata)
-            await self.redis_client.sadd(self.inflight_key, job.job_id)
+                    remaining.append(i)
+        except Exception:
+            # Leasing a block failed, put back the units taken on the previous dimensions
+            for dimension in taken:
+                self.quota.give(dimension, request.costs[request.dimensions.index(dimension)])
+            raise
+        if not taken:
+            return request
+        # Tells the worker and the result collector which dimensions hold no slot lease
+        request.task_metadata["_quota"] = {"replica": self.quota.replica_id, "dimensions": taken}
+        return request._replace(
+            dimensions=[request.dimensions[i] for i in remaining],
+            limits=[request.limits[i] for i in remaining],
+            costs=[request.costs[i] for i in remaining],
+            rate_limits=[request.rate_limits[i] for i in remaining],
+        )
+    
+    def _limit_backlog(self, request: AdmissionRequest) -> AdmissionRequest:
+        """
+        Cap the backlog a new submission may join, from the backlog limits and the drain rate of its
+        dimensions. A task with the `_no_wait` metadata may not join any backlog.
+        """
+        if request.task_metadata.get("_no_wait"):
+            return request._replace(backlog_caps=[0] * len(request.dimensions), total_backlog_cap=0, max_rate_wait=0)
+        if not self.backpressure.enabled:
+            return request
+        return request._replace(
+            backlog_caps=[self.backpressure.backlog_cap(dimension) for dimension in request.dimensions],
+            total_backlog_cap=self.backpressure.max_total_backlog,
+            max_rate_wait=self.backpressure.max_wait,
+        )
+    
+    def _settle_quota(self, request: AdmissionRequest, outcome: int | None):
+        """
+        Keep the units taken from the quota blocks for the admitted job, or put them back,
+        also when the admission failed without an outcome.
+        """
+        quota = request.task_metadata.get("_quota")
+        if not quota:
+            return
+        costs = {dimension: self._get_cost(request.task_metadata, dimension) for dimension in quota["dimensions"]}
+        if outcome == ADMITTED:
+            self.quota.track(request.job_id, costs, request.lease_ttl)
+            return
+        for dimension, cost in costs.items():
+            self.quota.give(dimension, cost)
+        del request.task_metadata["_quota"]
+    
+    def _record_admission(self, request: AdmissionRequest, outcome: int, source: str):
+        if self.metrics is None:
+            return
+        self.metrics.admissions.inc(outcome=ADMISSION_OUTCOME_NAMES[outcome], source=source)
+        submitted_at = request.task_metadata.get("_submitted_at")
+        if outcome == ADMITTED and submitted_at:
+            self.metrics.submit_to_enqueue.observe(request.task_metadata["_enqueued_at"] - submitted_at)
+    
+    async def _redispatch_ready(self, partition: int) -> int:
+        """
+        Redispatch the tasks waiting in the partition on dimensions that have free capacity.
+
+        All the tasks waiting on a dimension are in its partition, whatever their tenant and priority,
+        so the lanes and tenants below are those of the whole dispatcher queue. Priority lanes are served in order,
+        except a lane left waiting for longer than the aging period, which is served first. Within a
+        lane, the released capacity of a dimension is shared between the waiting tenants by weighted
+        deficit round robin, and the tasks of a tenant are served earliest deadline first. A task
+        blocked again keeps its rank at the head of its wait list, so the cost grows with the number
+        of admissible tasks rather than the whole backlog. The tasks past their deadline are dropped
+        from the head of the wait lists on the way, without being admitted.
+
+        Returns:
+            int: The number of waiting tasks processed.
+        """
+        processed = 0
+        for dimension in await self.admission.ready_dimensions(partition):
+            lanes = await self.admission.waiting_tenants(dimension)
+            for priority in self._order_lanes(dimension, lanes):
+                if processed >= self.redispatch_batch_size:
+                    return processed
+                processed += await self._redispatch_lane(dimension, priority, lanes[priority], self.redispatch_batch_size - processed)
+        return processed
+    
+    def _order_lanes(self, dimension: str, lanes: dict[int, list[str]]) -> list[int]:
+        """
+        Return the priority lanes of the dimension in the order they are served. The lanes are those
+        of the whole dispatcher queue, and so is their aging.
+        """
+        now = time.monotonic()
+        for key in [key for key in self._lanes_served_at if key[0] == dimension and key[1] not in lanes]:
+            del self._lanes_served_at[key]
+        for priority in lanes:
+            self._lanes_served_at.setdefault((dimension, priority), now)
+        # Lanes starved for longer than the aging period go first, the longest starved first
+        starved = sorted(
+            (priority for priority in lanes if now - self._lanes_served_at[(dimension, priority)] >= self.priority_aging),
+            key=lambda priority: self._lanes_served_at[(dimension, priority)],
+        )
+        return starved + sorted(priority for priority in lanes if priority not in starved)
+    
+    async def _redispatch_lane(self, dimension: str, priority: int, tenants: list[str], budget: int) -> int:
+        key = (dimension, priority)
+        fair_queue = self._fair_queues.get(key)
+        if fair_queue is None:
+            fair_queue = self._fair_queues[key] = DeficitRoundRobin(self.tenant_weights, self.fair_quantum)
+        fair_queue.sync(tenants)
+        
+        processed = 0
+        while processed < budget:
+            tenant = fair_queue.next_tenant()
+            if tenant is None:
+                break
+            raw, expired = await self.admission.pop_waiting(dimension, priority, tenant, self.redispatch_batch_size)
+            if expired:
+                await self._report_expired([self._decode_dispatch_args(entry)[2] for entry in expired], "wait_list")
+            if raw is None:
+                if expired:
+                    # More expired tasks may be left ahead of the next one
+                    processed += 1
+                else:
+                    fair_queue.drop(tenant)
+                continue
+            processed += 1
+            try:
+                task_name, task_data, task_metadata = self._decode_dispatch_args(raw)
+                fair_queue.charge(tenant, self._get_cost(task_metadata, dimension))
+                outcome, blocking_dimension, _ = await self._admit(task_name, task_data, task_metadata, source="redispatch")
+            except (TypeError, ValueError):
+                logger.exception("Dropped a waiting task that can not be admitted.")
+                continue
+            except Exception:
+                # Already out of its wait list, the task comes back through the delayed queue
+                await self._retry_later([raw])
+                raise
+            if outcome == BLOCKED and blocking_dimension == dimension:
+                # The dimension is full again for this lane, the turn of the tenant resumes on the next release
+                fair_queue.charge(tenant, -self._get_cost(task_metadata, dimension))
+                break
+            self._lanes_served_at[key] = time.monotonic()
+        if not fair_queue.ring:
+            del self._fair_queues[key]
+        return processed
+    
+    async def _report_expired(self, task_metadatas: list[dict], source: str):
+        """
+        Report the tasks dropped past their deadline on the completion stream, for the result collector to
+        pass them on with the expired status. Only the header of their queue entry was decoded.
+        """
+        if not task_metadatas:
+            return
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_metadata in task_metadatas:
+                fields = {
+                    "status": TASK_EXPIRED,
+                    "task_id": task_metadata["_task_id"],
+                    "coalesce_key": task_metadata.get("_coalesce_key", ""),
+                }
+                pipe.xadd(self.completion_stream_key, fields, maxlen=self.completion_stream_maxlen, approximate=True)
+            await pipe.execute()
+        if self.metrics:
+            self.metrics.expired_tasks.inc(len(task_metadatas), source=source)
+    
+    def _get_cost(self, task_metadata: dict, dimension: str) -> int:
+        dimensions = task_metadata.get("_concurrency_dimensions", [])
+        costs = task_metadata.get("_concurrency_costs") or [1] * len(dimensions)
+        return costs[dimensions.index(dimension)] if dimension in dimensions else 1
+            
+    async def _promote_due(self) -> int | None:
+        """
+        Admit the deferred tasks that are due. A task that can not be decoded or admitted is dropped,
+        and when an admission fails otherwise, e.g. on a Redis error, the tasks not admitted yet are
+        deferred again for a retry, rather than lost with the failed pass.
+
+        Returns:
+            int | None: The eligible-at time in ms of the next deferred task, if any.
+        """
+        due, next_due = await self.delayed_queue.pop_due(int(time.time() * 1000), self.redispatch_batch_size)
+        for i, raw in enumerate(due):
+            try:
+                task_name, task_data, task_metadata = self._decode_dispatch_args(raw)
+                await self._admit(task_name, task_data, task_metadata, source="promote")
+            except (TypeError, ValueError):
+                # Could never be admitted, retrying would only come back to the same error
+                logger.exception("Dropped a deferred task that can not be admitted.")
+            except Exception:
+                await self._retry_later(due[i:])
+                raise
+        if len(due) == self.redispatch_batch_size:
+            # More tasks may be due already
+            return 0
+        return next_due
+            
+    async def _retry_later(self, entries: list[bytes]):
+        """
+        Defer queue entries whose admission failed, so that they are promoted again after the backoff.
+        """
+        retry_at = int((time.time() + LOOP_ERROR_BACKOFF) * 1000)
+        await self.delayed_queue.defer_many([(entry, retry_at) for entry in entries])
             
-    def _encode_dispatch_args(self, task_name: str, task_data: dict, task_metadata: dict):
+    def _encode_dispatch_args(self, task_name: str, task_data: dict | EncodedPayload, task_metadata: dict) -> bytes:
         """
-        Encode the dispatch arguments to a JSON-like format.
+        Encode the dispatch arguments to a queue entry: the size of the header, the header with the
+        task name and metadata, then the payload. The payload is encoded once and never decoded by
+        the dispatcher, only the header is needed for scheduling.
         """
-        return json.dumps({
+        header = self.codec.encode({
             "task_name": task_name,
-            "task_data": task_data,
             "task_metadata": task_metadata,
         })
+        return len(header).to_bytes(ENTRY_HEADER_SIZE_BYTES, "big") + header + self.codec.encode_payload(task_data).data
         
-    def _decode_dispatch_args(self, dispatch_args: str):
+    def _decode_dispatch_args(self, dispatch_args: bytes) -> tuple[str, EncodedPayload, dict]:
         """
-        Decode the dispatch arguments from a JSON-like format.
+        Decode the header of a queue entry, keeping the payload encoded.
         """
-        decoded_args = json.loads(dispatch_args)
-        return decoded_args.get("task_name"), decoded_args.get("task_data"), decoded_args.get("task_metadata")
+        header_end = ENTRY_HEADER_SIZE_BYTES + int.from_bytes(dispatch_args[:ENTRY_HEADER_SIZE_BYTES], "big")
+        header = self.codec.decode(dispatch_args[ENTRY_HEADER_SIZE_BYTES:header_end])
+        return header.get("task_name"), EncodedPayload(dispatch_args[header_end:]), header.get("task_metadata")
     
-    async def increase_concurrency(self, dimensions: list):
+    async def increase_concurrency(self, dimensions: list, job_id: str, ttl: float = None, costs: list = None):
         """
-        Increase the concurrency for the specified dimensions.
+        Increase the concurrency for the specified dimensions, with a lease held by the job.
         """
-        
-        for dimension in dimensions:
-            await self.redis_client.incrby(f"dispatcher:concurrency:{dimension}")
+        await self.leases.renew(job_id, dimensions, ttl or self.lease_ttl, costs)
             
-    async def decrease_concurrency(self, dimensions: list):
+    async def decrease_concurrency(self, dimensions: list, job_id: str, quota: dict = None):
+        """
+        Decrease the concurrency for the specified dimensions, releasing the leases of the job.
+
+        The dimensions admitted from the quota blocks of a replica, given by the `_quota` metadata
+        of the job, hold no lease: the job is pushed to the release list of that replica instead.
+        """
+        quota_dimensions = quota["dimensions"] if quota else []
+        await self.admission.release(job_id, [dimension for dimension in dimensions if dimension not in quota_dimensions])
+        if quota:
+            await self.quota.release(quota["replica"], job_id)
+    
+    async def record_completion(self, dimensions: list, latency: float, success: bool):
+        """
+        Feed the outcome of a completed job to the throttling policy, for each of its dimensions.
+        """
+        if self.throttling_policy:
+            for dimension in dimensions:
+                await self.throttling_policy.record_completion(dimension, latency, success)
+    
+    async def get_reclaimed_leases(self) -> dict[str, int]:
+        """
+        Return the number of slot leases reclaimed after expiry, per dimension.
         """
-        Decrease the concurrency for the specified dimensions.
+        return await self.leases.reclaimed()
+    
+    async def collect_metrics(self):
         """
+        Sample the occupancy of the dimensions and the backlog of the queues into the metrics gauges.
+
+        The dimensions are the ones that have held a slot. Called on each scrape of the metrics.
+        """
+        if self.metrics is None:
+            return
+        dimensions = await self.leases.dimensions()
+        self.metrics.dimension_usage.clear()
+        self.metrics.dimension_limit.clear()
+        for dimension, usage in (await self.leases.occupancy(dimensions)).items():
+            self.metrics.dimension_usage.set(usage, dimension=dimension)
+            limit = self.throttling_policy.get_limit(dimension) if self.throttling_policy else None
+            if limit is not None:
+                self.metrics.dimension_limit.set(limit, dimension=dimension)
         
-        for dimension in dimensions:
-            # Check whether the dimension exists or value is greater than 0
-            current_value = await self.redis_client.get(f"dispatcher:concurrency:{dimension}")
-            if current_value is None:
-                continue
-            elif int(current_value) <= 0:
-                await self.redis_client.delete(f"dispatcher:concurrency:{dimension}")
-            else:
-                await self.redis_client.decrby(f"dispatcher:concurrency:{dimension}")
\ No newline at end of file
+        waiting = {}
+        oldest = {}
+        now = time.time()
+        for dimension, priority, length, head in await self.admission.wait_list_heads(dimensions):
+            waiting[dimension, priority] = waiting.get((dimension, priority), 0) + length
+            if head is not None:
+                submitted_at = self._decode_dispatch_args(head)[2].get("_submitted_at")
+                if submitted_at:
+                    oldest[dimension] = max(oldest.get(dimension, 0), now - submitted_at)
+        self.metrics.waiting_tasks.clear()
+        for (dimension, priority), length in waiting.items():
+            self.metrics.waiting_tasks.set(length, dimension=dimension, priority=priority)
+        self.metrics.oldest_waiting_age.clear()
+        for dimension, age in oldest.items():
+            self.metrics.oldest_waiting_age.set(age, dimension=dimension)
+        self.metrics.estimated_wait.clear()
+        for dimension in self.backpressure.rates:
+            estimated_wait = self.backpressure.estimated_wait(dimension)
+            if estimated_wait is not None:
+                self.metrics.estimated_wait.set(estimated_wait, dimension=dimension)
+        self.metrics.quota_units.clear()
+        for dimension, units in self.quota.granted.items():
+            self.metrics.quota_units.set(units, dimension=dimension)
+        self.metrics.delayed_tasks.set(await self.delayed_queue.size())
+        self.metrics.inflight_jobs.set(await self.redis_client.scard(self.inflight_key))
@@ -0,0 +1,157 @@
+import time
+from typing import NamedTuple
+
+from redis import Redis
+
+# The backlog of a dimension is the number of tasks parked in its wait lists.
+# The admission script counts a task when it parks it and the pop script when
+# it takes it out, along with the total across the dimensions. The drain rate
+# of a dimension is sampled from the number of jobs that gave back their slot
+# on it, counted by the release script.
+BACKLOG_KEY = "dispatcher:backlog"
+BACKLOG_TOTAL_KEY = "dispatcher:backlog:total"
+BACKLOG_DRAINED_KEY = "dispatcher:backlog:drained"
+
+# Reasons for shedding a submission, returned by the admission script
+SHED_DIMENSION_BACKLOG = 0
+SHED_TOTAL_BACKLOG = 1
+SHED_RATE_WAIT = 2
+
+
+class Overloaded(Exception):
+    """
+    Raised when a submission is shed because the backlog it would join is over its limit.
+    """
+    def __init__(self, message: str, retry_after: float, dimension: str | None = None):
+        super().__init__(message)
+        # Estimated time in seconds until the submission would be accepted
+        self.retry_after = retry_after
+        self.dimension = dimension
+
+
+class BackpressureConfig(NamedTuple):
+    """
+    Backlog limits of the submissions of a dispatcher, see Backpressure.
+    """
+    # Maximum number of tasks waiting on a dimension, for every dimension or by dimension name or type, None for no limit
+    max_backlog: int | dict | None = None
+    # Maximum number of tasks waiting or deferred by a rate limit, None for no limit
+    max_total_backlog: int | None = None
+    # Maximum estimated wait in seconds of a submission, None for no limit
+    max_wait: float | None = None
+    # Interval in seconds for sampling the backlog and the drain rate of the dimensions
+    sample_interval: float = 1.0
+
+
+class Backpressure:
+    """
+    Limits on the backlog the submissions may join, per dimension and in total, with the estimated
+    wait of each dimension derived from its backlog and its recent drain rate.
+
+    The limits are enforced by the admission script, atomically with the decision to park a task,
+    and only for new submissions: the tasks already waiting are never shed.
+    """
+    def __init__(self, redis_client: Redis, max_backlog: int | dict = None, max_total_backlog: int = None, max_wait: float = None, smoothing: float = 0.2, fallback_retry_after: float = 5.0, min_rate: float = 0.01, max_retry_after: float = 300.0):
+        """
+        Args:
+            redis_client (Redis): The Redis client instance.
+            max_backlog (int | dict): The maximum number of tasks waiting on a dimension, either one for every dimension or a map
+                keyed by dimension name or dimension type (e.g. `account`), None for no limit.
+            max_total_backlog (int): The maximum number of tasks waiting on any dimension or deferred by a rate limit, None for no limit.
+            max_wait (float): The maximum estimated wait in seconds of a new submission, None for no limit.
+            smoothing (float): The weight of the latest sample in the moving average of the drain rates.
+            fallback_retry_after (float): The retry delay in seconds of a shed submission when the drain rate is unknown.
+            min_rate (float): The drain rate in jobs per second below which the rate of a dimension is unknown, e.g. while
+                long jobs hold all of its slots, rather than estimating waits from a moving average decaying to 0.
+            max_retry_after (float): The longest retry delay in seconds of a shed submission.
+        """
+        self.redis_client = redis_client
+        self.max_backlog = max_backlog
+        self.max_total_backlog = max_total_backlog
+        self.max_wait = max_wait
+        self.smoothing = smoothing
+        self.fallback_retry_after = fallback_retry_after
+        self.min_rate = min_rate
+        self.max_retry_after = max_retry_after
+        # Jobs drained per second and tasks waiting, by dimension, as of the last sample
+        self.rates: dict[str, float] = {}
+        self.backlog: dict[str, int] = {}
+        self._drained: dict[str, int] = {}
+        self._sampled_at: float | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_backlog is not None or self.max_total_backlog is not None or self.max_wait is not None
+
+    async def sample(self):
+        """
+        Update the drain rate and the backlog of every dimension from the counters in Redis.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(BACKLOG_DRAINED_KEY)
+            pipe.hgetall(BACKLOG_KEY)
+            drained, backlog = await pipe.execute()
+        now = time.monotonic()
+        drained = {dimension.decode(): int(count) for dimension, count in drained.items()}
+        if self._sampled_at is not None and now > self._sampled_at:
+            elapsed = now - self._sampled_at
+            for dimension, count in drained.items():
+                rate = (count - self._drained.get(dimension, 0)) / elapsed
+                previous = self.rates.get(dimension)
+                self.rates[dimension] = rate if previous is None else previous + self.smoothing * (rate - previous)
+        self._drained = drained
+        self._sampled_at = now
+        self.backlog = {dimension.decode(): int(count) for dimension, count in backlog.items()}
+
+    def drain_rate(self, dimension: str) -> float | None:
+        """
+        Return the recent drain rate of the dimension in jobs per second, None if it is unknown or below the minimum rate.
+        """
+        rate = self.rates.get(dimension)
+        if rate is None or rate < self.min_rate:
+            return None
+        return rate
+
+    def backlog_cap(self, dimension: str) -> int | None:
+        """
+        Return the number of waiting tasks past which new submissions blocked on the dimension are shed,
+        the lowest of its maximum backlog and of the backlog drained within the maximum wait.
+        """
+        cap = self.max_backlog
+        if isinstance(cap, dict):
+            cap = cap.get(dimension, cap.get(dimension.split(":", 1)[0]))
+        rate = self.drain_rate(dimension)
+        if self.max_wait is not None and rate:
+            # The wait is only estimated while the dimension drains, and a task may always join an empty backlog
+            wait_cap = max(int(self.max_wait * rate), 1)
+            cap = wait_cap if cap is None else min(cap, wait_cap)
+        return cap
+
+    def estimated_wait(self, dimension: str) -> float | None:
+        """
+        Return the estimated wait in seconds of a task joining the backlog of the dimension, None if it never drained.
+        """
+        rate = self.drain_rate(dimension)
+        if not rate:
+            return None
+        return self.backlog.get(dimension, 0) / rate
+
+    def retry_after(self, reason: int, dimension: str, excess: int) -> float:
+        """
+        Return the estimated time in seconds until a shed submission would be accepted, at most the maximum retry delay.
+
+        Args:
+            reason (int): The reason for shedding the submission.
+            dimension (str): The dimension that blocked the submission.
+            excess (int): The number of tasks over the backlog limit, or the time in ms over the maximum wait for a rate limit token.
+        """
+        if reason == SHED_RATE_WAIT:
+            # The time of the next rate limit token is known exactly
+            return min(excess / 1000, self.max_retry_after)
+        if reason == SHED_TOTAL_BACKLOG:
+            rate = sum(rate for rate in map(self.drain_rate, self.rates) if rate)
+        else:
+            rate = self.drain_rate(dimension)
+        if not rate:
+            return self.fallback_retry_after
+        return min(excess / rate, self.max_retry_after)
@@ -0,0 +1,182 @@
+import hashlib
+import json
+from typing import Any, NamedTuple
+
+from redis import Redis
+
+from .codec import Codec
+from .partitions import SCRIPT_HELPERS_LUA
+
+# Identical submissions of an idempotent task, same task name and same
+# payload, share one job. The first one owns the coalescing key while its job
+# is queued or running, the others attach to it and take no slot. Once the
+# job succeeds its result is cached for the TTL of the task, and identical
+# submissions are answered from the cache. The cache is a single hash with the
+# expiry of each entry in a sorted set, and a byte budget enforced by evicting
+# the entries closest to expiry first.
+COALESCE_INFLIGHT_KEY_PREFIX = "coalesce:inflight:"
+COALESCE_RESULTS_KEY = "coalesce:results"
+COALESCE_EXPIRY_KEY = "coalesce:expiry"
+COALESCE_SIZE_KEY = "coalesce:size"
+
+# KEYS[1]  cached results, by coalescing key
+# KEYS[2]  expiry of the cached results in ms
+# KEYS[3]  owner of the coalescing key
+# ARGV[1]  coalescing key
+# ARGV[2]  task id
+# ARGV[3]  ownership duration in ms, until the job completes
+#
+# Returns {0, task id} when the task owns the key, {1, owner task id} when it
+# attaches to the job of the owner and {2, cached entry} when the result is cached.
+CLAIM_SCRIPT = SCRIPT_HELPERS_LUA + """
+local expires_at = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if expires_at and tonumber(expires_at) > now_ms() then
+    local entry = redis.call('HGET', KEYS[1], ARGV[1])
+    if entry then
+        return {2, entry}
+    end
+end
+local owner = redis.call('GET', KEYS[3])
+if owner then
+    return {1, owner}
+end
+redis.call('SET', KEYS[3], ARGV[2], 'PX', ARGV[3])
+return {0, ARGV[2]}
+"""
+
+# Give up the ownership of the key and cache the result of the job, dropping
+# the expired entries, then the ones closest to expiry while over budget.
+#
+# KEYS[1]  cached results
+# KEYS[2]  expiry of the cached results in ms
+# KEYS[3]  total size of the cached results in bytes
+# KEYS[4]  owner of the coalescing key
+# ARGV[1]  coalescing key
+# ARGV[2]  task id of the owner
+# ARGV[3]  cache entry, empty to only give up the ownership
+# ARGV[4]  cache TTL in ms
+# ARGV[5]  cache budget in bytes
+COMPLETE_SCRIPT = SCRIPT_HELPERS_LUA + """
+local function drop(field)
+    local size = redis.call('HSTRLEN', KEYS[1], field)
+    redis.call('HDEL', KEYS[1], field)
+    redis.call('ZREM', KEYS[2], field)
+    redis.call('DECRBY', KEYS[3], size)
+end
+
+if redis.call('GET', KEYS[4]) == ARGV[2] then
+    redis.call('DEL', KEYS[4])
+end
+local now = now_ms()
+for _, field in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, 100)) do
+    drop(field)
+end
+if ARGV[3] == '' then
+    return 0
+end
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    drop(ARGV[1])
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[4]), ARGV[1])
+redis.call('INCRBY', KEYS[3], #ARGV[3])
+local budget = tonumber(ARGV[5])
+while tonumber(redis.call('GET', KEYS[3]) or 0) > budget do
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)
+    if #oldest == 0 then
+        break
+    end
+    drop(oldest[1])
+end
+return 1
+"""
+
+# Outcomes of a claim
+OWNER = 0
+ATTACHED = 1
+CACHED = 2
+
+
+class Claim(NamedTuple):
+    """
+    Outcome of the claim of a coalescing key by a submission.
+    """
+    outcome: int
+    # The task the submission is answered with, its own if it owns the key
+    task_id: str
+    # The cached result of that task, if any
+    result: Any = None
+
+
+def coalescing_key(task_name: str, payload: dict) -> str:
+    """
+    Return the coalescing key of a task, a hash of its name and its canonical payload.
+    """
+    canonical = json.dumps([task_name, payload], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class TaskCoalescer:
+    """
+    Coalescing of the identical submissions of idempotent tasks, and cache of their results.
+    """
+    def __init__(self, redis_client: Redis, codec: Codec, inflight_ttl: float = 3600.0, max_cache_bytes: int = 64 * 1024 * 1024):
+        """
+        Initialize the coalescer and register its scripts.
+
+        Args:
+            redis_client (Redis): The Redis client instance the scripts are registered on.
+            codec (Codec): The codec of the cached results.
+            inflight_ttl (float): The maximum time in seconds a job owns its coalescing key, in case its completion is never collected.
+            max_cache_bytes (int): The budget of the result cache in bytes.
+        """
+        self.redis_client = redis_client
+        self.codec = codec
+        self.inflight_ttl = inflight_ttl
+        self.max_cache_bytes = max_cache_bytes
+        self._claim_script = redis_client.register_script(CLAIM_SCRIPT)
+        self._complete_script = redis_client.register_script(COMPLETE_SCRIPT)
+
+    async def claim_many(self, claims: list[tuple[str, str]]) -> list[Claim]:
+        """
+        Claim the coalescing keys of a batch of submissions in one pipelined round trip.
+
+        Args:
+            claims (list[tuple[str, str]]): The coalescing key and the task ID of each submission.
+
+        Returns:
+            list[Claim]: The outcome of each claim, in order.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for key, task_id in claims:
+                await self._claim_script(
+                    keys=[COALESCE_RESULTS_KEY, COALESCE_EXPIRY_KEY, COALESCE_INFLIGHT_KEY_PREFIX + key],
+                    args=[key, task_id, int(self.inflight_ttl * 1000)],
+                    client=pipe,
+                )
+            replies = await pipe.execute()
+        results = []
+        for outcome, value in replies:
+            if outcome == CACHED:
+                entry = self.codec.decode(value)
+                results.append(Claim(CACHED, entry["task_id"], entry["result"]))
+            else:
+                results.append(Claim(outcome, value.decode() if isinstance(value, bytes) else value))
+        return results
+
+    async def claim(self, key: str, task_id: str) -> Claim:
+        """
+        Claim a coalescing key for a submission: own it, attach to the job owning it, or get the cached result.
+        """
+        return (await self.claim_many([(key, task_id)]))[0]
+
+    async def complete(self, key: str, task_id: str, result: Any = None, ttl: float = 0):
+        """
+        Give up the coalescing key owned by a task once its job completed, caching its result for ttl seconds.
+        With no ttl, e.g. for a failed job, nothing is cached and the next identical submission runs again.
+        """
+        entry = self.codec.encode({"task_id": task_id, "result": result}) if ttl > 0 else b""
+        await self._complete_script(
+            keys=[COALESCE_RESULTS_KEY, COALESCE_EXPIRY_KEY, COALESCE_SIZE_KEY, COALESCE_INFLIGHT_KEY_PREFIX + key],
+            args=[key, task_id, entry, int(ttl * 1000), self.max_cache_bytes],
+        )
@@ -0,0 +1,174 @@
+import json
+import re
+from abc import ABC, abstractmethod
+from typing import Any
+from uuid import uuid4
+
+# msgpack extension type of the payloads embedded already encoded
+PAYLOAD_EXT_TYPE = 1
+
+
+class EncodedPayload:
+    """
+    Task payload already encoded by the codec, embedded as is in the messages encoded with the same codec.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+
+# Stand-in for the payload of a message encoded around it, see Codec.encode_split.
+# A JSON string, so that the JSON codecs embed it as is
+PAYLOAD_SLOT = EncodedPayload(b'"\\u0000payload-slot\\u0000"')
+
+
+class Codec(ABC):
+    """
+    Serialization of the dispatcher queue entries and of the arq jobs and results.
+
+    The API and the workers must use the same codec, through `job_serializer` and `job_deserializer`.
+    """
+    @abstractmethod
+    def encode(self, obj: Any) -> bytes:
+        """Encode a message, embedding its EncodedPayload values without decoding them if the format allows it."""
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes) -> Any:
+        """Decode a message, including the payloads embedded in it."""
+        pass
+
+    def encode_split(self, obj: Any, payload_size: int) -> tuple[bytes, bytes]:
+        """
+        Encode a message holding PAYLOAD_SLOT in place of its payload, split around it: the message with the
+        payload is the prefix, the encoded payload of payload_size bytes and the suffix, put together without
+        encoding the payload again.
+        """
+        prefix, slot, suffix = self.encode(obj).partition(PAYLOAD_SLOT.data)
+        if not slot:
+            raise ValueError("The message holds no payload slot")
+        return prefix, suffix
+
+    def encode_payload(self, payload: Any) -> EncodedPayload:
+        """Encode a task payload once, to be embedded in the queue entries and the arq job."""
+        if isinstance(payload, EncodedPayload):
+            return payload
+        return EncodedPayload(self.encode(payload))
+
+    def _encode_default(self, obj: Any) -> Any:
+        if isinstance(obj, BaseException):
+            # Failed job results hold the exception, kept as its description
+            return f"{type(obj).__name__}: {obj}"
+        raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+class JsonCodec(Codec):
+    """
+    Standard library JSON codec, with no dependency. Embedded payloads are encoded as placeholder
+    strings, then spliced in the encoded message as is.
+    """
+    def __init__(self):
+        # Unique to the codec, so that no string of the message is taken for a placeholder
+        self._placeholder = f"\u0000payload-{uuid4().hex}-"
+        self._placeholder_pattern = re.compile(re.escape(json.dumps(self._placeholder)[:-1].encode()) + rb'(\d+)"')
+
+    def encode(self, obj: Any) -> bytes:
+        payloads = []
+
+        def _default(value: Any) -> Any:
+            if isinstance(value, EncodedPayload):
+                payloads.append(value.data)
+                return f"{self._placeholder}{len(payloads) - 1}"
+            return self._encode_default(value)
+
+        data = json.dumps(obj, default=_default, separators=(",", ":")).encode()
+        if payloads:
+            data = self._placeholder_pattern.sub(lambda match: payloads[int(match.group(1))], data)
+        return data
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    msgpack codec, embedding the payloads as an extension type.
+    """
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, obj: Any) -> bytes:
+        return self._msgpack.packb(obj, default=self._encode_default, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Any:
+        return self._msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False, strict_map_key=False)
+
+    def encode_split(self, obj: Any, payload_size: int) -> tuple[bytes, bytes]:
+        prefix, suffix = super().encode_split(obj, payload_size)
+        # The extension header ahead of the slot holds the size of the slot, not of the payload
+        return prefix[:-len(self._ext_header(len(PAYLOAD_SLOT.data)))] + self._ext_header(payload_size), suffix
+
+    def _ext_header(self, size: int) -> bytes:
+        fixext = {1: b"\xd4", 2: b"\xd5", 4: b"\xd6", 8: b"\xd7", 16: b"\xd8"}
+        if size in fixext:
+            header = fixext[size]
+        elif size < 1 << 8:
+            header = b"\xc7" + size.to_bytes(1, "big")
+        elif size < 1 << 16:
+            header = b"\xc8" + size.to_bytes(2, "big")
+        else:
+            header = b"\xc9" + size.to_bytes(4, "big")
+        return header + PAYLOAD_EXT_TYPE.to_bytes(1, "big")
+
+    def _encode_default(self, obj: Any) -> Any:
+        if isinstance(obj, EncodedPayload):
+            return self._msgpack.ExtType(PAYLOAD_EXT_TYPE, obj.data)
+        return super()._encode_default(obj)
+
+    def _ext_hook(self, code: int, data: bytes) -> Any:
+        if code == PAYLOAD_EXT_TYPE:
+            return self.decode(data)
+        return self._msgpack.ExtType(code, data)
+
+
+class OrjsonCodec(Codec):
+    """
+    orjson codec, embedding the payloads as JSON fragments.
+    """
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, obj: Any) -> bytes:
+        return self._orjson.dumps(obj, default=self._encode_default)
+
+    def decode(self, data: bytes) -> Any:
+        return self._orjson.loads(data)
+
+    def _encode_default(self, obj: Any) -> Any:
+        if isinstance(obj, EncodedPayload):
+            return self._orjson.Fragment(obj.data)
+        return super()._encode_default(obj)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "msgpack": MsgpackCodec,
+    "orjson": OrjsonCodec,
+}
+
+
+def get_codec(name: str) -> Codec:
+    """
+    Return the codec with the given name, one of json, msgpack (requires msgpack) or orjson (requires orjson).
+    """
+    try:
+        codec_cls = CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec {name!r}, expected one of {list(CODECS)}")
+    try:
+        return codec_cls()
+    except ImportError as e:
+        raise ImportError(f"The {name} codec requires the {name} package, install it with `pip install {name}`") from e
@@ -0,0 +1,105 @@
+from redis import Redis
+
+# Schedule a deferred task and wake up the promoters when it becomes the
+# earliest one, so that they can shorten their wait.
+#
+# KEYS[1]  delayed sorted set, scored by eligible-at time in ms
+# KEYS[2]  wakeup list
+# ARGV[1]  eligible-at time in ms
+# ARGV[2]  encoded dispatch args
+DEFER_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+local first = redis.call('ZRANGE', KEYS[1], 0, 0)
+if first[1] == ARGV[2] then
+    redis.call('LPUSH', KEYS[2], 1)
+    redis.call('LTRIM', KEYS[2], 0, 0)
+end
+return 1
+"""
+
+# Move the due tasks out of the sorted set, so a task is promoted by exactly
+# one dispatcher, and return the eligible-at time of the next one.
+#
+# KEYS[1]  delayed sorted set
+# ARGV[1]  current time in ms
+# ARGV[2]  maximum number of tasks to promote
+#
+# Returns {next eligible-at time in ms or -1, task...}
+POP_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+local next_due = -1
+local first = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if first[2] then
+    next_due = tonumber(first[2])
+end
+table.insert(due, 1, next_due)
+return due
+"""
+
+
+class DelayedQueue:
+    """
+    Sorted set of deferred tasks scored by the time they become eligible for dispatch.
+    """
+    def __init__(self, redis_client: Redis, queue_key: str):
+        """
+        Initialize the delayed queue and register its scripts.
+
+        Args:
+            redis_client (Redis): The Redis client instance the scripts are registered on.
+            queue_key (str): The key prefix for the dispatcher queues in Redis.
+        """
+        self.redis_client = redis_client
+        self.delayed_key = f"{queue_key}:delayed"
+        self.wakeup_key = f"{queue_key}:delayed:wakeup"
+        self._defer_script = redis_client.register_script(DEFER_SCRIPT)
+        self._pop_due_script = redis_client.register_script(POP_DUE_SCRIPT)
+
+    async def defer(self, entry: str, eligible_at_ms: int):
+        """
+        Schedule the encoded task to be promoted at the eligible-at time.
+        """
+        await self._defer_script(keys=[self.delayed_key, self.wakeup_key], args=[eligible_at_ms, entry])
+
+    async def defer_many(self, entries: list[tuple[str, int]]):
+        """
+        Schedule a batch of encoded tasks with their eligible-at times in ms, in one pipelined round trip.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for entry, eligible_at_ms in entries:
+                await self._defer_script(keys=[self.delayed_key, self.wakeup_key], args=[eligible_at_ms, entry], client=pipe)
+            await pipe.execute()
+
+    async def pop_due(self, now_ms: int, count: int) -> tuple[list[bytes], int | None]:
+        """
+        Pop up to count tasks that are due.
+
+        Returns:
+            tuple[list[bytes], int | None]: The due tasks and the eligible-at time in ms of the next one, if any.
+        """
+        next_due, *due = await self._pop_due_script(keys=[self.delayed_key], args=[now_ms, count])
+        return due, None if next_due < 0 else next_due
+
+    async def size(self) -> int:
+        """
+        Return the number of deferred tasks.
+        """
+        return await self.redis_client.zcard(self.delayed_key)
+
+    async def wake(self):
+        """
+        Wake up the promoters waiting for an earlier task, e.g. for the dispatcher to stop.
+        """
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.lpush(self.wakeup_key, 1)
+            pipe.ltrim(self.wakeup_key, 0, 0)
+            await pipe.execute()
+
+    async def wait_for_earlier(self, timeout: float):
+        """
+        Block until an earlier task is scheduled, or until the timeout expires.
+        """
+        await self.redis_client.blpop([self.wakeup_key], timeout=timeout)
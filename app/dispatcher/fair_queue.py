@@ -0,0 +1,62 @@
+class DeficitRoundRobin:
+    """
+    Deficit round robin over the tenants waiting on a dimension.
+
+    Each turn grants the tenant at the head of the ring a quantum scaled by its weight, and the
+    tenant is served until its deficit is spent. A turn interrupted because the dimension is full
+    again resumes on the next pass, so every tenant gets its share of the released capacity
+    whatever the backlog of the others.
+    """
+    def __init__(self, weights: dict[str, float], quantum: float = 1.0):
+        """
+        Args:
+            weights (dict[str, float]): The weight of each tenant, 1 for the tenants not listed.
+            quantum (float): The capacity units granted to a tenant of weight 1 per turn.
+        """
+        self.weights = weights
+        self.quantum = quantum
+        self.ring: list[str] = []
+        self.deficits: dict[str, float] = {}
+        self._granted = False
+
+    def sync(self, tenants: list[str]):
+        """
+        Add the newly waiting tenants at the tail of the ring, and drop the ones no longer waiting.
+        """
+        waiting = set(tenants)
+        for tenant in [tenant for tenant in self.ring if tenant not in waiting]:
+            self.drop(tenant)
+        for tenant in sorted(waiting.difference(self.ring)):
+            self.ring.append(tenant)
+            self.deficits[tenant] = 0.0
+
+    def next_tenant(self) -> str | None:
+        """
+        Return the tenant to serve next, or None if no tenant is waiting.
+        """
+        while self.ring:
+            tenant = self.ring[0]
+            if not self._granted:
+                self.deficits[tenant] += self.quantum * self.weights.get(tenant, 1.0)
+                self._granted = True
+            if self.deficits[tenant] > 0:
+                return tenant
+            # The turn of the tenant is over, move on to the next one
+            self.ring.append(self.ring.pop(0))
+            self._granted = False
+        return None
+
+    def charge(self, tenant: str, cost: float):
+        """
+        Spend the cost of a served task from the deficit of the tenant.
+        """
+        self.deficits[tenant] -= cost
+
+    def drop(self, tenant: str):
+        """
+        Remove a tenant whose queue is drained, its unspent deficit is not kept.
+        """
+        if self.ring and self.ring[0] == tenant:
+            self._granted = False
+        self.ring.remove(tenant)
+        self.deficits.pop(tenant, None)
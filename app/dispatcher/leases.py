@@ -0,0 +1,156 @@
+from redis import Redis
+
+from .partitions import SCRIPT_HELPERS_LUA, PartitionedQueue
+
+# A concurrency slot is a lease held by a job on a dimension, stored as a
+# member of a sorted set scored by the lease deadline in ms. A lease weighs
+# the cost of its task, kept in a hash per dimension, and the usage of a
+# dimension is the total cost of its leases. The slot of a job that never
+# reports its completion (worker killed, result expired) comes back once its
+# lease expires and is reclaimed.
+LEASE_KEY_PREFIX = "dispatcher:lease:"
+LEASE_COST_KEY_PREFIX = "dispatcher:lease-cost:"
+LEASE_USAGE_KEY = "dispatcher:lease-usage"
+LEASE_DIMENSIONS_KEY = "dispatcher:lease-dimensions"
+LEASE_RECLAIMED_KEY = "dispatcher:lease-reclaimed"
+
+# Drop the expired leases of every dimension, count them as reclaimed, give
+# their cost back and wake the tasks waiting on the dimensions that got
+# capacity back.
+#
+# KEYS[1]              reclaimed counters
+# KEYS[2]              usage per dimension
+# KEYS[3..2+n]         lease sets, one per dimension
+# KEYS[3+n..2+2n]      lease costs, one per dimension
+# KEYS[3+2n..2+5n]     wake keys of the dimensions, see PartitionedQueue.wake_keys
+# ARGV[1..n]           dimension names
+RECLAIM_SCRIPT = SCRIPT_HELPERS_LUA + """
+local n = #ARGV
+local now = now_ms()
+local base = 2 + 2 * n
+local total = 0
+for i = 1, n do
+    local expired = redis.call('ZRANGEBYSCORE', KEYS[2 + i], '-inf', now)
+    if #expired > 0 then
+        local cost = 0
+        for _, job_id in ipairs(expired) do
+            cost = cost + tonumber(redis.call('HGET', KEYS[2 + n + i], job_id) or 1)
+        end
+        redis.call('ZREM', KEYS[2 + i], unpack(expired))
+        redis.call('HDEL', KEYS[2 + n + i], unpack(expired))
+        redis.call('HINCRBY', KEYS[2], ARGV[i], -cost)
+        redis.call('HINCRBY', KEYS[1], ARGV[i], #expired)
+        wake(ARGV[i], KEYS[base + 3 * i - 2], KEYS[base + 3 * i - 1], KEYS[base + 3 * i])
+        total = total + #expired
+    end
+end
+return total
+"""
+
+# Extend the leases of a job, re-creating them if they were reclaimed meanwhile
+# so that a running job is always counted.
+#
+# KEYS[1]          leased dimensions index
+# KEYS[2]          usage per dimension
+# KEYS[3..2+n]     lease sets, one per dimension
+# KEYS[3+n..2+2n]  lease costs, one per dimension
+# ARGV[1]          job id
+# ARGV[2]          lease duration in ms
+# ARGV[3..2+n]     costs, one per dimension
+# ARGV[3+n..2+2n]  dimension names
+RENEW_SCRIPT = SCRIPT_HELPERS_LUA + """
+local n = (#KEYS - 2) / 2
+local deadline = now_ms() + tonumber(ARGV[2])
+for i = 1, n do
+    if redis.call('ZADD', KEYS[2 + i], deadline, ARGV[1]) == 1 then
+        redis.call('HSET', KEYS[2 + n + i], ARGV[1], ARGV[2 + i])
+        redis.call('HINCRBY', KEYS[2], ARGV[2 + n + i], ARGV[2 + i])
+    end
+    redis.call('SADD', KEYS[1], ARGV[2 + n + i])
+end
+return deadline
+"""
+
+
+def lease_key(dimension: str) -> str:
+    """
+    Return the key of the lease set for the dimension.
+    """
+    return LEASE_KEY_PREFIX + dimension
+
+
+def lease_cost_key(dimension: str) -> str:
+    """
+    Return the key of the lease costs for the dimension, by job ID.
+    """
+    return LEASE_COST_KEY_PREFIX + dimension
+
+
+class SlotLeases:
+    """
+    Renewal, reclaiming and accounting of the concurrency slot leases.
+    """
+    def __init__(self, redis_client: Redis):
+        """
+        Initialize the lease manager and register its scripts.
+
+        Args:
+            redis_client (Redis): The Redis client instance the scripts are registered on.
+        """
+        self.redis_client = redis_client
+        self._renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self._reclaim_script = redis_client.register_script(RECLAIM_SCRIPT)
+
+    async def renew(self, job_id: str, dimensions: list, ttl: float, costs: list | None = None):
+        """
+        Extend the leases of a job for ttl seconds from now. The costs, one per dimension and
+        1 by default, are only used when a lease has to be re-created.
+        """
+        if dimensions:
+            costs = costs or [1] * len(dimensions)
+            keys = [
+                LEASE_DIMENSIONS_KEY,
+                LEASE_USAGE_KEY,
+                *(lease_key(dimension) for dimension in dimensions),
+                *(lease_cost_key(dimension) for dimension in dimensions),
+            ]
+            await self._renew_script(keys=keys, args=[job_id, int(ttl * 1000), *costs, *dimensions])
+
+    async def reclaim(self, queue: PartitionedQueue) -> int:
+        """
+        Reclaim the expired leases of every dimension, waking the tasks waiting on them in the queue.
+
+        Returns:
+            int: The number of reclaimed leases.
+        """
+        dimensions = await self.dimensions()
+        if not dimensions:
+            return 0
+        keys = [
+            LEASE_RECLAIMED_KEY,
+            LEASE_USAGE_KEY,
+            *(lease_key(dimension) for dimension in dimensions),
+            *(lease_cost_key(dimension) for dimension in dimensions),
+            *queue.wake_keys(dimensions),
+        ]
+        return await self._reclaim_script(keys=keys, args=dimensions)
+
+    async def dimensions(self) -> list[str]:
+        """
+        Return the dimensions that have held a slot.
+        """
+        return [dimension.decode() for dimension in await self.redis_client.smembers(LEASE_DIMENSIONS_KEY)]
+
+    async def occupancy(self, dimensions: list) -> dict[str, int]:
+        """
+        Return the usage of each dimension, the total cost of its leases.
+        """
+        usages = await self.redis_client.hmget(LEASE_USAGE_KEY, dimensions) if dimensions else []
+        return {dimension: int(usage or 0) for dimension, usage in zip(dimensions, usages)}
+
+    async def reclaimed(self) -> dict[str, int]:
+        """
+        Return the number of leases reclaimed after expiry, per dimension.
+        """
+        counters = await self.redis_client.hgetall(LEASE_RECLAIMED_KEY)
+        return {dimension.decode(): int(count) for dimension, count in counters.items()}
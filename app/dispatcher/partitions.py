@@ -0,0 +1,200 @@
+import zlib
+from typing import NamedTuple
+from uuid import uuid4
+
+from redis import Redis
+
+# Lua helpers shared by the dispatcher scripts.
+SCRIPT_HELPERS_LUA = """
+local function now_us()
+    local time = redis.call('TIME')
+    return tonumber(time[1]) * 1000000 + tonumber(time[2])
+end
+
+local function now_ms()
+    return math.floor(now_us() / 1000)
+end
+
+-- Mark the dimension ready in its partition when tasks wait on it, and leave
+-- a wakeup token for the owner of the partition.
+-- ready and wakeup are the keys of the partition, waiting the tenants waiting
+-- on the dimension.
+local function wake(dimension, ready, wakeup, waiting)
+    if redis.call('EXISTS', waiting) == 0 then
+        return 0
+    end
+    redis.call('SADD', ready, dimension)
+    redis.call('LPUSH', wakeup, 1)
+    redis.call('LTRIM', wakeup, 0, 0)
+    return 1
+end
+"""
+
+# Heartbeat the replica, then claim the partitions assigned to it and give
+# back the ones that are not anymore. Partitions are spread over the live
+# replicas sorted by ID, so every replica computes the same assignment.
+#
+# KEYS[1]          live replicas, scored by last heartbeat in ms
+# KEYS[2..1+N]     partition leases
+# ARGV[1]          replica id
+# ARGV[2]          lease duration in ms
+#
+# Returns the owned partitions, numbered from 0.
+CLAIM_PARTITIONS_SCRIPT = SCRIPT_HELPERS_LUA + """
+local now = now_ms()
+local ttl = tonumber(ARGV[2])
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - ttl)
+local replicas = redis.call('ZRANGE', KEYS[1], 0, -1)
+table.sort(replicas)
+local index = 0
+for i = 1, #replicas do
+    if replicas[i] == ARGV[1] then
+        index = i - 1
+    end
+end
+local owned = {}
+for p = 0, #KEYS - 2 do
+    local key = KEYS[2 + p]
+    local owner = redis.call('GET', key)
+    if p % #replicas == index then
+        if not owner then
+            redis.call('SET', key, ARGV[1], 'PX', ttl)
+            table.insert(owned, p)
+        elseif owner == ARGV[1] then
+            redis.call('PEXPIRE', key, ttl)
+            table.insert(owned, p)
+        end
+    elseif owner == ARGV[1] then
+        redis.call('DEL', key)
+    end
+end
+return owned
+"""
+
+# KEYS[1]       live replicas
+# KEYS[2..1+N]  partition leases
+# ARGV[1]       replica id
+RELEASE_PARTITIONS_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+for i = 2, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[1] then
+        redis.call('DEL', KEYS[i])
+    end
+end
+return 1
+"""
+
+
+class PartitionConfig(NamedTuple):
+    """
+    Partitions of the dispatcher queue, spread over the dispatcher replicas.
+    """
+    # Number of partitions of the dispatcher queue
+    count: int = 8
+    # Partition lease duration in seconds, renewed three times per period
+    lease_ttl: float = 10.0
+
+
+class PartitionedQueue:
+    """
+    Key layout of the dispatcher queue, sharded into partitions by hash of the dimension the tasks wait on.
+
+    All the tasks waiting on a dimension are in the same partition, whatever their tenant and priority,
+    so that the owner of the partition shares the capacity of the dimension between all of them.
+    """
+    def __init__(self, queue_key: str, partitions: int):
+        """
+        Args:
+            queue_key (str): The key prefix for the dispatcher queues in Redis.
+            partitions (int): The number of partitions.
+        """
+        self.queue_key = queue_key
+        self.partitions = partitions
+
+    def partition_of(self, dimension: str) -> int:
+        """
+        Return the partition of the tasks waiting on the dimension.
+        """
+        return zlib.crc32(dimension.encode()) % self.partitions
+
+    def ready_key(self, partition: int) -> str:
+        """
+        Return the key of the ready index of dimensions with free capacity and waiting tasks.
+        """
+        return f"{self.queue_key}:{partition}:ready"
+
+    def wakeup_key(self, partition: int) -> str:
+        """
+        Return the key of the wakeup list of the partition owner.
+        """
+        return f"{self.queue_key}:{partition}:wakeup"
+
+    def wait_key(self, dimension: str, priority: int, tenant: str) -> str:
+        """
+        Return the key of the wait list of the tenant in the priority lane for the dimension.
+        """
+        return f"{self.queue_key}:{self.partition_of(dimension)}:wait:{dimension}:{priority}:{tenant}"
+
+    def tenants_key(self, dimension: str) -> str:
+        """
+        Return the key of the set of tenants waiting on the dimension, as `{priority}:{tenant}` members.
+        """
+        return f"{self.queue_key}:{self.partition_of(dimension)}:tenants:{dimension}"
+
+    def wake_keys(self, dimensions: list) -> list[str]:
+        """
+        Return the keys the scripts need to wake the tasks waiting on the dimensions: dimension by
+        dimension, the ready index and the wakeup list of its partition and its waiting tenants.
+        """
+        keys = []
+        for dimension in dimensions:
+            partition = self.partition_of(dimension)
+            keys.extend((self.ready_key(partition), self.wakeup_key(partition), self.tenants_key(dimension)))
+        return keys
+
+
+class PartitionLeaseManager:
+    """
+    Membership of the dispatcher replicas and ownership of the queue partitions.
+
+    Each replica owns a disjoint set of partitions through expiring leases, and the partitions
+    of a replica that stops heartbeating are taken over once its leases expire.
+    """
+    def __init__(self, redis_client: Redis, partitions: int, replica_id: str = None, lease_ttl: float = 10.0, key_prefix: str = "dispatcher:partition"):
+        """
+        Initialize the partition lease manager and register its scripts.
+
+        Args:
+            redis_client (Redis): The Redis client instance the scripts are registered on.
+            partitions (int): The number of partitions.
+            replica_id (str): The unique ID of this dispatcher replica.
+            lease_ttl (float): The partition lease and heartbeat duration in seconds.
+            key_prefix (str): The key prefix for the partition leases in Redis.
+        """
+        self.redis_client = redis_client
+        self.partitions = partitions
+        self.replica_id = replica_id or uuid4().hex
+        self.lease_ttl = lease_ttl
+        self.replicas_key = f"{key_prefix}:replicas"
+        self.lease_keys = [f"{key_prefix}:{partition}" for partition in range(partitions)]
+        self.owned: list[int] = []
+        self._claim_script = redis_client.register_script(CLAIM_PARTITIONS_SCRIPT)
+        self._release_script = redis_client.register_script(RELEASE_PARTITIONS_SCRIPT)
+
+    async def rebalance(self) -> list[int]:
+        """
+        Heartbeat, renew the owned partition leases and rebalance them over the live replicas.
+
+        Returns:
+            list[int]: The partitions owned by this replica.
+        """
+        self.owned = await self._claim_script(keys=[self.replicas_key, *self.lease_keys], args=[self.replica_id, int(self.lease_ttl * 1000)])
+        return self.owned
+
+    async def release_all(self):
+        """
+        Give back every owned partition, so that the other replicas take them over right away.
+        """
+        await self._release_script(keys=[self.replicas_key, *self.lease_keys], args=[self.replica_id])
+        self.owned = []
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from contextlib import AsyncExitStack
+from typing import NamedTuple
+
+from redis import Redis
+
+from .leases import LEASE_DIMENSIONS_KEY, LEASE_USAGE_KEY
+from .partitions import SCRIPT_HELPERS_LUA, PartitionedQueue
+
+logger = logging.getLogger(__name__)
+
+# A quota block is a share of the limit of a high-limit dimension leased by a
+# dispatcher replica, which then admits tasks on that dimension locally
+# instead of reserving their slots in Redis one by one. The units of a block
+# count in the usage of the dimension from the time they are granted, so the
+# tasks admitted globally never go over the limit together with the blocks.
+# The jobs admitted from a block hold no slot lease on its dimension: their
+# completions are pushed to the release list of the replica, which puts their
+# units back in the block. Like a slot lease, the units of a job are kept until
+# a deadline the worker extends when each try starts, through the renewals of
+# the replica, so those of a job that never reports its completion come back
+# as soon as its try is over. Idle units are given back to the dimension, and the
+# block of a replica that stops renewing it is reclaimed once it expires.
+QUOTA_KEY_PREFIX = "dispatcher:quota:"
+QUOTA_DEADLINES_KEY = "dispatcher:quota-deadlines"
+QUOTA_RELEASED_KEY_PREFIX = "dispatcher:quota-released:"
+QUOTA_RENEWED_KEY_PREFIX = "dispatcher:quota-renewed:"
+
+# Grant the replica up to the wanted units of what is left of the limit.
+#
+# KEYS[1]  usage per dimension
+# KEYS[2]  quota blocks of the dimension, granted units by replica
+# KEYS[3]  quota block deadlines
+# KEYS[4]  leased dimensions index
+# ARGV[1]  dimension name
+# ARGV[2]  replica id
+# ARGV[3]  limit
+# ARGV[4]  units wanted
+# ARGV[5]  minimum units, nothing is granted below
+# ARGV[6]  block lease duration in ms
+# ARGV[7]  member of the block in the deadlines
+#
+# Returns {granted units, units of the block before}.
+ACQUIRE_QUOTA_SCRIPT = SCRIPT_HELPERS_LUA + """
+local before = tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or 0)
+local free = tonumber(ARGV[3]) - tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+local units = math.min(tonumber(ARGV[4]), free)
+if units < tonumber(ARGV[5]) then
+    return {0, before}
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], units)
+redis.call('HINCRBY', KEYS[2], ARGV[2], units)
+redis.call('ZADD', KEYS[3], now_ms() + tonumber(ARGV[6]), ARGV[7])
+redis.call('SADD', KEYS[4], ARGV[1])
+return {units, before}
+"""
+
+# Give units of the block back to the dimension and renew the block, or drop
+# it once it is empty. The tasks waiting on the dimension are woken when units
+# are given back, or when asked to because units came back to the block.
+#
+# KEYS[1]    usage per dimension
+# KEYS[2]    quota blocks of the dimension
+# KEYS[3]    quota block deadlines
+# KEYS[4..6] wake keys of the dimension, see PartitionedQueue.wake_keys
+# ARGV[1]    dimension name
+# ARGV[2]    replica id
+# ARGV[3]    units given back
+# ARGV[4]    block lease duration in ms
+# ARGV[5]    member of the block in the deadlines
+# ARGV[6]    1 to wake the tasks waiting on the dimension
+#
+# Returns the units left in the block, or -1 if the block was reclaimed.
+SYNC_QUOTA_SCRIPT = SCRIPT_HELPERS_LUA + """
+local granted = redis.call('HGET', KEYS[2], ARGV[2])
+if not granted then
+    redis.call('ZREM', KEYS[3], ARGV[5])
+    return -1
+end
+granted = tonumber(granted)
+local units = math.min(tonumber(ARGV[3]), granted)
+if units > 0 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], -units)
+    granted = redis.call('HINCRBY', KEYS[2], ARGV[2], -units)
+end
+if granted > 0 then
+    redis.call('ZADD', KEYS[3], now_ms() + tonumber(ARGV[4]), ARGV[5])
+else
+    redis.call('HDEL', KEYS[2], ARGV[2])
+    redis.call('ZREM', KEYS[3], ARGV[5])
+end
+if units > 0 or ARGV[6] == '1' then
+    wake(ARGV[1], KEYS[4], KEYS[5], KEYS[6])
+end
+return granted
+"""
+
+# Give the whole block of a replica back to the dimension once it has expired.
+#
+# KEYS[1]    usage per dimension
+# KEYS[2]    quota blocks of the dimension
+# KEYS[3]    quota block deadlines
+# KEYS[4..6] wake keys of the dimension, see PartitionedQueue.wake_keys
+# ARGV[1]    dimension name
+# ARGV[2]    replica id
+# ARGV[3]    member of the block in the deadlines
+#
+# Returns the units given back.
+RECLAIM_QUOTA_SCRIPT = SCRIPT_HELPERS_LUA + """
+local deadline = redis.call('ZSCORE', KEYS[3], ARGV[3])
+if not deadline or tonumber(deadline) > now_ms() then
+    return 0
+end
+redis.call('ZREM', KEYS[3], ARGV[3])
+local granted = tonumber(redis.call('HGET', KEYS[2], ARGV[2]) or 0)
+redis.call('HDEL', KEYS[2], ARGV[2])
+if granted > 0 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], -granted)
+    wake(ARGV[1], KEYS[4], KEYS[5], KEYS[6])
+end
+return granted
+"""
+
+
+def quota_key(dimension: str) -> str:
+    """
+    Return the key of the quota blocks of the dimension, granted units by replica.
+    """
+    return QUOTA_KEY_PREFIX + dimension
+
+
+def quota_released_key(replica_id: str) -> str:
+    """
+    Return the key of the release list of the replica, the IDs of the completed jobs admitted from its blocks.
+    """
+    return QUOTA_RELEASED_KEY_PREFIX + replica_id
+
+
+def quota_renewed_key(replica_id: str) -> str:
+    """
+    Return the key of the renewals of the replica, the deadline in epoch ms of the units of its running jobs by job ID.
+    """
+    return QUOTA_RENEWED_KEY_PREFIX + replica_id
+
+
+class QuotaConfig(NamedTuple):
+    """
+    Quota blocks of a dispatcher replica, see QuotaLeases.
+    """
+    # Lowest limit of a dimension admitted locally from quota blocks, None to admit every dimension in Redis
+    min_limit: int | None = None
+    # Share of the limit of a dimension leased per block
+    block_fraction: float = 0.1
+    # Block lease duration in seconds, renewed on each sync
+    ttl: float = 30.0
+    # Interval in seconds for putting the units of the completed jobs back in the blocks and giving the idle ones back
+    sync_interval: float = 0.5
+
+
+class QuotaLeases:
+    """
+    Quota blocks leased by a dispatcher replica on its high-limit dimensions, and the local
+    admission against them.
+    """
+    def __init__(self, redis_client: Redis, replica_id: str = None, min_limit: int = None, block_fraction: float = 0.1, ttl: float = 30.0):
+        """
+        Initialize the quota blocks and register their scripts.
+
+        Args:
+            redis_client (Redis): The Redis client instance the scripts are registered on.
+            replica_id (str): The unique ID of this dispatcher replica, None for a worker only renewing the units of its jobs.
+            min_limit (int): The lowest limit of a dimension admitted from quota blocks, None to admit every dimension globally.
+            block_fraction (float): The share of the limit of a dimension leased per block.
+            ttl (float): The block lease duration in seconds, renewed on each sync.
+        """
+        self.redis_client = redis_client
+        self.replica_id = replica_id
+        self.min_limit = min_limit
+        self.block_fraction = block_fraction
+        self.ttl = ttl
+        self.granted: dict[str, int] = {}
+        self.free: dict[str, int] = {}
+        # Dimensions with units taken since the previous sync, the others are idle
+        self._taken: set[str] = set()
+        # Dimensions whose limit had no room left for a block, not asked again until the next sync
+        self._exhausted: set[str] = set()
+        # Jobs admitted from the blocks, by job ID: the deadline of their units and their cost by dimension
+        self._jobs: dict[str, tuple[float, dict[str, int]]] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._acquire_script = redis_client.register_script(ACQUIRE_QUOTA_SCRIPT)
+        self._sync_script = redis_client.register_script(SYNC_QUOTA_SCRIPT)
+        self._reclaim_script = redis_client.register_script(RECLAIM_QUOTA_SCRIPT)
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_limit is not None
+
+    def eligible(self, limit: int | None, rate_limit) -> bool:
+        """
+        Return whether a dimension is admitted from quota blocks: its limit is high enough and it has no rate limit.
+        """
+        return self.enabled and limit is not None and limit >= self.min_limit and rate_limit is None
+
+    def _member(self, dimension: str) -> str:
+        return json.dumps([self.replica_id, dimension])
+
+    def _lock(self, dimension: str) -> asyncio.Lock:
+        lock = self._locks.get(dimension)
+        if lock is None:
+            lock = self._locks[dimension] = asyncio.Lock()
+        return lock
+
+    async def take(self, dimension: str, limit: int, cost: int) -> bool:
+        """
+        Take the cost of a task from the block of the dimension, leasing a new block from Redis
+        when the units left are not enough.
+
+        Returns:
+            bool: True if the units were taken, False if the limit has no room left for a block.
+        """
+        if self.free.get(dimension, 0) < cost:
+            if dimension in self._exhausted:
+                return False
+            async with self._lock(dimension):
+                if self.free.get(dimension, 0) < cost:
+                    await self._acquire(dimension, limit, cost)
+            if self.free.get(dimension, 0) < cost:
+                self._exhausted.add(dimension)
+                return False
+        self.free[dimension] -= cost
+        self._taken.add(dimension)
+        return True
+
+    async def _acquire(self, dimension: str, limit: int, cost: int):
+        wanted = max(math.ceil(limit * self.block_fraction), cost)
+        units, before = await self._acquire_script(
+            keys=[LEASE_USAGE_KEY, quota_key(dimension), QUOTA_DEADLINES_KEY, LEASE_DIMENSIONS_KEY],
+            args=[dimension, self.replica_id, limit, wanted, cost, int(self.ttl * 1000), self._member(dimension)],
+        )
+        if before < self.granted.get(dimension, 0):
+            # The block expired before it was renewed and was given back meanwhile
+            logger.warning("Quota block of %s expired before it was renewed.", dimension)
+            self._drop(dimension)
+        if units:
+            self.granted[dimension] = self.granted.get(dimension, 0) + units
+            self.free[dimension] = self.free.get(dimension, 0) + units
+
+    def give(self, dimension: str, cost: int):
+        """
+        Put units back in the block of the dimension, e.g. those of a task that was not admitted.
+        """
+        if dimension in self.granted:
+            self.free[dimension] += cost
+
+    def track(self, job_id: str, costs: dict[str, int], ttl: float):
+        """
+        Keep the units of a job admitted from the blocks until its completion is released,
+        or for ttl seconds unless the worker renews them meanwhile.
+        """
+        self._jobs[job_id] = (time.monotonic() + ttl, costs)
+
+    def _drop(self, dimension: str):
+        self.granted.pop(dimension, None)
+        self.free.pop(dimension, None)
+        # The units of the running jobs were given back with the block
+        for job_id, (_, costs) in list(self._jobs.items()):
+            costs.pop(dimension, None)
+            if not costs:
+                del self._jobs[job_id]
+
+    async def release(self, replica_id: str, job_id: str):
+        """
+        Push the completion of a job admitted from the blocks of a replica to its release list.
+        """
+        key = quota_released_key(replica_id)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, job_id)
+            pipe.pexpire(key, int(self.ttl * 1000))
+            await pipe.execute()
+
+    async def renew(self, replica_id: str, job_id: str, ttl: float):
+        """
+        Keep the units of a job admitted from the blocks of a replica for ttl seconds from now,
+        e.g. for the duration of a try.
+        """
+        key = quota_renewed_key(replica_id)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(key, job_id, int((time.time() + ttl) * 1000))
+            pipe.pexpire(key, int(self.ttl * 1000))
+            await pipe.execute()
+
+    async def sync(self, queue: PartitionedQueue, give_back_all: bool = False):
+        """
+        Put the units of the released jobs back in the blocks, extend the deadline of the renewed ones,
+        give the idle units back and renew the blocks.
+
+        Args:
+            queue (PartitionedQueue): The queue of the tasks woken when units are given back.
+            give_back_all (bool): Give back every free unit, e.g. when the replica stops.
+        """
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.lrange(quota_released_key(self.replica_id), 0, -1)
+            pipe.delete(quota_released_key(self.replica_id))
+            pipe.hgetall(quota_renewed_key(self.replica_id))
+            pipe.delete(quota_renewed_key(self.replica_id))
+            released, _, renewed, _ = await pipe.execute()
+        returned = set()
+        for job_id in released:
+            _, costs = self._jobs.pop(job_id.decode(), (None, {}))
+            for dimension, cost in costs.items():
+                self.give(dimension, cost)
+                returned.add(dimension)
+        now = time.monotonic()
+        for job_id, deadline_ms in renewed.items():
+            job = self._jobs.get(job_id.decode())
+            if job:
+                self._jobs[job_id.decode()] = (now + int(deadline_ms) / 1000 - time.time(), job[1])
+        expired = [job_id for job_id, (deadline, _) in self._jobs.items() if deadline <= now]
+        for job_id in expired:
+            for dimension, cost in self._jobs.pop(job_id)[1].items():
+                self.give(dimension, cost)
+                returned.add(dimension)
+        if expired:
+            logger.warning("Gave back the units of %d job(s) that never reported their completion.", len(expired))
+
+        self._exhausted.clear()
+        dimensions = sorted(self.granted)
+        if not dimensions:
+            self._taken.clear()
+            return
+        async with AsyncExitStack() as stack:
+            # Keep the blocks from being leased meanwhile, so the granted units match Redis
+            for dimension in dimensions:
+                await stack.enter_async_context(self._lock(dimension))
+            given_back = {}
+            for dimension in dimensions:
+                units = self.free[dimension] if give_back_all or dimension not in self._taken else 0
+                self.free[dimension] -= units
+                given_back[dimension] = units
+            self._taken.clear()
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for dimension in dimensions:
+                    await self._sync_script(
+                        keys=[LEASE_USAGE_KEY, quota_key(dimension), QUOTA_DEADLINES_KEY, *queue.wake_keys([dimension])],
+                        args=[dimension, self.replica_id, given_back[dimension], int(self.ttl * 1000), self._member(dimension), int(dimension in returned)],
+                        client=pipe,
+                    )
+                replies = await pipe.execute()
+            for dimension, granted in zip(dimensions, replies):
+                if granted < 0:
+                    logger.warning("Quota block of %s expired before it was renewed.", dimension)
+                    self._drop(dimension)
+                elif granted == 0:
+                    self._drop(dimension)
+                else:
+                    self.granted[dimension] -= given_back[dimension]
+
+    async def reclaim(self, queue: PartitionedQueue) -> int:
+        """
+        Give back the expired blocks of every replica, waking the tasks waiting on their dimensions in the queue.
+
+        Returns:
+            int: The number of units given back.
+        """
+        members = await self.redis_client.zrangebyscore(QUOTA_DEADLINES_KEY, "-inf", int(time.time() * 1000))
+        if not members:
+            return 0
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for member in members:
+                replica_id, dimension = json.loads(member)
+                await self._reclaim_script(
+                    keys=[LEASE_USAGE_KEY, quota_key(dimension), QUOTA_DEADLINES_KEY, *queue.wake_keys([dimension])],
+                    args=[dimension, replica_id, member],
+                    client=pipe,
+                )
+            return sum(await pipe.execute())
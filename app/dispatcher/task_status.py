@@ -0,0 +1,149 @@
+import time
+from contextlib import aclosing
+from typing import AsyncIterator
+
+from redis import Redis
+
+from .codec import Codec
+
+# The status of a task is a hash keyed by its task ID, the ID it keeps from
+# submission to completion, whether it waits in the dispatcher queue first or
+# is enqueued right away. Every change is published on the channel of the
+# task, for the clients waiting on it. The admission script sets the
+# deferred and enqueued states in the same round trip as the admission, the
+# worker sets running and the result collector sets complete with the result,
+# or expired for a task dropped by the dispatcher past its deadline.
+TASK_STATUS_KEY_PREFIX = "task:status:"
+TASK_STATUS_CHANNEL_PREFIX = "task:events:"
+
+# Task states
+TASK_DEFERRED = "deferred"
+TASK_ENQUEUED = "enqueued"
+TASK_RUNNING = "running"
+TASK_COMPLETE = "complete"
+TASK_EXPIRED = "expired"
+
+# States a task never leaves
+FINAL_TASK_STATES = {TASK_COMPLETE, TASK_EXPIRED}
+
+
+def task_status_key(task_id: str) -> str:
+    """
+    Return the key of the status of the task.
+    """
+    return TASK_STATUS_KEY_PREFIX + task_id
+
+
+def task_status_channel(task_id: str) -> str:
+    """
+    Return the channel the status changes of the task are published on.
+    """
+    return TASK_STATUS_CHANNEL_PREFIX + task_id
+
+
+class TaskStatusStore:
+    """
+    Status of the tasks by task ID, with the changes pushed to the clients waiting on a task.
+    """
+    def __init__(self, redis_client: Redis, codec: Codec, ttl: float = 86400.0):
+        """
+        Args:
+            redis_client (Redis): The Redis client instance.
+            codec (Codec): The codec of the task results.
+            ttl (float): The time in seconds the status of a task is kept after its last change.
+        """
+        self.redis_client = redis_client
+        self.codec = codec
+        self.ttl = ttl
+
+    async def set(self, task_id: str, state: str, **fields):
+        """
+        Set the state of a task, with extra fields such as its job ID, and publish the change.
+        """
+        await self.set_many([task_id], state, **fields)
+
+    async def set_many(self, task_ids: list[str], state: str, **fields):
+        """
+        Set the same state for a batch of tasks in one round trip.
+        """
+        if not task_ids:
+            return
+        mapping = {"state": state, "updated_at": time.time(), **fields}
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hset(task_status_key(task_id), mapping=mapping)
+                pipe.pexpire(task_status_key(task_id), int(self.ttl * 1000))
+                pipe.publish(task_status_channel(task_id), state)
+            await pipe.execute()
+
+    async def complete(self, task_id: str, job_id: str, job_result: dict | None):
+        """
+        Mark a task complete with the result of its job, as {"result": ...} or {"error": ...},
+        None if the result expired.
+        """
+        fields = {"job_id": job_id}
+        if job_result is not None:
+            fields["result"] = self.codec.encode(job_result)
+        await self.set(task_id, TASK_COMPLETE, **fields)
+
+    async def get(self, task_id: str) -> dict | None:
+        """
+        Return the status of a task, or None if it is unknown or expired.
+        """
+        return self._decode(task_id, await self.redis_client.hgetall(task_status_key(task_id)))
+
+    def _decode(self, task_id: str, raw: dict) -> dict | None:
+        if not raw:
+            return None
+        fields = {name.decode(): value for name, value in raw.items()}
+        status = {
+            "task_id": task_id,
+            "state": fields["state"].decode(),
+            "job_id": fields["job_id"].decode() if "job_id" in fields else None,
+            "updated_at": float(fields["updated_at"]) if "updated_at" in fields else None,
+        }
+        if "result" in fields:
+            status.update(self.codec.decode(fields["result"]))
+        return status
+
+    async def watch(self, task_id: str, timeout: float | None = None) -> AsyncIterator[dict]:
+        """
+        Yield the status of a task, then each change until it reaches a final state or the timeout expires.
+        Nothing is yielded for an unknown task.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            # Subscribe before reading, so that no change is missed in between
+            await pubsub.subscribe(task_status_channel(task_id))
+            status = await self.get(task_id)
+            while status is not None:
+                yield status
+                if status["state"] in FINAL_TASK_STATES:
+                    return
+                state = status["state"]
+                while status["state"] == state:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return
+                    message = await pubsub.get_message(timeout=remaining)
+                    if message is None:
+                        continue
+                    status = await self.get(task_id)
+                    if status is None:
+                        return
+        finally:
+            await pubsub.aclose()
+
+    async def wait(self, task_id: str, state: str | None, timeout: float) -> dict | None:
+        """
+        Long-poll the status of a task: return it as soon as its state differs from the given one,
+        or as it is once the timeout expires.
+        """
+        status = None
+        # Close the watch right away on break, unsubscribing from the task channel
+        async with aclosing(self.watch(task_id, timeout)) as statuses:
+            async for status in statuses:
+                if status["state"] != state:
+                    break
+        return status
@@ -1 +1,2 @@
 from .arq_job_result_collector import ArqJobResultCollector
+from .completion_stream import COMPLETION_STREAM_KEY, CompletionPublisher
@@ -1,92 +1,286 @@
 import asyncio
+import json
+import logging
+import time
 from typing import Awaitable, Callable, Optional
+from uuid import uuid4
 
 import redis.asyncio as redis
-from arq.jobs import Job, JobStatus
-from dispatcher import ConcurrencyAwareArqDispatcher
+from arq.constants import in_progress_key_prefix, job_key_prefix, result_key_prefix
+from arq.jobs import Job, JobResult, JobStatus, deserialize_result
+from dispatcher import (TASK_COMPLETE, TASK_EXPIRED, ConcurrencyAwareArqDispatcher,
+                        TaskCoalescer)
+from metrics import PipelineMetrics
+from redis.exceptions import ResponseError
+
+from .completion_stream import COMPLETION_STREAM_KEY
+
+logger = logging.getLogger(__name__)
 
 
 class ArqJobResultCollector:
+    """
+    Releases the slots of the completed jobs, from the completion stream and a reconciliation sweep.
+
+    The `on_result` callback is called once per task outcome as `on_result(task_id, job_id, status, result)`:
+    with the `complete` status and the job result, as {"result": ...} or {"error": ...}, None if it was not kept,
+    or with the `expired` status, no job ID and no result for a task dropped by the dispatcher past its deadline.
+    The task ID is None for a job enqueued without one.
+    """
     def __init__(
         self,
         redis_client: redis.Redis,
         dispatcher: ConcurrencyAwareArqDispatcher,
         poll_interval: float = 2.0,
         inflight_key: str = "arq:jobs:inflight",
-        on_result: Optional[Callable[[str, str, dict | None], Awaitable[None]]] = None,
+        on_result: Optional[Callable[[str | None, str | None, str, dict | None], Awaitable[None]]] = None,
+        on_pending: Optional[Callable[[dict[str, JobStatus]], Awaitable[None]]] = None,
         verbose: bool = False,
+        stream_key: str = COMPLETION_STREAM_KEY,
+        group_name: str = "arq:result-collector",
+        consumer_name: Optional[str] = None,
+        block_ms: int = 1000,
+        batch_size: int = 100,
+        claim_idle_ms: int = 30_000,
+        sweep_batch_size: int = 500,
+        sweep_budget: int = 5000,
+        metrics: Optional[PipelineMetrics] = None,
+        coalescer: Optional[TaskCoalescer] = None,
     ):
         self.redis = redis_client
         self.dispatcher = dispatcher
+        # Completions are pushed by the workers, polling is a reconciliation sweep for the jobs that end
+        # without publishing one (expired, cancelled on their last try or lost with their worker)
         self.poll_interval = poll_interval
         self.inflight_key = inflight_key
         self.on_result = on_result
+        # Opt-in, called once per sweep batch with the status of the jobs that are not complete yet
+        self.on_pending = on_pending
+
+        # Completion stream consumption
+        self.stream_key = stream_key
+        self.group_name = group_name
+        self.consumer_name = consumer_name or uuid4().hex
+        self.block_ms = block_ms
+        self.batch_size = batch_size
+        self.claim_idle_ms = claim_idle_ms
+
+        # Reconciliation sweep, resumed from the saved cursor on each tick
+        self.sweep_batch_size = sweep_batch_size
+        self.sweep_budget = sweep_budget
+        self._sweep_cursor = 0
 
         # Instance attributes
         self._running = False
-        
-        # Verbose mode
+
+        # Verbose mode, logs the lifecycle and the collected results at INFO rather than DEBUG
         self.verbose = verbose
-    
+        self._log_level = logging.INFO if verbose else logging.DEBUG
+
+        # Completions, collector lag and sweep lock contention
+        self.metrics = metrics
+
+        # Gives up the coalescing keys of the completed jobs and caches their results
+        self.coalescer = coalescer
+
 
     async def start(self):
-        if self.verbose:
-            print("[ArqJobResultCollector] Starting result collector...")
+        logger.log(self._log_level, "Starting result collector...")
         self._running = True
+        await self._ensure_group()
         lock = self.redis.lock("arq:result-collector", timeout=10)
-        
+
+        async def consume_loop():
+            while self._running:
+                try:
+                    await self._consume_once()
+                except Exception as e:
+                    logger.warning("Failed to consume completions: %s", e)
+                    await asyncio.sleep(1)
+
         async def run_loop():
             while self._running:
+                waiting_since = time.perf_counter()
                 got_lock = await lock.acquire(blocking_timeout=0.5)
+                if self.metrics:
+                    self.metrics.lock_wait.observe(time.perf_counter() - waiting_since)
+                    self.metrics.lock_acquisitions.inc(outcome="acquired" if got_lock else "busy")
                 if got_lock:
                     try:
                         await self._collect_once()
                     finally:
                         await lock.release()
+                await self._claim_stale_once()
                 await asyncio.sleep(self.poll_interval)
-            if self.verbose:
-                print("[ArqJobResultCollector] Stopped result collector.")
+            logger.log(self._log_level, "Stopped result collector.")
+        asyncio.create_task(consume_loop())
         asyncio.create_task(run_loop())
-        
+
     async def stop(self):
-        if self.verbose:
-            print("[ArqJobResultCollector] Stopping result collector...")
+        logger.log(self._log_level, "Stopping result collector...")
         self._running = False
 
-    async def _collect_once(self):
-        job_ids = await self.redis.smembers(self.inflight_key)
-        if not job_ids:
+    async def _ensure_group(self):
+        try:
+            await self.redis.xgroup_create(self.stream_key, self.group_name, id="$", mkstream=True)
+        except ResponseError as e:
+            # The group is shared by every collector replica
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _consume_once(self):
+        """
+        Block on the completion stream and release the slots of the completed jobs.
+        """
+        response = await self.redis.xreadgroup(
+            self.group_name,
+            self.consumer_name,
+            {self.stream_key: ">"},
+            count=self.batch_size,
+            block=self.block_ms,
+        )
+        for _, messages in response or []:
+            await self._handle_completions(messages)
+
+    async def _claim_stale_once(self):
+        """
+        Take over the completions left pending by a collector that died before acknowledging them.
+        """
+        _, messages, *_ = await self.redis.xautoclaim(
+            self.stream_key,
+            self.group_name,
+            self.consumer_name,
+            min_idle_time=self.claim_idle_ms,
+            count=self.batch_size,
+        )
+        await self._handle_completions(messages)
+
+    async def _handle_completions(self, messages: list):
+        message_ids = []
+        for message_id, fields in messages:
+            if fields.get(b"status", b"").decode() == TASK_EXPIRED:
+                # A task dropped by the dispatcher past its deadline, it never had a job
+                await self._expire(fields[b"task_id"].decode(), fields.get(b"coalesce_key", b"").decode() or None)
+            elif fields:
+                job_id = fields[b"job_id"].decode()
+                concurrency_dimensions = json.loads(fields[b"dimensions"])
+                quota = json.loads(fields.get(b"quota", b"null"))
+                task_id = fields.get(b"task_id", b"").decode() or None
+                coalesce_key = fields.get(b"coalesce_key", b"").decode() or None
+                await self._complete(job_id, concurrency_dimensions, quota=quota, task_id=task_id, coalesce_key=coalesce_key)
+            message_ids.append(message_id)
+        if message_ids:
+            await self.redis.xack(self.stream_key, self.group_name, *message_ids)
+
+    async def _complete(self, job_id: str, concurrency_dimensions: list, result_info: JobResult | None = None, source: str = "stream", quota: dict | None = None, task_id: str | None = None, coalesce_key: str | None = None):
+        """
+        Release the slots of a completed job exactly once, whichever path saw it first.
+        """
+        removed = await self.redis.srem(self.inflight_key, job_id)
+        if not removed:
             return
+        await self.dispatcher.decrease_concurrency(concurrency_dimensions, job_id, quota)
 
-        for job_id_bytes in job_ids:
-            job_id = job_id_bytes.decode()
-            if self.verbose:
-                print(f"[ArqJobResultCollector] Collecting result for job ID: {job_id}")
-            job = Job(job_id=job_id, redis=self.redis)
-            
-            # Get the job status
-            status = await job.status()
-            if status == JobStatus.complete:
-                # Package the job result as a dictionary even if it's exception
-                try:
-                    job_result = {
-                        "result": await job.result(),
-                    }
-                except Exception as e:
-                    job_result = {
-                        "error": str(e),
-                    }
-                    
-                if self.verbose:
-                    print(f"[ArqJobResultCollector] Collected result for {job_id} → {job_result}")
-                await self.redis.srem(self.inflight_key, job_id)
-                
-                job_info = await job.info()
-                concurrency_dimensions = job_info.args[1].get("_concurrency_dimensions", [])
-                await self.dispatcher.decrease_concurrency(concurrency_dimensions)
-                    
-                if self.on_result:
-                    await self.on_result(job_id, status, job_result)
+        if result_info is None:
+            result_info = await Job(job_id=job_id, redis=self.redis, _deserializer=self.dispatcher.arq.job_deserializer).result_info()
+        if result_info is not None:
+            # Let adaptive policies track the latency and errors of each dimension
+            latency = (result_info.finish_time - result_info.start_time).total_seconds()
+            await self.dispatcher.record_completion(concurrency_dimensions, latency, result_info.success)
+        if self.metrics:
+            self._record_completion(result_info, source)
+        if self.coalescer and result_info is not None:
+            await self._complete_coalesced(result_info)
+        elif self.coalescer and coalesce_key and task_id:
+            # The result expired or was never kept, give up the key without caching anything
+            await self.coalescer.complete(coalesce_key, task_id)
+        job_result = self._package_result(result_info)
+        if task_id is None and result_info is not None and len(result_info.args) > 1:
+            task_id = result_info.args[1].get("_task_id")
+        if task_id:
+            # Pushed to the clients waiting on the task, with its result
+            await self.dispatcher.task_status.complete(task_id, job_id, job_result)
+        logger.log(self._log_level, "Collected result for %s → %s", job_id, job_result)
+        if self.on_result:
+            await self.on_result(task_id, job_id, TASK_COMPLETE, job_result)
+
+    async def _expire(self, task_id: str, coalesce_key: str | None = None):
+        """
+        Report a task dropped past its deadline, giving up its coalescing key so that identical submissions run again.
+        """
+        await self.dispatcher.task_status.set(task_id, TASK_EXPIRED)
+        if self.coalescer and coalesce_key:
+            await self.coalescer.complete(coalesce_key, task_id)
+        logger.log(self._log_level, "Task %s expired before it was admitted", task_id)
+        if self.on_result:
+            await self.on_result(task_id, None, TASK_EXPIRED, None)
+
+    async def _complete_coalesced(self, result_info: JobResult):
+        # Without a result, the ownership of the key expires on its own
+        metadata = result_info.args[1] if len(result_info.args) > 1 else {}
+        key = metadata.get("_coalesce_key")
+        if key:
+            ttl = metadata.get("_coalesce_ttl", 0) if result_info.success else 0
+            await self.coalescer.complete(key, metadata["_task_id"], result_info.result, ttl)
+
+    def _record_completion(self, result_info: JobResult | None, source: str):
+        if result_info is None:
+            # The result expired or was never stored
+            self.metrics.completions.inc(source=source, status="unknown")
+            return
+        self.metrics.completions.inc(source=source, status="success" if result_info.success else "failure")
+        self.metrics.collector_lag.observe(max(time.time() - result_info.finish_time.timestamp(), 0))
+
+    def _package_result(self, result_info: JobResult | None) -> dict | None:
+        # Package the job result as a dictionary even if it's exception
+        if result_info is None:
+            return None
+        if result_info.success:
+            return {"result": result_info.result}
+        return {"error": str(result_info.result)}
+
+    async def _collect_once(self):
+        """
+        Reconcile the inflight set with the job results, within the per-tick work budget.
+
+        The inflight set is walked with SSCAN from where the previous tick stopped, and each
+        batch of jobs costs a single pipelined round trip.
+        """
+        budget = self.sweep_budget
+        while budget > 0:
+            self._sweep_cursor, job_ids = await self.redis.sscan(
+                self.inflight_key,
+                cursor=self._sweep_cursor,
+                count=min(self.sweep_batch_size, budget),
+            )
+            if job_ids:
+                await self._collect_batch([job_id.decode() for job_id in job_ids])
+                budget -= len(job_ids)
+            if self._sweep_cursor == 0:
+                # The whole set has been walked, the next tick starts over
+                break
+
+    async def _collect_batch(self, job_ids: list[str]):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for job_id in job_ids:
+                pipe.get(result_key_prefix + job_id)
+                pipe.exists(job_key_prefix + job_id)
+                pipe.exists(in_progress_key_prefix + job_id)
+            replies = await pipe.execute()
+
+        pending = {}
+        for i, job_id in enumerate(job_ids):
+            raw_result, job_exists, in_progress = replies[3 * i:3 * i + 3]
+            if raw_result is not None:
+                result_info = deserialize_result(raw_result, deserializer=self.dispatcher.arq.job_deserializer)
+                concurrency_dimensions = result_info.args[1].get("_concurrency_dimensions", [])
+                await self._complete(job_id, concurrency_dimensions, result_info, source="sweep", quota=result_info.args[1].get("_quota"), task_id=result_info.args[1].get("_task_id"))
+            elif in_progress:
+                pending[job_id] = JobStatus.in_progress
+            elif job_exists:
+                pending[job_id] = JobStatus.queued
             else:
-                if self.on_result:
-                    await self.on_result(job_id, status)
+                pending[job_id] = JobStatus.not_found
+
+        if pending and self.on_pending:
+            await self.on_pending(pending)
@@ -0,0 +1,63 @@
+import json
+
+from arq.constants import job_key_prefix
+from redis import Redis
+
+COMPLETION_STREAM_KEY = "arq:jobs:completed"
+
+# Publish a completion only once the job has ended for good: arq deletes the
+# job key when a job finishes, while a job scheduled for retry keeps it.
+#
+# KEYS[1]  arq job key
+# KEYS[2]  completion stream
+# ARGV[1]  approximate maximum length of the stream
+# ARGV[2]  job id
+# ARGV[3]  JSON encoded concurrency dimensions
+# ARGV[4]  JSON encoded quota blocks the job was admitted from, null if none
+# ARGV[5]  task id, empty if none
+# ARGV[6]  coalescing key of the task, empty if none, given up even when the result is not kept
+#
+# The dispatcher also publishes the tasks it drops past their deadline, with
+# the expired status, the task id and the coalescing key but no job.
+PUBLISH_COMPLETION_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return false
+end
+return redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], '*', 'job_id', ARGV[2], 'dimensions', ARGV[3], 'quota', ARGV[4], 'task_id', ARGV[5], 'coalesce_key', ARGV[6])
+"""
+
+
+class CompletionPublisher:
+    """
+    Worker side of the completion stream, publishing ended jobs for the result collector.
+    """
+    def __init__(self, redis_client: Redis, stream_key: str = COMPLETION_STREAM_KEY, maxlen: int = 100_000):
+        """
+        Initialize the publisher.
+
+        Args:
+            redis_client (Redis): The Redis client instance, usually the arq worker pool.
+            stream_key (str): The key of the completion stream in Redis.
+            maxlen (int): The approximate maximum length of the completion stream.
+        """
+        self.redis_client = redis_client
+        self.stream_key = stream_key
+        self.maxlen = maxlen
+        self._publish_script = redis_client.register_script(PUBLISH_COMPLETION_SCRIPT)
+
+    async def publish(self, job_id: str, task_metadata: dict | None) -> bool:
+        """
+        Publish the completion of a job if it has ended for good.
+
+        Returns:
+            bool: True if a completion was published, False if the job will be retried.
+        """
+        dimensions = (task_metadata or {}).get("_concurrency_dimensions", [])
+        quota = (task_metadata or {}).get("_quota")
+        task_id = (task_metadata or {}).get("_task_id", "")
+        coalesce_key = (task_metadata or {}).get("_coalesce_key", "")
+        message_id = await self._publish_script(
+            keys=[job_key_prefix + job_id, self.stream_key],
+            args=[self.maxlen, job_id, json.dumps(dimensions), json.dumps(quota), task_id, coalesce_key],
+        )
+        return message_id is not None
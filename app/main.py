@@ -1,89 +1,260 @@
+import asyncio
+import json
+import logging
+import math
+import os
 import uuid
 from contextlib import asynccontextmanager
+from typing import Annotated
 
 import redis
 import redis.asyncio
 from arq import create_pool
 from arq.connections import RedisSettings
-from dispatcher import ConcurrencyAwareArqDispatcher
-from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse
+from dispatcher import (ATTACHED, CACHED, FINAL_TASK_STATES, PRIORITY_HIGH,
+                        PRIORITY_NORMAL, REJECTED, BackpressureConfig,
+                        ConcurrencyAwareArqDispatcher, Overloaded, QuotaConfig,
+                        TaskCoalescer, TaskStatusStore, coalescing_key,
+                        get_codec)
+from fastapi import FastAPI, HTTPException, Query, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import (JSONResponse, PlainTextResponse,
+                               StreamingResponse)
 from job_result_collector import ArqJobResultCollector
+from metrics import (WORKER_METRICS_KEY, MetricsRegistry, PipelineMetrics,
+                     WorkerMetrics)
 from persistence import ConnectorRepository
-from pydantic import BaseModel
-from service import AccountService
-from throttling import StaticThrottlingPolicy
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from service import AccountService, DimensionIndex, DimensionResolver
+from tasks import (BlockingLongRunningTask, DownloadContentTask, ErrorTask,
+                   GreetingTask, NonBlockingLongRunningTask,
+                   SideEffectErrorTask,
+                   SideEffectNonBlockingLongRunningWithErrorTask)
+from tasks.schema import get_task_schema
+from throttling import (AdaptiveLimit, AdaptiveThrottlingPolicy, RateLimit,
+                        RateLimitThrottlingPolicy, RedisThrottlingPolicy)
 
 CLUSTER_DIMENSION = "cluster"
+BATCH_CHUNK_SIZE = 500
+# Share of the cluster capacity of an account, by cluster tier
+CLUSTER_TIER_WEIGHTS = {1: 2.0, 2: 1.0}
+# Concurrency limit of the pool shared by the accounts of each cluster tier
+TIER_POOL_LIMITS = {1: 30, 2: 10}
+# Interval for applying the account and connector changes to the dimension index
+DIMENSION_INDEX_REFRESH_INTERVAL = 60
+# Budget of the result cache of the coalesced idempotent tasks
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Outcomes of the submissions answered by an identical task, queued or running, or by its cached result
+COALESCED = "coalesced"
+CACHED_RESULT = "cached"
+# Interval of the keepalive comments of the task event streams, while the state of the task does not change
+TASK_EVENTS_HEARTBEAT_INTERVAL = 15
+# Longest long-poll on the status of a task
+TASK_WAIT_MAX_TIMEOUT = 60
+# Tasks waiting on a dimension, and waiting or deferred in total, past which submissions are rejected with a 429
+MAX_DIMENSION_BACKLOG = 10_000
+MAX_TOTAL_BACKLOG = 100_000
+# Estimated wait of a submission past which it is rejected with a 429, from the drain rate of its dimensions
+MAX_QUEUE_WAIT = 600
+# Cluster slots kept for high priority tasks
+CLUSTER_RESERVED_CAPACITY = 2
+# Lowest limit of a dimension admitted locally from quota blocks leased by the replica
+QUOTA_MIN_LIMIT = 50
+TASK_CLASSES = {
+    task_cls.name or task_cls.__name__: task_cls
+    for task_cls in (
+        DownloadContentTask,
+        GreetingTask,
+        BlockingLongRunningTask,
+        NonBlockingLongRunningTask,
+        ErrorTask,
+        SideEffectErrorTask,
+        SideEffectNonBlockingLongRunningWithErrorTask,
+    )
+}
 REDIS_SETTINGS = RedisSettings(
     host="redis",
     port=6379
 )
+# Serialization of the queue entries and arq jobs, must match the worker (json, msgpack or orjson)
+CODEC = get_codec("json")
+# Prometheus text exposition format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# DEBUG logs every throttling decision
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
-async def handle_task_result(task_id: str, task_status: str, task_result: dict = None):
-    """Handle the result of a task."""
+async def handle_task_result(task_id: str | None, job_id: str | None, task_status: str, task_result: dict = None):
+    """Handle the outcome of a task, complete with the result of its job or expired before it had one."""
     # Here you can implement your logic to handle the task result
-    print(f"Task {task_id} status: {task_status}")
+    logger.info("Task %s (job %s) status: %s", task_id, job_id, task_status)
     if task_result:
-        print(f"Task {task_id} result: {task_result}")
+        logger.info("Task %s result: %s", task_id, task_result)
+
+async def refresh_dimension_index(index: DimensionIndex, limit_store: RedisThrottlingPolicy, rate_limit_policy: RateLimitThrottlingPolicy):
+    """Apply the account and connector changes periodically, with the limits of the new and changed dimensions."""
+    while True:
+        await asyncio.sleep(DIMENSION_INDEX_REFRESH_INTERVAL)
+        try:
+            limits = index.refresh()
+            if limits:
+                # A limit changed in the account or connector settings overrides the one set at runtime
+                await limit_store.update_limits(limits)
+            for dimension, rate in index.rate_limits().items():
+                rate_limit = rate_limit_policy.rate_limits.get(dimension)
+                if rate_limit is None or rate_limit.rate != rate:
+                    rate_limit_policy.rate_limits[dimension] = RateLimit(rate=rate)
+        except Exception as e:
+            logger.warning("Failed to refresh the dimension index: %s", e)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for FastAPI."""
     # Startup
-    app.state.arq = await create_pool(REDIS_SETTINGS)
+    app.state.arq = await create_pool(REDIS_SETTINGS, job_serializer=CODEC.encode, job_deserializer=CODEC.decode)
     app.state.redis_client = redis.asyncio.Redis(
         host="redis",
         port=6379,
     )
     
-    # Construct the throttling policy
-    limit_config = {}
-    account_service = AccountService()
-    accounts = account_service.get_all_accounts()
-
-    for account in accounts:
-        limit_config[f"account:{account['id']}"] = account['max_concurrency']
-        print(f"Policy added for account: {account['id']} with limit: {account['max_concurrency']}")
+    # Index the accounts, their tier pools and the connectors once, the dimensions of each task are
+    # resolved from it without calling the account service
+    dimension_index = DimensionIndex(
+        account_service=AccountService(),
+        connector_repository=ConnectorRepository(),
+        tier_pool_limits=TIER_POOL_LIMITS,
+        tier_weights=CLUSTER_TIER_WEIGHTS,
+    )
+    limit_config = dimension_index.refresh()
+    rate_config = dimension_index.rate_limits()
+    for dimension, limit in limit_config.items():
+        logger.info("Policy added for %s with limit: %s", dimension, limit)
+    for dimension, rate in rate_config.items():
+        logger.info("Rate limit added for %s with rate: %s/s", dimension, rate)
+    app.state.dimension_resolver = DimensionResolver(dimension_index, CLUSTER_DIMENSION)
         
-    connector_repository = ConnectorRepository()
-    connectors = connector_repository.get_all_connectors()
-    for connector in connectors:
-        limit_config[f"connector:{connector['id']}"] = connector['max_concurrency']
-        print(f"Policy added for connector: {connector['id']} with limit: {connector['max_concurrency']}")
-    limit_config[CLUSTER_DIMENSION] = 10
+    # The cluster limit follows the observed errors, starting from 10
+    adaptive_config = {CLUSTER_DIMENSION: AdaptiveLimit(floor=CLUSTER_RESERVED_CAPACITY + 2, ceiling=50, initial=10)}
         
-    static_policy = StaticThrottlingPolicy(limit_config=limit_config)
+    # The limits are shared by the replicas through Redis and can be changed at runtime, the
+    # configured ones only fill in the dimensions that have no limit yet, until the account or
+    # connector settings change a limit
+    limit_store = RedisThrottlingPolicy(redis_client=app.state.redis_client)
+    await limit_store.seed_limits(limit_config)
+    await limit_store.start()
+    app.state.limit_store = limit_store
+    adaptive_policy = AdaptiveThrottlingPolicy(
+        redis_client=app.state.redis_client,
+        limit_config=adaptive_config,
+        fallback_policy=limit_store,
+    )
+    rate_limit_policy = RateLimitThrottlingPolicy(rate_config=rate_config, concurrency_policy=adaptive_policy)
+    
+    # Metrics of the dispatcher and the collector, and of the workers pulled from Redis on each scrape
+    app.state.metrics_registry = MetricsRegistry()
+    app.state.pipeline_metrics = PipelineMetrics(app.state.metrics_registry)
+    app.state.worker_metrics = WorkerMetrics(MetricsRegistry())
     dispatcher = ConcurrencyAwareArqDispatcher(
         arq=app.state.arq,
         redis_client=app.state.redis_client,
-        throttling_policy=static_policy,
+        throttling_policy=rate_limit_policy,
+        tenant_dimension="account",
+        tenant_weights=dimension_index.tenant_weights,
+        reserved_capacity={CLUSTER_DIMENSION: CLUSTER_RESERVED_CAPACITY},
+        metrics=app.state.pipeline_metrics,
+        quota_config=QuotaConfig(min_limit=QUOTA_MIN_LIMIT),
+        backpressure_config=BackpressureConfig(
+            max_backlog=MAX_DIMENSION_BACKLOG,
+            max_total_backlog=MAX_TOTAL_BACKLOG,
+            max_wait=MAX_QUEUE_WAIT,
+        ),
     )
     await dispatcher.start()
     app.state.dispatcher = dispatcher
+    app.state.coalescer = TaskCoalescer(app.state.redis_client, CODEC, max_cache_bytes=RESULT_CACHE_MAX_BYTES)
     
     result_collector = ArqJobResultCollector(
         redis_client=app.state.redis_client,
         dispatcher=dispatcher,
         on_result=handle_task_result,
+        metrics=app.state.pipeline_metrics,
+        coalescer=app.state.coalescer,
     )
     await result_collector.start()
     app.state.result_collector = result_collector
+    app.state.index_refresher = asyncio.create_task(refresh_dimension_index(dimension_index, limit_store, rate_limit_policy))
     
     yield
     
     # Shutdown
-    await app.state.arq.aclose()
-    await app.state.redis_client.close()
+    app.state.index_refresher.cancel()
+    # The dispatcher gives back its quota blocks and partitions on the way out, before the clients close
     await app.state.result_collector.stop()
     await app.state.dispatcher.stop()
+    await app.state.limit_store.stop()
+    await app.state.arq.aclose()
+    await app.state.redis_client.close()
 
 app = FastAPI(lifespan=lifespan)
 
+def build_task_metadata(task_name: str, task_data: dict, priority: int = PRIORITY_NORMAL, no_wait: bool = False, max_queue_age: float | None = None) -> dict:
+    """Build the dispatch metadata of a task, with the dimensions resolved from its payload and the cost declared by its task class."""
+    task_cls = TASK_CLASSES.get(task_name)
+    resolver: DimensionResolver = app.state.dimension_resolver
+    task_metadata = {
+        "_task_id": uuid.uuid4().hex,
+        "_concurrency_dimensions": resolver.resolve(task_cls, task_data),
+        "_priority": priority,
+        "_cost": task_cls.cost if task_cls else 1,
+    }
+    if no_wait:
+        task_metadata["_no_wait"] = True
+    if max_queue_age:
+        task_metadata["_max_queue_age"] = max_queue_age
+    result_cache_ttl = getattr(task_cls, "result_cache_ttl", 0)
+    if result_cache_ttl:
+        task_metadata["_coalesce_key"] = coalescing_key(task_name, task_data)
+        task_metadata["_coalesce_ttl"] = result_cache_ttl
+    return task_metadata
+
+async def coalesce(tasks: list[tuple[str, dict, dict]]) -> list[dict | None]:
+    """Answer the submissions of the tasks that opt in to coalescing with an identical task, None for the ones to dispatch."""
+    coalescer: TaskCoalescer = app.state.coalescer
+    answers = [None] * len(tasks)
+    indexes = [i for i, (_, _, task_metadata) in enumerate(tasks) if "_coalesce_key" in task_metadata]
+    if not indexes:
+        return answers
+    claims = await coalescer.claim_many([(tasks[i][2]["_coalesce_key"], tasks[i][2]["_task_id"]) for i in indexes])
+    for i, claim in zip(indexes, claims):
+        if claim.outcome == ATTACHED:
+            answers[i] = {"task_id": claim.task_id, "job_id": None, "outcome": COALESCED}
+        elif claim.outcome == CACHED:
+            answers[i] = {"task_id": claim.task_id, "job_id": None, "outcome": CACHED_RESULT, "result": claim.result}
+    return answers
+
+async def release_coalescing_key(task_metadata: dict):
+    """Give up the coalescing key of a task that was not dispatched, so identical submissions do not wait for it."""
+    if "_coalesce_key" in task_metadata:
+        await app.state.coalescer.complete(task_metadata["_coalesce_key"], task_metadata["_task_id"])
+
+def validate_task_data(task_name: str, task_data: dict):
+    """Validate the payload of a task against its input schema, before it takes any concurrency slot."""
+    task_cls = TASK_CLASSES.get(task_name)
+    if task_cls:
+        get_task_schema(task_cls).validate_input(task_data)
+
 class TaskSubmissionRequest(BaseModel):
     """Response model for task submission."""
     task_name: str
     task_data: dict
+    # Priority lane, 0 (high) is redispatched first and may use the reserved capacity
+    priority: int = Field(default=PRIORITY_NORMAL, ge=PRIORITY_HIGH)
+    # Reject the task with a 429 unless it is admitted right away, instead of queueing it
+    no_wait: bool = False
+    # Drop the task, reported as expired, if it is not admitted within this many seconds
+    max_queue_age: float | None = Field(default=None, gt=0)
 
 @app.post('/task/{task_name}')
 async def submit_task(request: TaskSubmissionRequest):
@@ -92,16 +263,198 @@ async def submit_task(request: TaskSubmissionRequest):
     """Submit a task to the queue."""
     task_name = request.task_name
     task_data = request.task_data
+    try:
+        validate_task_data(task_name, task_data)
+        task_metadata = build_task_metadata(task_name, task_data, request.priority, request.no_wait, request.max_queue_age)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False, include_context=False))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    # An identical idempotent task queued, running or cached answers the submission
+    answer, = await coalesce([(task_name, task_data, task_metadata)])
+    if answer:
+        return JSONResponse(answer)
+
+    # Dispatch the task, its ID follows it from the dispatcher queue to its arq job
+    try:
+        task_id = await dispatcher.dispatch(
+            task_name=task_name,
+            task_data=task_data,
+            task_metadata=task_metadata,
+        )
+    except Overloaded as e:
+        await release_coalescing_key(task_metadata)
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(max(math.ceil(e.retry_after), 1))})
+    except Exception:
+        await release_coalescing_key(task_metadata)
+        raise
+    
+    return JSONResponse({
+        'task_id': task_id,
+    })
 
-    # Dispatch the task
-    await dispatcher.dispatch(
-        task_name=task_name,
-        task_data=task_data,
-        task_metadata={
-            "_concurrency_dimensions": ["account:acct-001", "connector:conn-001", CLUSTER_DIMENSION],
-        }
+async def get_task_status_or_404(task_id: str) -> dict:
+    """Get the status of a task, or fail with a 404 if it is unknown or expired."""
+    task_status: TaskStatusStore = app.state.dispatcher.task_status
+    task = await task_status.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task {task_id!r}")
+    return task
+
+@app.get('/task/{task_id}')
+async def get_task(task_id: str):
+    """Get the state of a task, with the ID of its job once enqueued and its result once complete."""
+    return JSONResponse(jsonable_encoder(await get_task_status_or_404(task_id)))
+
+@app.get('/task/{task_id}/wait')
+async def wait_task(task_id: str, state: str | None = None, timeout: Annotated[float, Query(gt=0, le=TASK_WAIT_MAX_TIMEOUT)] = 30):
+    """Long-poll the state of a task: answer as soon as it differs from `state`, the last state seen by the client, or once the timeout expires."""
+    task_status: TaskStatusStore = app.state.dispatcher.task_status
+    task = await task_status.wait(task_id, state, timeout)
+    if task is None:
+        raise HTTPException(status_code=404, detail=f"Unknown task {task_id!r}")
+    return JSONResponse(jsonable_encoder(task))
+
+async def iter_task_events(task_status: TaskStatusStore, task: dict):
+    """Yield the state changes of a task as Server-Sent Events until it completes, with keepalive comments meanwhile."""
+    task_id = task["task_id"]
+    while True:
+        yield f"event: {task['state']}\ndata: {json.dumps(jsonable_encoder(task))}\n\n"
+        if task["state"] in FINAL_TASK_STATES:
+            return
+        state = task["state"]
+        while task["state"] == state:
+            task = await task_status.wait(task_id, state, TASK_EVENTS_HEARTBEAT_INTERVAL)
+            if task is None:
+                # The status expired
+                return
+            if task["state"] == state:
+                yield ": keepalive\n\n"
+
+@app.get('/task/{task_id}/events')
+async def stream_task_events(task_id: str):
+    """Stream the state changes of a task (deferred, enqueued, running, complete or expired) as Server-Sent Events, ending with its result."""
+    task = await get_task_status_or_404(task_id)
+    return StreamingResponse(
+        iter_task_events(app.state.dispatcher.task_status, task),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
+
+class LimitsUpdateRequest(BaseModel):
+    """Request model for a change of the concurrency limits."""
+    # Limit by dimension, None removes the limit of the dimension
+    limits: dict[str, Annotated[int, Field(ge=0)] | None]
+
+TaskSubmissionBatch = TypeAdapter(list[TaskSubmissionRequest])
+
+async def dispatch_submissions(dispatcher: ConcurrencyAwareArqDispatcher, submissions: list[TaskSubmissionRequest | ValidationError]) -> list[dict]:
+    """Dispatch a batch of task submissions, rejecting the malformed ones and the ones whose payload is invalid, and coalescing the identical ones."""
+    results = [None] * len(submissions)
+    tasks = []
+    task_indexes = []
+    for i, submission in enumerate(submissions):
+        if isinstance(submission, ValidationError):
+            # A malformed line of a streamed batch
+            results[i] = {"task_id": None, "job_id": None, "outcome": REJECTED, "error": str(submission)}
+            continue
+        try:
+            validate_task_data(submission.task_name, submission.task_data)
+            task_metadata = build_task_metadata(submission.task_name, submission.task_data, submission.priority, submission.no_wait, submission.max_queue_age)
+        except ValueError as e:
+            # Invalid payload, or unknown account or connector
+            results[i] = {"task_id": None, "job_id": None, "outcome": REJECTED, "error": str(e)}
+            continue
+        tasks.append((submission.task_name, submission.task_data, task_metadata))
+        task_indexes.append(i)
+    dispatched = []
+    for i, task, answer in zip(task_indexes, tasks, await coalesce(tasks)):
+        if answer:
+            results[i] = answer
+        else:
+            dispatched.append((i, task))
+    outcomes = await dispatcher.dispatch_many([task for _, task in dispatched], chunk_size=BATCH_CHUNK_SIZE)
+    for (i, (_, _, task_metadata)), result in zip(dispatched, outcomes):
+        if result["outcome"] == REJECTED:
+            await release_coalescing_key(task_metadata)
+        results[i] = result
+    return results
+
+async def iter_ndjson_lines(request: Request):
+    """Yield the non-empty lines of a streamed NDJSON body as they arrive."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+@app.post('/tasks/batch')
+async def submit_tasks(request: Request):
+    """Submit a batch of tasks, as a JSON array or as a streamed NDJSON body with one task per line, a malformed line being rejected on its own."""
+    dispatcher: ConcurrencyAwareArqDispatcher = app.state.dispatcher
+    results = []
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            # Dispatch while the body is still streaming, one chunk at a time
+            submissions = []
+            async for line in iter_ndjson_lines(request):
+                try:
+                    submissions.append(TaskSubmissionRequest.model_validate_json(line))
+                except ValidationError as e:
+                    # The tasks of the previous lines may be enqueued already, only this line is rejected
+                    submissions.append(e)
+                if len(submissions) >= BATCH_CHUNK_SIZE:
+                    results.extend(await dispatch_submissions(dispatcher, submissions))
+                    submissions = []
+            if submissions:
+                results.extend(await dispatch_submissions(dispatcher, submissions))
+        else:
+            submissions = TaskSubmissionBatch.validate_json(await request.body())
+            results = await dispatch_submissions(dispatcher, submissions)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False, include_context=False))
     
     return JSONResponse({
-        'task_id': uuid.uuid4().hex,
-    })
\ No newline at end of file
+        'results': results,
+    })
+
+@app.get('/leases/reclaimed')
+async def get_reclaimed_leases():
+    """Get the number of slot leases reclaimed after expiry, per dimension."""
+    dispatcher: ConcurrencyAwareArqDispatcher = app.state.dispatcher
+    return JSONResponse(await dispatcher.get_reclaimed_leases())
+
+@app.get('/metrics')
+async def get_metrics():
+    """Expose the metrics of the dispatcher, the result collector and the workers in the Prometheus text format."""
+    dispatcher: ConcurrencyAwareArqDispatcher = app.state.dispatcher
+    await dispatcher.collect_metrics()
+    worker_registry = app.state.worker_metrics.registry
+    await worker_registry.pull(app.state.redis_client, WORKER_METRICS_KEY)
+    return PlainTextResponse(app.state.metrics_registry.render() + worker_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get('/admin/limits')
+async def get_limits():
+    """Get the concurrency limits shared by the replicas, with their version."""
+    limit_store: RedisThrottlingPolicy = app.state.limit_store
+    await limit_store.reload()
+    return JSONResponse({
+        'version': limit_store.version,
+        'limits': limit_store.limits,
+    })
+
+@app.put('/admin/limits')
+async def update_limits(request: LimitsUpdateRequest):
+    """Change the concurrency limits of some dimensions on every replica, without a restart."""
+    limit_store: RedisThrottlingPolicy = app.state.limit_store
+    version = await limit_store.update_limits(request.limits)
+    logger.info("Limits changed to version %s: %s", version, request.limits)
+    return JSONResponse({
+        'version': version,
+        'limits': limit_store.limits,
+    })
@@ -0,0 +1,2 @@
+from .pipeline_metrics import WORKER_METRICS_KEY, PipelineMetrics, WorkerMetrics
+from .registry import Counter, Gauge, Histogram, MetricsRegistry
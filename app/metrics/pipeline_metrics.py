@@ -0,0 +1,138 @@
+import time
+
+from redis import Redis
+
+from .registry import MetricsRegistry
+
+# Redis hash the workers push their metrics to, pulled by the API on each scrape
+WORKER_METRICS_KEY = "metrics:worker"
+
+
+class PipelineMetrics:
+    """
+    Metrics of the throttling pipeline in the API process: admission by the dispatcher, occupancy
+    and backlog sampled on each scrape, and slot release by the result collector.
+    """
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self.admissions = registry.counter(
+            "throttler_admissions",
+            "Admission decisions, by outcome and by source (submit, redispatch or promote).",
+            ("outcome", "source"),
+        )
+        self.expired_tasks = registry.counter(
+            "throttler_expired_tasks",
+            "Tasks dropped past their deadline, by where they were dropped (submit, promote, redispatch or wait_list).",
+            ("source",),
+        )
+        self.admission_duration = registry.histogram(
+            "throttler_admission_duration_seconds",
+            "Duration of the admission round trip of a single task.",
+            ("source",),
+        )
+        self.submit_to_enqueue = registry.histogram(
+            "throttler_submit_to_enqueue_seconds",
+            "Time from the submission of a task to its arq job being enqueued.",
+        )
+        self.dimension_usage = registry.gauge(
+            "throttler_dimension_usage",
+            "Units of concurrency held on the dimension, the total cost of its slot leases.",
+            ("dimension",),
+        )
+        self.dimension_limit = registry.gauge(
+            "throttler_dimension_limit",
+            "Concurrency limit of the dimension given by the throttling policy.",
+            ("dimension",),
+        )
+        self.waiting_tasks = registry.gauge(
+            "throttler_waiting_tasks",
+            "Tasks parked in the wait lists of the dimension, by priority lane.",
+            ("dimension", "priority"),
+        )
+        self.oldest_waiting_age = registry.gauge(
+            "throttler_oldest_waiting_task_age_seconds",
+            "Age of the oldest task at the head of a wait list of the dimension.",
+            ("dimension",),
+        )
+        self.estimated_wait = registry.gauge(
+            "throttler_estimated_wait_seconds",
+            "Estimated wait of a task joining the backlog of the dimension, from its recent drain rate.",
+            ("dimension",),
+        )
+        self.delayed_tasks = registry.gauge(
+            "throttler_delayed_tasks",
+            "Tasks in the delayed queue, deferred to a later time or by a rate limit.",
+        )
+        self.inflight_jobs = registry.gauge(
+            "throttler_inflight_jobs",
+            "Jobs enqueued and not collected yet.",
+        )
+        self.quota_units = registry.gauge(
+            "throttler_quota_block_units",
+            "Units of the dimension leased by this dispatcher replica as a quota block, counted in its usage.",
+            ("dimension",),
+        )
+        self.completions = registry.counter(
+            "throttler_completions",
+            "Jobs whose slots were released by the result collector, by source (stream or sweep) and status.",
+            ("source", "status"),
+        )
+        self.collector_lag = registry.histogram(
+            "throttler_collector_lag_seconds",
+            "Time from the end of a job to the release of its slots by the result collector.",
+        )
+        self.lock_acquisitions = registry.counter(
+            "throttler_collector_lock_acquisitions",
+            "Attempts at the sweep lock of the result collectors, by outcome (acquired or busy).",
+            ("outcome",),
+        )
+        self.lock_wait = registry.histogram(
+            "throttler_collector_lock_wait_seconds",
+            "Time spent waiting for the sweep lock of the result collectors.",
+        )
+
+
+class WorkerMetrics:
+    """
+    Metrics of the task runs in a worker, pushed to Redis at most once per push interval.
+    """
+    def __init__(self, registry: MetricsRegistry, push_interval: float = 5.0, key: str = WORKER_METRICS_KEY):
+        """
+        Args:
+            registry (MetricsRegistry): The registry the metrics are defined in.
+            push_interval (float): The minimum time in seconds between two pushes to Redis.
+            key (str): The Redis hash the metrics are pushed to.
+        """
+        self.registry = registry
+        self.push_interval = push_interval
+        self.key = key
+        self._pushed_at = 0.0
+        self.runs = registry.counter(
+            "throttler_task_runs",
+            "Task tries run by the workers, by task and status (success, retry or failure).",
+            ("task", "status"),
+        )
+        self.enqueue_to_start = registry.histogram(
+            "throttler_enqueue_to_start_seconds",
+            "Time from a job being enqueued to the start of its first try.",
+            ("task",),
+        )
+        self.start_to_finish = registry.histogram(
+            "throttler_start_to_finish_seconds",
+            "Run time of a task try.",
+            ("task", "status"),
+        )
+
+    async def maybe_push(self, redis_client: Redis):
+        """
+        Push the metrics to Redis if the push interval has elapsed since the previous push.
+        """
+        if time.monotonic() - self._pushed_at >= self.push_interval:
+            await self.push(redis_client)
+
+    async def push(self, redis_client: Redis):
+        """
+        Push the metrics to Redis, e.g. when the worker shuts down.
+        """
+        self._pushed_at = time.monotonic()
+        await self.registry.push(redis_client, self.key)
@@ -0,0 +1,221 @@
+import json
+import math
+from abc import ABC, abstractmethod
+
+from redis import Redis
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 3600.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class Metric(ABC):
+    """
+    A metric family with a value per combination of label values, in the Prometheus data model.
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _label_values(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+    @abstractmethod
+    def samples(self) -> list[tuple[str, dict, float]]:
+        """Return the samples of the family, as (name suffix, labels, value)."""
+        pass
+
+    @abstractmethod
+    def state(self) -> dict[tuple, list[float]]:
+        """Return the cumulative state by label values, a list of additive slots."""
+        pass
+
+    @abstractmethod
+    def load(self, state: dict[tuple, list[float]]):
+        """Replace the state by label values with the one given, as returned by `state`."""
+        pass
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        return [("_total", dict(zip(self.labelnames, key)), value) for key, value in sorted(self._values.items())]
+
+    def state(self) -> dict[tuple, list[float]]:
+        return {key: [value] for key, value in self._values.items()}
+
+    def load(self, state: dict[tuple, list[float]]):
+        self._values = {key: slots[0] for key, slots in state.items()}
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._label_values(labels)] = value
+
+    def clear(self):
+        """Drop every value, for gauges sampled again as a whole on each scrape."""
+        self._values = {}
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        return [("", dict(zip(self.labelnames, key)), value) for key, value in sorted(self._values.items())]
+
+    def state(self) -> dict[tuple, list[float]]:
+        # A gauge is a point in time value, it can not be added up across processes
+        return {}
+
+    def load(self, state: dict[tuple, list[float]]):
+        pass
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Count per bucket (not cumulative), then sum and count
+        self._values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        slots = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                slots[i] += 1
+                break
+        slots[-2] += value
+        slots[-1] += 1
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        samples = []
+        for key, slots in sorted(self._values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, slots):
+                cumulative += count
+                samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append(("_sum", labels, slots[-2]))
+            samples.append(("_count", labels, slots[-1]))
+        return samples
+
+    def state(self) -> dict[tuple, list[float]]:
+        return {key: list(slots) for key, slots in self._values.items()}
+
+    def load(self, state: dict[tuple, list[float]]):
+        size = len(self.buckets) + 2
+        # Only the slots that changed are pushed, the others are left out of the state
+        self._values = {key: list(slots) + [0] * (size - len(slots)) for key, slots in state.items() if len(slots) <= size}
+
+
+class MetricsRegistry:
+    """
+    In-process metrics, rendered in the Prometheus text format.
+
+    The counters and histograms of processes that are not scraped, like the workers, are pushed
+    to a Redis hash and pulled by the process serving `/metrics` into a registry defining the same
+    metrics. Each push only adds what changed since the previous one, so the processes sharing the
+    hash are added up.
+    """
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._pushed: dict[str, dict[tuple, list[float]]] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n" if lines else ""
+
+    async def push(self, redis_client: Redis, key: str):
+        """
+        Add the changes of the counters and histograms since the previous push to the Redis hash.
+        """
+        async with redis_client.pipeline(transaction=False) as pipe:
+            changed = False
+            for name, metric in self._metrics.items():
+                pushed = self._pushed.setdefault(name, {})
+                for label_values, slots in metric.state().items():
+                    previous = pushed.get(label_values, [0] * len(slots))
+                    for slot, (value, before) in enumerate(zip(slots, previous)):
+                        if value != before:
+                            pipe.hincrbyfloat(key, json.dumps([name, label_values, slot]), value - before)
+                            changed = True
+                    pushed[label_values] = slots
+            if changed:
+                await pipe.execute()
+
+    async def pull(self, redis_client: Redis, key: str):
+        """
+        Replace the state of the counters and histograms with the totals pushed to the Redis hash.
+        """
+        states: dict[str, dict[tuple, list[float]]] = {}
+        for field, value in (await redis_client.hgetall(key)).items():
+            name, label_values, slot = json.loads(field)
+            metric = self._metrics.get(name)
+            if metric is None:
+                # Pushed by a process running another version, with other metrics
+                continue
+            slots = states.setdefault(name, {}).setdefault(tuple(label_values), [])
+            slots.extend([0] * (slot + 1 - len(slots)))
+            slots[slot] = float(value)
+        for name, metric in self._metrics.items():
+            metric.load(states.get(name, {}))
@@ -1 +1,3 @@
 from .account_service import AccountService
+from .dimension_resolver import (DimensionIndex, DimensionResolver,
+                                 pool_dimension)
@@ -0,0 +1,135 @@
+import logging
+
+from persistence import ConnectorRepository
+
+from .account_service import AccountService
+
+logger = logging.getLogger(__name__)
+
+
+def pool_dimension(tier: int) -> str:
+    """
+    Return the dimension of the capacity pool shared by the accounts of a cluster tier.
+    """
+    return f"pool:tier-{tier}"
+
+
+class DimensionIndex:
+    """
+    In-memory index of the accounts, with the pool of their cluster tier, and of the connectors.
+
+    Loaded once from the account service and the connector repository, then refreshed by applying
+    the entries added, changed or removed since the previous load, so that resolving the dimensions
+    of a task never calls them.
+    """
+    def __init__(self, account_service: AccountService, connector_repository: ConnectorRepository, tier_pool_limits: dict[int, int] = None, tier_weights: dict[int, float] = None):
+        """
+        Args:
+            account_service (AccountService): The source of the accounts.
+            connector_repository (ConnectorRepository): The source of the connectors.
+            tier_pool_limits (dict): The concurrency limit of the pool of each cluster tier, the accounts of the other tiers share no pool.
+            tier_weights (dict): The share of the cluster capacity of an account, by cluster tier, 1 for the other tiers.
+        """
+        self.account_service = account_service
+        self.connector_repository = connector_repository
+        self.tier_pool_limits = tier_pool_limits or {}
+        self.tier_weights = tier_weights or {}
+        self.accounts: dict[str, dict] = {}
+        self.connectors: dict[str, dict] = {}
+        # Pool dimension of each account, None if its tier has no pool
+        self.account_pools: dict[str, str | None] = {}
+        # Updated in place, so the dispatcher sharing it sees the accounts added later
+        self.tenant_weights: dict[str, float] = {}
+
+    def refresh(self) -> dict[str, int]:
+        """
+        Apply the changes of the accounts and connectors since the previous refresh.
+
+        Returns:
+            dict[str, int]: The concurrency limits of the dimensions added or changed.
+        """
+        limits = {}
+        if not self.accounts:
+            # First load, the tier pools come with it
+            limits.update({pool_dimension(tier): limit for tier, limit in self.tier_pool_limits.items()})
+        accounts = {account["id"]: account for account in self.account_service.get_all_accounts()}
+        for account_id, account in accounts.items():
+            previous = self.accounts.get(account_id)
+            if previous == account:
+                continue
+            self.accounts[account_id] = account
+            tier = account["cluster_tier"]
+            self.account_pools[account_id] = pool_dimension(tier) if tier in self.tier_pool_limits else None
+            self.tenant_weights[account_id] = self.tier_weights.get(tier, 1.0)
+            if previous is None or previous["max_concurrency"] != account["max_concurrency"]:
+                limits[f"account:{account_id}"] = account["max_concurrency"]
+        for account_id in self.accounts.keys() - accounts.keys():
+            del self.accounts[account_id]
+            del self.account_pools[account_id]
+            del self.tenant_weights[account_id]
+
+        connectors = {connector["id"]: connector for connector in self.connector_repository.get_all_connectors()}
+        for connector_id, connector in connectors.items():
+            previous = self.connectors.get(connector_id)
+            if previous == connector:
+                continue
+            self.connectors[connector_id] = connector
+            if previous is None or previous["max_concurrency"] != connector["max_concurrency"]:
+                limits[f"connector:{connector_id}"] = connector["max_concurrency"]
+        for connector_id in self.connectors.keys() - connectors.keys():
+            del self.connectors[connector_id]
+
+        if limits:
+            logger.info("Dimension index refreshed, %d dimension(s) added or changed.", len(limits))
+        return limits
+
+    def rate_limits(self) -> dict[str, float]:
+        """
+        Return the rate limits of the connectors that have one, in tasks per second.
+        """
+        return {f"connector:{connector_id}": connector["max_rate"] for connector_id, connector in self.connectors.items() if connector.get("max_rate")}
+
+
+class DimensionResolver:
+    """
+    Resolve the concurrency dimensions of a task from its payload, following the dimension fields
+    declared on its task class, with dictionary lookups in the dimension index.
+    """
+    def __init__(self, index: DimensionIndex, cluster_dimension: str = "cluster"):
+        """
+        Args:
+            index (DimensionIndex): The index of the accounts and connectors.
+            cluster_dimension (str): The dimension every task is throttled on.
+        """
+        self.index = index
+        self.cluster_dimension = cluster_dimension
+
+    def resolve(self, task_cls: type | None, payload: dict) -> list[str]:
+        """
+        Return the dimensions of a task: its account and the pool of the account tier, its connector,
+        any other dimension declared by its task class, then the cluster. The account comes first,
+        it is the tenant of the task.
+
+        Raises:
+            ValueError: If the payload names an account or connector that does not exist.
+        """
+        dimensions = []
+        for dimension_type, field in (getattr(task_cls, "dimension_fields", None) or {}).items():
+            value = payload.get(field)
+            if value is None:
+                continue
+            if dimension_type == "account":
+                if value not in self.index.accounts:
+                    raise ValueError(f"Unknown account {value!r}")
+                dimensions.insert(0, f"account:{value}")
+                pool = self.index.account_pools[value]
+                if pool:
+                    dimensions.insert(1, pool)
+            elif dimension_type == "connector":
+                if value not in self.index.connectors:
+                    raise ValueError(f"Unknown connector {value!r}")
+                dimensions.append(f"connector:{value}")
+            else:
+                dimensions.append(f"{dimension_type}:{value}")
+        dimensions.append(self.cluster_dimension)
+        return dimensions
@@ -9,6 +9,15 @@ class BaseTask(ABC):
     retry_delay: int = 10
     max_retries: int = 3
     timeout: int = 60 # 1 minute
+    # Units of concurrency taken on each dimension, or a map keyed by dimension name or type (e.g. {"connector": 5})
+    cost: int | dict[str, int] = 1
+    # Where run is executed: "async" on the worker event loop, "thread" or "process" in the worker pools for
+    # blocking code, in which case run may be a plain function. Process tasks only get job_id, job_try and
+    # cancel_event in their context.
+    execution_mode: str = "async"
+    # Payload field naming the entity of each dimension type the task is throttled on, a task without
+    # the field is not throttled on that type. Accounts also take a slot in the pool of their cluster tier.
+    dimension_fields: dict[str, str] = {"account": "account_id", "connector": "connector_id"}
     input_schema: list[TaskIoField] = []
     output_schema: list[TaskIoField] = []
     
@@ -17,6 +26,13 @@ class BaseTask(ABC):
         self.payload = payload
         self.metadata = metadata
 
+    def is_cancelled(self) -> bool:
+        """
+        Return True once the job timed out or was aborted, for tasks running in a worker pool to stop early.
+        """
+        cancel_event = self.ctx.get('cancel_event')
+        return cancel_event is not None and cancel_event.is_set()
+
     @abstractmethod
     async def run(self) -> Dict:
         """
@@ -36,6 +52,9 @@ class AppIdempotentBaseTask(BaseTask):
 
     Workers must be able to retry the task without causing side effects.
     """
+    # Opt-in coalescing: identical submissions (same task and payload) share the job queued or running,
+    # and the result of a successful job is served to them for this many seconds. 0 disables it.
+    result_cache_ttl: int = 0
     
 class SideEffectBaseTask(BaseTask):
     """
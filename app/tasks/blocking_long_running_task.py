@@ -1,3 +1,5 @@
+import time
+
 from tasks.base_task import AppIdempotentBaseTask
 
 
@@ -6,15 +8,19 @@ class BlockingLongRunningTask(AppIdempotentBaseTask):
     Task to simulate a blocking long-running task.
     """
     name = 'long_running_task_block'
+    # Run in the worker thread pool, so the blocking sleep does not stall the event loop
+    execution_mode = 'thread'
 
-    async def run(self) -> str:
+    def run(self) -> str:
         """
         Run the blocking long-running task.
 
         Returns:
             str: The result of the task execution.
         """
-        # Simulate a blocking long-running task
-        import time
-        time.sleep(10)  # Blocking sleep for 10 seconds
+        # Simulate a blocking long-running task, stopping early if the job is cancelled
+        for _ in range(10):
+            if self.is_cancelled():
+                return "Blocking long-running task cancelled."
+            time.sleep(1)  # Blocking sleep for 1 second
         return "Blocking long-running task completed."
\ No newline at end of file
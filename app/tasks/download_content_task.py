@@ -6,6 +6,8 @@ class DownloadContentTask(AppIdempotentBaseTask):
     Task to download content from a URL.
     """
     name = 'download_content'
+    # The same URL is often submitted again within seconds
+    result_cache_ttl = 60
 
     async def run(self) -> int:
         """
@@ -1 +1,2 @@
-from .task_io_field import TaskIoField
\ No newline at end of file
+from .task_io_field import TaskIoField
+from .task_schema import TaskSchema, get_task_schema
\ No newline at end of file
@@ -0,0 +1,46 @@
+from functools import cache
+
+from pydantic import BaseModel, create_model
+
+from .task_io_field import TaskIoField
+
+
+class TaskSchema:
+    """
+    Input and output validators of a task class, compiled once.
+
+    An empty schema compiles to no model at all, and the payload or result passes through as is.
+    """
+    def __init__(self, name: str, input_schema: list[TaskIoField], output_schema: list[TaskIoField]):
+        self.input_model = self._compile(f"{name}InputModel", input_schema)
+        self.output_model = self._compile(f"{name}OutputModel", output_schema)
+
+    @staticmethod
+    def _compile(model_name: str, fields: list[TaskIoField]) -> type[BaseModel] | None:
+        if not fields:
+            return None
+        return create_model(model_name, **{field.name: (field.type, ...) for field in fields})
+
+    def validate_input(self, payload: dict) -> dict:
+        """
+        Validate the payload of a task, raising a ValidationError if it does not match the input schema.
+        """
+        if self.input_model is None:
+            return payload
+        return self.input_model.model_validate(payload).model_dump()
+
+    def validate_output(self, result):
+        """
+        Validate the result of a task, raising a ValidationError if it does not match the output schema.
+        """
+        if self.output_model is None:
+            return result
+        return self.output_model.model_validate(result).model_dump()
+
+
+@cache
+def get_task_schema(task_cls: type) -> TaskSchema:
+    """
+    Return the compiled schema of a task class, compiling it on first use.
+    """
+    return TaskSchema(task_cls.name or task_cls.__name__, task_cls.input_schema, task_cls.output_schema)
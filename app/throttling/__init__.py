@@ -1,2 +1,5 @@
-from .policy_base import ThrottlingPolicy
+from .adaptive_policy import AdaptiveLimit, AdaptiveThrottlingPolicy
+from .policy_base import RateLimit, ThrottlingPolicy
+from .rate_limit_policy import RateLimitThrottlingPolicy
+from .redis_policy import RedisThrottlingPolicy
 from .static_policy import StaticThrottlingPolicy
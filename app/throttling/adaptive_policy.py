@@ -0,0 +1,141 @@
+import logging
+from typing import Awaitable, Callable, NamedTuple
+
+from redis import Redis
+from throttling.policy_base import ThrottlingPolicy
+
+logger = logging.getLogger(__name__)
+
+# Additive increase, multiplicative decrease of the limit of a dimension. The
+# limit is kept as a float so that each healthy completion adds increase/limit,
+# about `increase` per window of `limit` completions. A cut happens at most
+# once per cooldown, the completions of the window that overloaded the
+# dimension must not collapse the limit down to the floor.
+#
+# KEYS[1]  adaptive limits hash, limit and last cut time in ms by dimension
+# ARGV[1]  dimension name
+# ARGV[2]  initial limit
+# ARGV[3]  floor
+# ARGV[4]  ceiling
+# ARGV[5]  additive increase
+# ARGV[6]  multiplicative decrease factor
+# ARGV[7]  decrease cooldown in ms
+# ARGV[8]  1 if the completion was healthy, 0 otherwise
+#
+# Returns the new limit, as a string since Lua numbers are truncated to integers.
+OBSERVE_SCRIPT = """
+local limit = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or ARGV[2])
+if ARGV[8] == '1' then
+    limit = math.min(tonumber(ARGV[4]), limit + tonumber(ARGV[5]) / limit)
+else
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+    local cut_at = tonumber(redis.call('HGET', KEYS[1], ARGV[1] .. ':cut_at') or 0)
+    if now - cut_at < tonumber(ARGV[7]) then
+        return tostring(limit)
+    end
+    limit = math.max(tonumber(ARGV[3]), limit * tonumber(ARGV[6]))
+    redis.call('HSET', KEYS[1], ARGV[1] .. ':cut_at', now)
+end
+redis.call('HSET', KEYS[1], ARGV[1], tostring(limit))
+return tostring(limit)
+"""
+
+
+class AdaptiveLimit(NamedTuple):
+    # Lowest and highest concurrency limits
+    floor: int
+    ceiling: int
+    # Limit until the first completion is observed, the ceiling by default
+    initial: int | None = None
+    # Run time in seconds above which a completion counts as overload, None to only react to errors
+    latency_target: float | None = None
+
+
+class AdaptiveThrottlingPolicy(ThrottlingPolicy):
+    def __init__(self, redis_client: Redis, limit_config: dict, increase: float = 1.0, decrease_factor: float = 0.5, decrease_cooldown: float = 5.0, key: str = "throttling:adaptive-limits", fallback_policy: ThrottlingPolicy = None):
+        """
+        limit_config: {
+            "connector:conn-001": AdaptiveLimit(floor=1, ceiling=10, latency_target=2.0),
+            "cluster": AdaptiveLimit(floor=5, ceiling=100, initial=10)
+        }
+        increase: limit added per window of healthy completions
+        decrease_factor: factor applied to the limit on an error or a completion slower than the latency target
+        decrease_cooldown: minimum time in seconds between two decreases of a dimension
+        key: the Redis hash sharing the limits across the replicas
+        fallback_policy: the policy enforcing the limits of the dimensions without an adaptive limit
+        """
+        self.redis_client = redis_client
+        self.adaptive_limits = limit_config
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.key = key
+        self.fallback_policy = fallback_policy
+        self.limits = {dimension: self._initial_limit(dimension) for dimension in limit_config}
+        self._observe_script = redis_client.register_script(OBSERVE_SCRIPT)
+        self._limit_listeners: list[Callable[[list[str]], Awaitable[None]]] = []
+
+    def get_limit(self, dimension: str) -> int | None:
+        limit = self.limits.get(dimension)
+        if limit is None:
+            return self.fallback_policy.get_limit(dimension) if self.fallback_policy else None
+        return int(limit)
+
+    async def refresh(self):
+        if self.fallback_policy:
+            await self.fallback_policy.refresh()
+        shared_limits = await self.redis_client.hmget(self.key, list(self.adaptive_limits)) if self.adaptive_limits else []
+        changed = []
+        for dimension, limit in zip(self.adaptive_limits, shared_limits):
+            if self._set_limit(dimension, self._initial_limit(dimension) if limit is None else float(limit)):
+                changed.append(dimension)
+        if changed:
+            await self._notify(changed)
+
+    async def record_completion(self, dimension: str, latency: float, success: bool):
+        adaptive_limit = self.adaptive_limits.get(dimension)
+        if adaptive_limit is None:
+            if self.fallback_policy:
+                await self.fallback_policy.record_completion(dimension, latency, success)
+            return
+        healthy = success and (adaptive_limit.latency_target is None or latency <= adaptive_limit.latency_target)
+        limit = await self._observe_script(
+            keys=[self.key],
+            args=[
+                dimension,
+                self._initial_limit(dimension),
+                adaptive_limit.floor,
+                adaptive_limit.ceiling,
+                self.increase,
+                self.decrease_factor,
+                int(self.decrease_cooldown * 1000),
+                1 if healthy else 0,
+            ],
+        )
+        if self._set_limit(dimension, float(limit)):
+            await self._notify([dimension])
+
+    def add_limit_listener(self, listener: Callable[[list[str]], Awaitable[None]]):
+        self._limit_listeners.append(listener)
+        if self.fallback_policy:
+            self.fallback_policy.add_limit_listener(listener)
+
+    def _set_limit(self, dimension: str, limit: float) -> bool:
+        """
+        Set the limit of the dimension, returning True if the enforced limit, its integer part, changed.
+        """
+        previous = self.limits.get(dimension)
+        self.limits[dimension] = limit
+        return previous is None or int(previous) != int(limit)
+
+    async def _notify(self, dimensions: list[str]):
+        for listener in self._limit_listeners:
+            try:
+                await listener(dimensions)
+            except Exception as e:
+                logger.warning("Failed to pass on the limit changes of %s: %s", dimensions, e)
+
+    def _initial_limit(self, dimension: str) -> float:
+        adaptive_limit = self.adaptive_limits[dimension]
+        return float(adaptive_limit.ceiling if adaptive_limit.initial is None else adaptive_limit.initial)
@@ -1,8 +1,39 @@
+import warnings
 from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, NamedTuple
+
+
+class RateLimit(NamedTuple):
+    # Tokens added per second
+    rate: float
+    # Maximum number of tokens available at once
+    burst: int = 1
 
 
 class ThrottlingPolicy(ABC):
     @abstractmethod
-    def is_allowed(self, dimension: str, current: int) -> bool:
-        """Return True if task is allowed based on current usage."""
-        pass
\ No newline at end of file
+    def get_limit(self, dimension: str) -> int | None:
+        """Return the concurrency limit enforced by the admission script, None if unlimited."""
+        pass
+
+    def is_allowed(self, dimension: str, current: int, cost: int = 1) -> bool:
+        """Deprecated, the admission script enforces the limit from get_limit. Return True if a task of the given cost fits in the limit."""
+        warnings.warn("is_allowed is deprecated and never called by the dispatcher, implement get_limit instead", DeprecationWarning, stacklevel=2)
+        limit = self.get_limit(dimension)
+        return (limit is None) or (current + cost <= limit)
+
+    def get_rate_limit(self, dimension: str) -> RateLimit | None:
+        """Return the rate limit enforced by the admission script, None if unlimited."""
+        return None
+
+    async def refresh(self):
+        """Reload the limits shared through Redis, called periodically by the dispatcher."""
+        pass
+
+    async def record_completion(self, dimension: str, latency: float, success: bool):
+        """Feed the outcome of a job completed on the dimension, with its run time in seconds."""
+        pass
+
+    def add_limit_listener(self, listener: Callable[[list[str]], Awaitable[None]]):
+        """Call the listener with the dimensions whose limit changed, e.g. to wake the tasks waiting on them."""
+        pass
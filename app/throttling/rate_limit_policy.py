@@ -0,0 +1,37 @@
+from typing import Awaitable, Callable
+
+from throttling.policy_base import RateLimit, ThrottlingPolicy
+
+
+class RateLimitThrottlingPolicy(ThrottlingPolicy):
+    def __init__(self, rate_config: dict, concurrency_policy: ThrottlingPolicy = None):
+        """
+        rate_config: {
+            "connector:conn-001": 5,                              # 5 tasks per second
+            "account:acct-001": RateLimit(rate=10, burst=20)      # 10 tasks per second, bursts of 20
+        }
+        concurrency_policy: the policy enforcing the concurrency limits of the same dimensions
+        """
+        self.rate_limits = {
+            dimension: rate_limit if isinstance(rate_limit, RateLimit) else RateLimit(rate=rate_limit)
+            for dimension, rate_limit in rate_config.items()
+        }
+        self.concurrency_policy = concurrency_policy
+
+    def get_limit(self, dimension: str) -> int | None:
+        return self.concurrency_policy.get_limit(dimension) if self.concurrency_policy else None
+
+    def get_rate_limit(self, dimension: str) -> RateLimit | None:
+        return self.rate_limits.get(dimension)
+
+    async def refresh(self):
+        if self.concurrency_policy:
+            await self.concurrency_policy.refresh()
+
+    async def record_completion(self, dimension: str, latency: float, success: bool):
+        if self.concurrency_policy:
+            await self.concurrency_policy.record_completion(dimension, latency, success)
+
+    def add_limit_listener(self, listener: Callable[[list[str]], Awaitable[None]]):
+        if self.concurrency_policy:
+            self.concurrency_policy.add_limit_listener(listener)
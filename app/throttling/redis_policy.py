@@ -0,0 +1,180 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from redis import Redis
+from throttling.policy_base import ThrottlingPolicy
+
+logger = logging.getLogger(__name__)
+
+# Change limits, bump the version and notify the replicas in one step, so a
+# replica that reads the version always reads the limits that go with it.
+#
+# KEYS[1]  limits hash, limit by dimension
+# KEYS[2]  version counter
+# ARGV[1]  invalidation channel
+# ARGV[2k], ARGV[2k+1]  dimension and limit, an empty limit removes the dimension
+#
+# Returns the new version.
+UPDATE_LIMITS_SCRIPT = """
+for i = 2, #ARGV, 2 do
+    if ARGV[i + 1] == '' then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    else
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+local version = redis.call('INCR', KEYS[2])
+redis.call('PUBLISH', ARGV[1], version)
+return version
+"""
+
+# Add the limits of the dimensions that have none yet, keeping the ones
+# changed at runtime, and bump the version if any was added.
+#
+# KEYS[1]  limits hash
+# KEYS[2]  version counter
+# ARGV[1]  invalidation channel
+# ARGV[2k], ARGV[2k+1]  dimension and default limit
+#
+# Returns the current version.
+SEED_LIMITS_SCRIPT = """
+local added = 0
+for i = 2, #ARGV, 2 do
+    added = added + redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+if added > 0 then
+    local version = redis.call('INCR', KEYS[2])
+    redis.call('PUBLISH', ARGV[1], version)
+    return version
+end
+return tonumber(redis.call('GET', KEYS[2]) or 0)
+"""
+
+
+class RedisThrottlingPolicy(ThrottlingPolicy):
+    def __init__(self, redis_client: Redis, key: str = "throttling:limits", fallback_policy: ThrottlingPolicy = None):
+        """
+        key: the Redis hash of the limits by dimension, e.g. {"account:acct-001": "10", "cluster": "100"},
+            with its version counter at `{key}:version` and its invalidation channel at `{key}:changes`
+        fallback_policy: the policy enforcing the limits of the dimensions missing from the hash
+
+        The limits are cached in memory and looked up without any Redis read. The cache is reloaded
+        as soon as a change is published on the invalidation channel, and `refresh` compares the
+        versions as a fallback for the changes missed while the subscription was down. The limit
+        listeners are called with the dimensions whose limit changed on each reload.
+        """
+        self.redis_client = redis_client
+        self.key = key
+        self.version_key = f"{key}:version"
+        self.channel = f"{key}:changes"
+        self.fallback_policy = fallback_policy
+        self.limits: dict[str, int] = {}
+        self.version: int | None = None
+        self._update_script = redis_client.register_script(UPDATE_LIMITS_SCRIPT)
+        self._seed_script = redis_client.register_script(SEED_LIMITS_SCRIPT)
+        self._listener: asyncio.Task | None = None
+        self._limit_listeners: list[Callable[[list[str]], Awaitable[None]]] = []
+
+    def get_limit(self, dimension: str) -> int | None:
+        limit = self.limits.get(dimension)
+        if limit is None:
+            return self.fallback_policy.get_limit(dimension) if self.fallback_policy else None
+        return limit
+
+    async def refresh(self):
+        if self.fallback_policy:
+            await self.fallback_policy.refresh()
+        version = int(await self.redis_client.get(self.version_key) or 0)
+        if version != self.version:
+            await self.reload()
+
+    async def record_completion(self, dimension: str, latency: float, success: bool):
+        if self.fallback_policy:
+            await self.fallback_policy.record_completion(dimension, latency, success)
+
+    def add_limit_listener(self, listener: Callable[[list[str]], Awaitable[None]]):
+        self._limit_listeners.append(listener)
+        if self.fallback_policy:
+            self.fallback_policy.add_limit_listener(listener)
+
+    async def reload(self):
+        """
+        Reload the limits and their version in one transaction, then pass the dimensions whose
+        limit changed since the previous load to the limit listeners.
+        """
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.get(self.version_key)
+            pipe.hgetall(self.key)
+            version, limits = await pipe.execute()
+        previous, loaded = self.limits, self.version is not None
+        self.limits = {dimension.decode(): int(limit) for dimension, limit in limits.items()}
+        self.version = int(version or 0)
+        changed = [dimension for dimension in previous.keys() | self.limits.keys() if previous.get(dimension) != self.limits.get(dimension)]
+        if loaded and changed:
+            await self._notify(changed)
+
+    async def _notify(self, dimensions: list[str]):
+        for listener in self._limit_listeners:
+            try:
+                await listener(dimensions)
+            except Exception as e:
+                logger.warning("Failed to pass on the limit changes of %s: %s", dimensions, e)
+
+    async def start(self):
+        """
+        Load the limits, then reload them on each change published by any replica.
+        """
+        await self.reload()
+        pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.channel)
+        self._listener = asyncio.create_task(self._listen(pubsub))
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+
+    async def _listen(self, pubsub):
+        try:
+            while True:
+                try:
+                    message = await pubsub.get_message(timeout=None)
+                    if message and int(message["data"]) != self.version:
+                        await self.reload()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # The version check of refresh catches up with the changes missed meanwhile
+                    logger.warning("Failed to listen to the limit changes: %s", e)
+                    await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+    async def update_limits(self, limits: dict[str, int | None]) -> int:
+        """
+        Set the limits of the dimensions, removing the ones set to None, for every replica.
+
+        Returns:
+            int: The new version of the limits.
+        """
+        args = [self.channel]
+        for dimension, limit in limits.items():
+            args.extend([dimension, "" if limit is None else int(limit)])
+        version = await self._update_script(keys=[self.key, self.version_key], args=args)
+        await self.reload()
+        return version
+
+    async def seed_limits(self, limits: dict[str, int]) -> int:
+        """
+        Set the default limits of the dimensions that have none yet, keeping the limits changed at runtime.
+
+        Returns:
+            int: The current version of the limits.
+        """
+        args = [self.channel]
+        for dimension, limit in limits.items():
+            args.extend([dimension, int(limit)])
+        version = await self._seed_script(keys=[self.key, self.version_key], args=args)
+        await self.reload()
+        return version
@@ -12,9 +12,5 @@ class StaticThrottlingPolicy(ThrottlingPolicy):
         """
         self.limits = limit_config
 
-    def is_allowed(self, dimension: str, current: int) -> bool:
-        limit = self._get_limit(dimension)
-        return (limit is None) or (current < limit)
-
-    def _get_limit(self, dimension: str) -> int:
-        return self.limits.get(dimension, float("inf"))
\ No newline at end of file
+    def get_limit(self, dimension: str) -> int | None:
+        return self.limits.get(dimension)
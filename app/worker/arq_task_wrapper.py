@@ -1,6 +1,125 @@
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+
 from arq import Retry, func
-from pydantic import ValidationError, create_model
-from tasks.base_task import AppIdempotentBaseTask, SideEffectBaseTask
+from dispatcher import TASK_RUNNING
+from pydantic import ValidationError
+from tasks.base_task import (AppIdempotentBaseTask, BaseTask,
+                             SideEffectBaseTask)
+from tasks.schema import get_task_schema
+
+# Extra lease time on top of the task timeout and retry delay, covering the queueing before the next try
+LEASE_GRACE_SECONDS = 60
+
+EXECUTION_MODES = ("async", "thread", "process")
+
+logger = logging.getLogger(__name__)
+
+
+async def _start_try(ctx, metadata, task_cls: type[BaseTask]):
+    # Keep the metadata in the job context for the after_job_end hook
+    ctx['task_metadata'] = metadata
+    
+    # Renew the concurrency slot leases for the duration of this try
+    if 'slot_leases' in ctx:
+        dimensions = (metadata or {}).get('_concurrency_dimensions', [])
+        costs = (metadata or {}).get('_concurrency_costs') or [1] * len(dimensions)
+        # The dimensions admitted from a quota block of the dispatcher hold no lease
+        quota_dimensions = ((metadata or {}).get('_quota') or {}).get('dimensions', [])
+        leased = [(dimension, cost) for dimension, cost in zip(dimensions, costs) if dimension not in quota_dimensions]
+        await ctx['slot_leases'].renew(ctx['job_id'], [dimension for dimension, _ in leased], task_cls.timeout + task_cls.retry_delay + LEASE_GRACE_SECONDS, [cost for _, cost in leased])
+    # Same for the units taken from the quota blocks, kept by the dispatcher replica that admitted the job
+    quota = (metadata or {}).get('_quota')
+    if 'quota_leases' in ctx and quota:
+        await ctx['quota_leases'].renew(quota['replica'], ctx['job_id'], task_cls.timeout + task_cls.retry_delay + LEASE_GRACE_SECONDS)
+    
+    # Tell the clients waiting on the task that it runs
+    task_id = (metadata or {}).get('_task_id')
+    if 'task_status' in ctx and task_id:
+        await ctx['task_status'].set(task_id, TASK_RUNNING, job_id=ctx['job_id'])
+
+
+def _retry(ctx, task_cls: type[BaseTask], max_tries: int, error: Exception):
+    """
+    Retry the failed try, unless it is the last one: arq then ends the job as failed through its
+    max tries check, without the after_job_end hook publishing its completion, so the error is
+    raised as is for the job to end here.
+    """
+    if ctx.get('job_try', 1) >= max_tries:
+        raise error
+    raise Retry(defer=task_cls.retry_delay)
+
+
+def _call_run(task: BaseTask):
+    # Runs in a pool thread or process, a coroutine gets its own event loop there
+    result = task.run()
+    if inspect.iscoroutine(result):
+        result = asyncio.run(result)
+    return result
+
+
+def _run_in_process(task_cls: type[BaseTask], ctx, payload, metadata):
+    return _call_run(task_cls(ctx, payload, metadata))
+
+
+async def _run_task(ctx, task_cls: type[BaseTask], payload, metadata):
+    """
+    Run the task on the event loop, or in the worker thread or process pool for blocking tasks.
+
+    arq enforces the timeout by cancelling this coroutine. The job ends right away, and the
+    task still running in the pool is told to stop through its cancel event.
+    """
+    if task_cls.execution_mode == "async":
+        return await task_cls(ctx, payload, metadata).run()
+    
+    loop = asyncio.get_running_loop()
+    if task_cls.execution_mode == "thread":
+        cancel_event = threading.Event()
+        task = task_cls({**ctx, 'cancel_event': cancel_event}, payload, metadata)
+        future = loop.run_in_executor(ctx['thread_pool'], _call_run, task)
+    else:
+        # The worker context holds connections that can not be sent to another process
+        cancel_event = ctx['process_manager'].Event()
+        process_ctx = {'job_id': ctx['job_id'], 'job_try': ctx.get('job_try'), 'cancel_event': cancel_event}
+        future = loop.run_in_executor(ctx['process_pool'], _run_in_process, task_cls, process_ctx, payload, metadata)
+    try:
+        return await future
+    except asyncio.CancelledError:
+        cancel_event.set()
+        raise
+
+
+def _instrumented(task_cls: type[BaseTask], wrapped):
+    """
+    Record the queueing time, run time and outcome of each try in the worker metrics, if any.
+    """
+    task_name = task_cls.name or task_cls.__name__
+    
+    @functools.wraps(wrapped)
+    async def _instrumented_wrapped(ctx, payload, metadata):
+        worker_metrics = ctx.get('metrics')
+        if worker_metrics is None:
+            return await wrapped(ctx, payload, metadata)
+        started_at = time.time()
+        enqueued_at = (metadata or {}).get('_enqueued_at')
+        if enqueued_at and ctx.get('job_try', 1) == 1:
+            worker_metrics.enqueue_to_start.observe(max(started_at - enqueued_at, 0), task=task_name)
+        status = 'failure'
+        try:
+            result = await wrapped(ctx, payload, metadata)
+            status = 'success'
+            return result
+        except Retry:
+            status = 'retry'
+            raise
+        finally:
+            worker_metrics.runs.inc(task=task_name, status=status)
+            worker_metrics.start_to_finish.observe(time.time() - started_at, task=task_name, status=status)
+    return _instrumented_wrapped
 
 
 def arq_task_wrapper(
@@ -8,74 +127,63 @@ def arq_task_wrapper(
 ):
     if not issubclass(task_cls, (AppIdempotentBaseTask, SideEffectBaseTask)):
         raise TypeError(f"task_cls must be a subclass of AppIdempotentBaseTask or SideEffectBaseTask, got {task_cls.__name__}")
+    if task_cls.execution_mode not in EXECUTION_MODES:
+        raise ValueError(f"execution_mode of {task_cls.__name__} must be one of {EXECUTION_MODES}, got {task_cls.execution_mode!r}")
+    
+    # Compile the input and output validators once, when the worker registers the task
+    schema = get_task_schema(task_cls)
     
     if issubclass(task_cls, AppIdempotentBaseTask):
         async def _wrapped(ctx, payload, metadata):
+            await _start_try(ctx, metadata, task_cls)
             try:
-                 # Create a dynamic Pydantic model for input validation
-                input_fields = {param.name: (param.type, ...) for param in task_cls.input_schema}
-                InputModel = create_model(f"{task_cls.name or 'BaseTask'}InputModel", **input_fields)
-                payload = InputModel(**payload).model_dump()
+                # Input validation
+                payload = schema.validate_input(payload)
                 
-                task = task_cls(ctx, payload, metadata)
-                result = await task.run()
+                result = await _run_task(ctx, task_cls, payload, metadata)
                 
                 # Output validation
-                output_fields = {param.name: (param.type, ...) for param in task.output_schema}
-                OutputModel = create_model(f"{task_cls.name or task_cls.__name__}OutputModel", **output_fields)
-                validated_result = OutputModel(**result).model_dump()
-                return validated_result
+                return schema.validate_output(result)
             except ValidationError as ve:
-                print(f"Validation error in task {task_cls.__name__}: {ve}")
+                logger.warning("Validation error in task %s: %s", task_cls.__name__, ve)
                 raise ve
             except Exception as e:
-                print(f"Task {task_cls.__name__} failed with exception: {e}")
-                raise Retry(defer=task_cls.retry_delay)
+                logger.warning("Task %s failed with exception: %s", task_cls.__name__, e)
+                _retry(ctx, task_cls, task_cls.max_retries, e)
         return func(
-            _wrapped,
+            _instrumented(task_cls, _wrapped),
             name=task_cls.name or task_cls.__name__,
             max_tries=task_cls.max_retries,
             timeout=task_cls.timeout,
         )
     elif issubclass(task_cls, SideEffectBaseTask):
         async def _wrapped(ctx, payload, metadata):
+            await _start_try(ctx, metadata, task_cls)
             if task_cls.allow_retry:
                 try:
-                    # Create a dynamic Pydantic model for input validation
-                    input_fields = {param.name: (param.type, ...) for param in task_cls.input_schema}
-                    InputModel = create_model(f"{task_cls.name or 'BaseTask'}InputModel", **input_fields)
-                    payload = InputModel(**payload).model_dump()
+                    # Input validation
+                    payload = schema.validate_input(payload)
                     
-                    task = task_cls(ctx, payload, metadata)
-                    result = await task.run()
+                    result = await _run_task(ctx, task_cls, payload, metadata)
 
                     # Output validation
-                    output_fields = {param.name: (param.type, ...) for param in task.output_schema}
-                    OutputModel = create_model(f"{task_cls.name or task_cls.__name__}OutputModel", **output_fields)
-                    validated_result = OutputModel(**result).model_dump()
-                    return validated_result
+                    return schema.validate_output(result)
                 except ValidationError as ve:
-                    print(f"Validation error in task {task_cls.__name__}: {ve}")
+                    logger.warning("Validation error in task %s: %s", task_cls.__name__, ve)
                     raise ve
                 except Exception as e:
-                    print(f"Task {task_cls.__name__} failed with exception: {e}")
-                    raise Retry(defer=task_cls.retry_delay)
+                    logger.warning("Task %s failed with exception: %s", task_cls.__name__, e)
+                    _retry(ctx, task_cls, task_cls.max_retries, e)
             else:
-                # Create a dynamic Pydantic model for input validation
-                input_fields = {param.name: (param.type, ...) for param in task_cls.input_schema}
-                InputModel = create_model(f"{task_cls.name or 'BaseTask'}InputModel", **input_fields)
-                payload = InputModel(**payload).model_dump()
+                # Input validation
+                payload = schema.validate_input(payload)
                 
-                task = task_cls(ctx, payload, metadata)
-                result = await task.run()
+                result = await _run_task(ctx, task_cls, payload, metadata)
 
                 # Output validation
-                output_fields = {param.name: (param.type, ...) for param in task.output_schema}
-                OutputModel = create_model(f"{task_cls.name or task_cls.__name__}OutputModel", **output_fields)
-                validated_result = OutputModel(**result).model_dump()
-                return validated_result
+                return schema.validate_output(result)
         return func(
-            _wrapped,
+            _instrumented(task_cls, _wrapped),
             name=task_cls.name or task_cls.__name__,
             max_tries=task_cls.max_retries if task_cls.allow_retry else 1,
             timeout=task_cls.timeout,
@@ -1,5 +1,13 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 from arq.connections import RedisSettings
+from dispatcher import QuotaLeases, SlotLeases, TaskStatusStore, get_codec
 from httpx import AsyncClient
+from job_result_collector import CompletionPublisher
+from metrics import MetricsRegistry, WorkerMetrics
 from tasks import (BlockingLongRunningTask, DownloadContentTask, ErrorTask,
                    GreetingTask, NonBlockingLongRunningTask,
                    SideEffectErrorTask,
@@ -13,12 +21,37 @@ REDIS_SETTINGS = RedisSettings(
     host="redis",
     port=6379
 )
+# Serialization of the arq jobs, must match the API (json, msgpack or orjson)
+CODEC = get_codec("json")
+
+# The arq CLI only configures the arq loggers, DEBUG logs every throttling decision
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 
 async def startup(ctx):
     ctx['session'] = AsyncClient()
+    ctx['completion_publisher'] = CompletionPublisher(ctx['redis'])
+    ctx['slot_leases'] = SlotLeases(ctx['redis'])
+    ctx['quota_leases'] = QuotaLeases(ctx['redis'])
+    ctx['task_status'] = TaskStatusStore(ctx['redis'], CODEC)
+    # Pushed to Redis and exposed by the API at /metrics
+    ctx['metrics'] = WorkerMetrics(MetricsRegistry())
+    # Pools running the tasks with a thread or process execution mode, off the event loop
+    ctx['thread_pool'] = ThreadPoolExecutor(max_workers=WorkerSettings.thread_pool_size, thread_name_prefix='task')
+    ctx['process_pool'] = ProcessPoolExecutor(max_workers=WorkerSettings.process_pool_size)
+    # Shares the cancel events with the tasks running in the process pool
+    ctx['process_manager'] = multiprocessing.Manager()
 
 async def shutdown(ctx):
+    await ctx['metrics'].push(ctx['redis'])
     await ctx['session'].aclose()
+    ctx['thread_pool'].shutdown(wait=False, cancel_futures=True)
+    ctx['process_pool'].shutdown(wait=False, cancel_futures=True)
+    ctx['process_manager'].shutdown()
+
+async def after_job_end(ctx):
+    # Push the completion to the result collector, so the concurrency slots are released right away
+    await ctx['completion_publisher'].publish(ctx['job_id'], ctx.get('task_metadata'))
+    await ctx['metrics'].maybe_push(ctx['redis'])
 
 # WorkerSettings defines the settings to use when creating the work,
 # It's used by the arq CLI.
@@ -36,5 +69,11 @@ class WorkerSettings:
     ]
     on_startup = startup
     on_shutdown = shutdown
+    after_job_end = after_job_end
     redis_settings = REDIS_SETTINGS
+    job_serializer = CODEC.encode
+    job_deserializer = CODEC.decode
+    # Number of tasks with a thread or process execution mode running at once
+    thread_pool_size = 10
+    process_pool_size = 2
     # allow_abort_jobs = True
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""
+Benchmarks of the dispatcher, the result collector and the throttling policies.
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --baseline results.json
+
+The cases run against an in-process fakeredis server by default, or against the Redis database
+given by --redis-url, which is flushed before each case.
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import sys
+from pathlib import Path
+
+# The application packages are imported as top-level packages, like in the containers
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+from .harness import RedisBackend  # noqa: E402
+from .report import (build_report, compare, format_comparison,  # noqa: E402
+                     format_result)
+from .scenarios import SCENARIOS  # noqa: E402
+
+
+def int_list(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the dispatcher, the result collector and the throttling policies.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated scenarios among {', '.join(SCENARIOS)}")
+    parser.add_argument("--backlog", type=int_list, default=[100, 1000], help="comma-separated numbers of tasks submitted per case")
+    parser.add_argument("--dimensions", type=int_list, default=[1, 3], help="comma-separated numbers of concurrency dimensions per task")
+    parser.add_argument("--replicas", type=int_list, default=[1, 2], help="comma-separated numbers of dispatcher replicas, for the drain and fairness scenarios")
+    parser.add_argument("--workers", type=int, default=4, help="number of synthetic workers, for the drain and fairness scenarios")
+    parser.add_argument("--limit", type=int, default=8, help="concurrency limit of each dimension value")
+    parser.add_argument("--codec", default="json", help="codec of the queue entries and arq jobs")
+    parser.add_argument("--redis-url", default=None, help="disposable Redis database to run against instead of fakeredis, flushed before each case")
+    parser.add_argument("--output", default=None, help="file to write the JSON report to, stdout by default")
+    parser.add_argument("--baseline", default=None, help="JSON report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change of a metric counted as a regression")
+    return parser.parse_args(argv)
+
+
+def cases(args: argparse.Namespace):
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {scenario!r}, expected one of {', '.join(SCENARIOS)}")
+        replicas = args.replicas if scenario in ("drain", "fairness") else [None]
+        for backlog, dimensions, replica_count in itertools.product(args.backlog, args.dimensions, replicas):
+            params = {"backlog": backlog, "dimensions": dimensions}
+            if replica_count is not None:
+                params.update(replicas=replica_count, workers=args.workers)
+            yield scenario, params
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    backend = RedisBackend(args.redis_url)
+    results = []
+    for scenario, params in cases(args):
+        # Keep the logs of the dispatcher and the collector out of the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            metrics = asyncio.run(SCENARIOS[scenario](backend, limit=args.limit, codec=args.codec, **params))
+        result = {"scenario": scenario, "params": params, "metrics": metrics}
+        results.append(result)
+        print(format_result(result), file=sys.stderr)
+
+    report = build_report(results, {
+        "backend": "redis" if args.redis_url else "fakeredis",
+        "codec": args.codec,
+        "limit": args.limit,
+    })
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        comparisons = compare(report, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        for comparison in comparisons:
+            print(format_comparison(comparison), file=sys.stderr)
+        if any(comparison["regression"] for comparison in comparisons):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+import redis.asyncio
+from arq import ArqRedis
+from arq.constants import default_queue_name, job_key_prefix, result_key_prefix
+from arq.jobs import deserialize_job, serialize_result
+from dispatcher import (TASK_RUNNING, ConcurrencyAwareArqDispatcher, QuotaLeases,
+                        SlotLeases, TaskStatusStore, get_codec)
+from job_result_collector import ArqJobResultCollector, CompletionPublisher
+
+
+@dataclass
+class CommandCounter:
+    """
+    Redis traffic of the clients of one role, counted on the client side.
+
+    A script call counts as one command, like any other command sent to the server.
+    """
+    commands: int = 0
+    round_trips: int = 0
+
+    def reset(self):
+        self.commands = 0
+        self.round_trips = 0
+
+
+def counting_connection_class(base: type, counter: CommandCounter) -> type:
+    """
+    Return a connection class counting the commands and round trips of its connections.
+    """
+    class CountingConnection(base):
+        def pack_command(self, *args):
+            counter.commands += 1
+            return super().pack_command(*args)
+
+        def pack_commands(self, commands):
+            commands = list(commands)
+            counter.commands += len(commands)
+            return super().pack_commands(commands)
+
+        async def send_packed_command(self, command, check_health=True):
+            counter.round_trips += 1
+            return await super().send_packed_command(command, check_health)
+
+    return CountingConnection
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """
+    Return the nearest-rank percentile q (0-100) of the values, None if there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class RedisBackend:
+    """
+    The Redis stand-in of a benchmark run: an in-process fakeredis server, or a disposable Redis database.
+    """
+    def __init__(self, redis_url: str | None = None):
+        """
+        Args:
+            redis_url (str): The URL of a Redis database flushed before each case, fakeredis if None.
+        """
+        self.redis_url = redis_url
+        self._fake_server = None
+
+    def reset(self):
+        if self.redis_url is None:
+            import fakeredis
+            self._fake_server = fakeredis.FakeServer()
+
+    def pool(self, counter: CommandCounter) -> redis.asyncio.ConnectionPool:
+        """
+        Return a connection pool whose commands are counted by the counter.
+        """
+        if self.redis_url is None:
+            from fakeredis import aioredis
+            # FakeConnection is a deprecated factory function in the recent fakeredis releases
+            connection_class = getattr(aioredis, "FakeAsyncRedisConnection", None) or aioredis.FakeConnection
+            return redis.asyncio.ConnectionPool(connection_class=counting_connection_class(connection_class, counter), server=self._fake_server)
+        pool = redis.asyncio.ConnectionPool.from_url(self.redis_url)
+        pool.connection_class = counting_connection_class(pool.connection_class, counter)
+        return pool
+
+
+class InstrumentedDispatcher(ConcurrencyAwareArqDispatcher):
+    """
+    Dispatcher recording when the slots of each job are given back.
+    """
+    def __init__(self, *args, released_at: dict[str, float], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.released_at = released_at
+
+    async def decrease_concurrency(self, dimensions: list, job_id: str, quota: dict = None):
+        await super().decrease_concurrency(dimensions, job_id, quota)
+        self.released_at[job_id] = time.perf_counter()
+
+
+class SyntheticWorker:
+    """
+    No-op worker with the Redis traffic of an arq worker running the tasks through `arq_task_wrapper`:
+    take a job, renew its slot leases and quota units, set the task running, store an empty result and publish the completion.
+    """
+    def __init__(self, arq: ArqRedis, completed_at: dict[str, float], poll_delay: float = 0.005, batch_size: int = 10, lease_ttl: float = 120.0):
+        self.arq = arq
+        self.completed_at = completed_at
+        self.poll_delay = poll_delay
+        self.batch_size = batch_size
+        self.lease_ttl = lease_ttl
+        self.leases = SlotLeases(arq)
+        self.quota_leases = QuotaLeases(arq)
+        self.publisher = CompletionPublisher(arq)
+        self.task_status = TaskStatusStore(arq, arq.job_serializer.__self__)
+        self._running = False
+
+    async def run(self):
+        self._running = True
+        while self._running:
+            jobs = await self.arq.zpopmin(default_queue_name, self.batch_size)
+            if not jobs:
+                await asyncio.sleep(self.poll_delay)
+                continue
+            for job_id, _ in jobs:
+                await self._run_job(job_id.decode())
+
+    def stop(self):
+        self._running = False
+
+    async def _run_job(self, job_id: str):
+        raw = await self.arq.get(job_key_prefix + job_id)
+        if raw is None:
+            return
+        job = deserialize_job(raw, deserializer=self.arq.job_deserializer)
+        metadata = job.args[1]
+        start_ms = int(time.time() * 1000)
+        dimensions = metadata.get("_concurrency_dimensions", [])
+        costs = metadata.get("_concurrency_costs") or [1] * len(dimensions)
+        quota_dimensions = (metadata.get("_quota") or {}).get("dimensions", [])
+        leased = [(dimension, cost) for dimension, cost in zip(dimensions, costs) if dimension not in quota_dimensions]
+        await self.leases.renew(job_id, [dimension for dimension, _ in leased], self.lease_ttl, [cost for _, cost in leased])
+        if metadata.get("_quota"):
+            await self.quota_leases.renew(metadata["_quota"]["replica"], job_id, self.lease_ttl)
+        if metadata.get("_task_id"):
+            await self.task_status.set(metadata["_task_id"], TASK_RUNNING, job_id=job_id)
+        result = serialize_result(
+            function=job.function,
+            args=job.args,
+            kwargs=job.kwargs,
+            job_try=1,
+            enqueue_time_ms=int(job.enqueue_time.timestamp() * 1000),
+            success=True,
+            result=None,
+            start_ms=start_ms,
+            finished_ms=int(time.time() * 1000),
+            ref=job_id,
+            queue_name=default_queue_name,
+            job_id=job_id,
+            serializer=self.arq.job_serializer,
+        )
+        async with self.arq.pipeline(transaction=True) as pipe:
+            pipe.psetex(result_key_prefix + job_id, 3_600_000, result)
+            pipe.delete(job_key_prefix + job_id)
+            await pipe.execute()
+        self.completed_at[job_id] = time.perf_counter()
+        await self.publisher.publish(job_id, metadata)
+
+
+@dataclass
+class BenchEnvironment:
+    """
+    Clients of a benchmark case, one counted pool per role.
+    """
+    backend: RedisBackend
+    codec_name: str = "json"
+    counters: dict[str, CommandCounter] = field(default_factory=lambda: {role: CommandCounter() for role in ("client", "dispatcher", "collector", "worker")})
+
+    def __post_init__(self):
+        self.codec = get_codec(self.codec_name)
+        self.released_at: dict[str, float] = {}
+        self.completed_at: dict[str, float] = {}
+
+    def arq(self, role: str) -> ArqRedis:
+        return ArqRedis(connection_pool=self.backend.pool(self.counters[role]), job_serializer=self.codec.encode, job_deserializer=self.codec.decode)
+
+    def redis(self, role: str) -> redis.asyncio.Redis:
+        return redis.asyncio.Redis(connection_pool=self.backend.pool(self.counters[role]))
+
+    def dispatcher(self, role: str, policy, replica_id: str | None = None, **kwargs) -> InstrumentedDispatcher:
+        return InstrumentedDispatcher(self.arq(role), self.redis(role), policy, replica_id=replica_id, released_at=self.released_at, **kwargs)
+
+    def reset_counters(self):
+        for counter in self.counters.values():
+            counter.reset()
+
+
+@asynccontextmanager
+async def running(backend: RedisBackend, codec_name: str = "json"):
+    """
+    Provide a fresh environment on an empty Redis stand-in.
+    """
+    backend.reset()
+    env = BenchEnvironment(backend, codec_name)
+    if backend.redis_url is not None:
+        await env.redis("client").flushdb()
+    yield env
+
+
+async def start_collector(env: BenchEnvironment, dispatcher: ConcurrencyAwareArqDispatcher) -> ArqJobResultCollector:
+    collector = ArqJobResultCollector(env.redis("collector"), dispatcher, poll_interval=30.0, block_ms=50)
+    await collector.start()
+    return collector
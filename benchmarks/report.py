@@ -0,0 +1,80 @@
+import json
+import platform
+from datetime import datetime, timezone
+
+# Version of the report layout, bumped when the metrics change meaning
+REPORT_VERSION = 1
+# Metrics compared between runs, the others (e.g. enqueued, drained) only describe the case
+COMPARED_SUFFIXES = ("_per_s", "_ms", "_per_task")
+
+
+def build_report(results: list[dict], settings: dict) -> dict:
+    return {
+        "version": REPORT_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": settings,
+        "results": results,
+    }
+
+
+def result_key(result: dict) -> str:
+    """
+    Return the key matching a result with the same case of another run.
+    """
+    return json.dumps([result["scenario"], result["params"]], sort_keys=True)
+
+
+def higher_is_better(metric: str) -> bool:
+    # Rates are higher is better, latencies and per-task costs lower is better
+    return metric.endswith("_per_s")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[dict]:
+    """
+    Compare the metrics of the report with the same cases of the baseline.
+
+    Returns:
+        list[dict]: The case, metric, baseline and current values, relative change and whether it is
+            a regression beyond the tolerance, for every metric found in both runs.
+    """
+    baseline_results = {result_key(result): result for result in baseline.get("results", [])}
+    comparisons = []
+    for result in report["results"]:
+        previous = baseline_results.get(result_key(result))
+        if previous is None:
+            continue
+        for metric, value in result["metrics"].items():
+            before = previous["metrics"].get(metric)
+            if not metric.endswith(COMPARED_SUFFIXES) or isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or not before:
+                continue
+            change = (value - before) / before
+            comparisons.append({
+                "scenario": result["scenario"],
+                "params": result["params"],
+                "metric": metric,
+                "baseline": before,
+                "current": value,
+                "change": change,
+                "regression": (-change if higher_is_better(metric) else change) > tolerance,
+            })
+    return comparisons
+
+
+def format_result(result: dict) -> str:
+    params = " ".join(f"{name}={value}" for name, value in result["params"].items())
+    metrics = " ".join(
+        f"{name}={value:.3f}" if isinstance(value, float) else f"{name}={value}"
+        for name, value in result["metrics"].items()
+    )
+    return f"{result['scenario']:<13} {params} | {metrics}"
+
+
+def format_comparison(comparison: dict) -> str:
+    params = " ".join(f"{name}={value}" for name, value in comparison["params"].items())
+    flag = "REGRESSION" if comparison["regression"] else "ok"
+    return (
+        f"{comparison['scenario']:<13} {params} {comparison['metric']}: "
+        f"{comparison['baseline']:.3f} -> {comparison['current']:.3f} ({comparison['change']:+.1%}) {flag}"
+    )
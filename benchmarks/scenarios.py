@@ -0,0 +1,280 @@
+import asyncio
+import time
+import zlib
+
+from arq.constants import result_key_prefix
+from arq.jobs import deserialize_result
+from dispatcher import QuotaConfig
+from throttling import (AdaptiveLimit, AdaptiveThrottlingPolicy,
+                        RateLimitThrottlingPolicy, StaticThrottlingPolicy)
+
+from .harness import (BenchEnvironment, RedisBackend, SyntheticWorker,
+                      percentile, running, start_collector)
+
+TASK_NAME = "noop"
+# Number of values of each dimension, e.g. dim0:0 to dim0:3
+DIMENSION_FANOUT = 4
+# Maximum time for a backlog to drain before the case is reported as timed out
+DRAIN_TIMEOUT_SECONDS = 300
+
+
+def task_dimensions(index: int, dimensions: int) -> list[str]:
+    """
+    Return the dimensions of the synthetic task at index, the first one being its tenant.
+    """
+    return [f"dim{j}:{(index + j) % DIMENSION_FANOUT}" for j in range(dimensions)]
+
+
+def static_policy(dimensions: int, limit: int) -> StaticThrottlingPolicy:
+    return StaticThrottlingPolicy({
+        f"dim{j}:{value}": limit
+        for j in range(dimensions)
+        for value in range(DIMENSION_FANOUT)
+    })
+
+
+def synthetic_tasks(backlog: int, dimensions: int) -> list[tuple[str, dict, dict]]:
+    return [
+        (TASK_NAME, {"index": index}, {"_concurrency_dimensions": task_dimensions(index, dimensions)})
+        for index in range(backlog)
+    ]
+
+
+def per_task(env: BenchEnvironment, roles: tuple[str, ...], tasks: int) -> dict:
+    commands = sum(env.counters[role].commands for role in roles)
+    round_trips = sum(env.counters[role].round_trips for role in roles)
+    return {
+        "redis_commands_per_task": commands / tasks,
+        "round_trips_per_task": round_trips / tasks,
+    }
+
+
+def ms(seconds: float | None) -> float | None:
+    return None if seconds is None else seconds * 1000
+
+
+async def submit(backend: RedisBackend, backlog: int, dimensions: int, limit: int, codec: str, quota_min_limit: int | None = None) -> dict:
+    """
+    Submit the backlog one task at a time, timing the admission of each task. Once the limits are
+    reached, the tasks are parked in the wait lists.
+    """
+    async with running(backend, codec) as env:
+        dispatcher = env.dispatcher("client", static_policy(dimensions, limit), quota_config=QuotaConfig(min_limit=quota_min_limit))
+        latencies = []
+        started_at = time.perf_counter()
+        for task_name, task_data, task_metadata in synthetic_tasks(backlog, dimensions):
+            submitted_at = time.perf_counter()
+            await dispatcher.dispatch(task_name, task_data, task_metadata)
+            latencies.append(time.perf_counter() - submitted_at)
+        elapsed = time.perf_counter() - started_at
+        usage = per_task(env, ("client",), backlog)
+        return {
+            "submit_ops_per_s": backlog / elapsed,
+            "admission_p50_ms": ms(percentile(latencies, 50)),
+            "admission_p99_ms": ms(percentile(latencies, 99)),
+            # The admitted jobs are the inflight ones, counted once the commands per task are taken
+            "enqueued": await dispatcher.redis_client.scard(dispatcher.inflight_key),
+            **usage,
+        }
+
+
+async def submit_quota(backend: RedisBackend, backlog: int, dimensions: int, limit: int, codec: str) -> dict:
+    """
+    Same as submit, with every dimension admitted locally from the quota blocks of the dispatcher.
+    """
+    return await submit(backend, backlog, dimensions, limit, codec, quota_min_limit=1)
+
+
+async def submit_batch(backend: RedisBackend, backlog: int, dimensions: int, limit: int, codec: str) -> dict:
+    """
+    Submit the backlog through `dispatch_many`, in pipelined chunks.
+    """
+    async with running(backend, codec) as env:
+        dispatcher = env.dispatcher("client", static_policy(dimensions, limit))
+        tasks = synthetic_tasks(backlog, dimensions)
+        started_at = time.perf_counter()
+        results = await dispatcher.dispatch_many(tasks)
+        elapsed = time.perf_counter() - started_at
+        return {
+            "submit_ops_per_s": backlog / elapsed,
+            "enqueued": sum(result["outcome"] == "enqueued" for result in results),
+            **per_task(env, ("client",), backlog),
+        }
+
+
+async def drain(backend: RedisBackend, backlog: int, dimensions: int, limit: int, codec: str, replicas: int, workers: int) -> dict:
+    """
+    Park the backlog in the wait lists, then drain it with the dispatcher replicas, the result
+    collector and the synthetic workers, until every slot has been given back.
+    """
+    async with running(backend, codec) as env:
+        policy = static_policy(dimensions, limit)
+        await env.dispatcher("client", policy).dispatch_many(synthetic_tasks(backlog, dimensions))
+        dispatchers = [env.dispatcher("dispatcher", policy, replica_id=f"replica-{i}", tenant_dimension="dim0") for i in range(replicas)]
+        for _ in range(2):
+            # Settle the partition ownership before timing, a replica only takes over the partitions
+            # of another one once that one has seen it
+            for dispatcher in dispatchers:
+                await dispatcher.partitions.rebalance()
+        env.reset_counters()
+
+        started_at = time.perf_counter()
+        for dispatcher in dispatchers:
+            await dispatcher.start()
+        collector = await start_collector(env, dispatchers[0])
+        synthetic_workers = [SyntheticWorker(env.arq("worker"), env.completed_at) for _ in range(workers)]
+        worker_tasks = [asyncio.create_task(worker.run()) for worker in synthetic_workers]
+        timed_out = False
+        while len(env.released_at) < backlog and not any(task.done() for task in worker_tasks):
+            if time.perf_counter() - started_at > DRAIN_TIMEOUT_SECONDS:
+                timed_out = True
+                break
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - started_at
+
+        for worker in synthetic_workers:
+            worker.stop()
+        await asyncio.gather(*worker_tasks)
+        await collector.stop()
+        for dispatcher in dispatchers:
+            await dispatcher.stop()
+
+        lags = [env.released_at[job_id] - completed_at for job_id, completed_at in env.completed_at.items() if job_id in env.released_at]
+        return {
+            "drain_tasks_per_s": len(env.released_at) / elapsed,
+            "slot_release_lag_p50_ms": ms(percentile(lags, 50)),
+            "slot_release_lag_p99_ms": ms(percentile(lags, 99)),
+            "drained": len(env.released_at),
+            "timed_out": timed_out,
+            **per_task(env, ("dispatcher", "collector"), max(len(env.released_at), 1)),
+            "worker_redis_commands_per_task": env.counters["worker"].commands / max(len(env.released_at), 1),
+        }
+
+
+def tenant_in_partition(name: str, partition: int, partitions: int) -> str:
+    """
+    Return a tenant named after name whose own dimension hashes to the partition, e.g. heavy-3.
+    """
+    index = 0
+    while zlib.crc32(f"dim0:{name}-{index}".encode()) % partitions != partition:
+        index += 1
+    return f"{name}-{index}"
+
+
+async def fairness(backend: RedisBackend, backlog: int, dimensions: int, limit: int, codec: str, replicas: int, workers: int) -> dict:
+    """
+    Drain a backlog shared by a heavy tenant, a light tenant and an urgent tenant on high priority,
+    all waiting on the same shared dimensions, with the tenants in different partitions of the
+    dispatcher queue and the heavy one in the first. The light tenant should get half of the
+    capacity while it waits, and the urgent tenant should go before both.
+    """
+    async with running(backend, codec) as env:
+        shared_dimensions = [f"dim{j}:0" for j in range(1, max(dimensions, 2))]
+        policy = StaticThrottlingPolicy({dimension: limit for dimension in shared_dimensions})
+        client = env.dispatcher("client", policy, tenant_dimension="dim0")
+        partitions = client.queue.partitions
+        tenants = {
+            "heavy": (tenant_in_partition("heavy", 0, partitions), max(backlog - 2 * (backlog // 10), 1), {}),
+            "light": (tenant_in_partition("light", partitions - 1, partitions), max(backlog // 10, 1), {}),
+            "urgent": (tenant_in_partition("urgent", partitions // 2, partitions), max(backlog // 10, 1), {"_priority": 0}),
+        }
+        for tenant, count, metadata in tenants.values():
+            await client.dispatch_many([
+                (TASK_NAME, {"index": index}, {"_concurrency_dimensions": [f"dim0:{tenant}", *shared_dimensions], **metadata})
+                for index in range(count)
+            ])
+        total = sum(count for _, count, _ in tenants.values())
+        dispatchers = [env.dispatcher("dispatcher", policy, replica_id=f"replica-{i}", tenant_dimension="dim0") for i in range(replicas)]
+        for _ in range(2):
+            for dispatcher in dispatchers:
+                await dispatcher.partitions.rebalance()
+
+        started_at = time.perf_counter()
+        for dispatcher in dispatchers:
+            await dispatcher.start()
+        collector = await start_collector(env, dispatchers[0])
+        synthetic_workers = [SyntheticWorker(env.arq("worker"), env.completed_at) for _ in range(workers)]
+        worker_tasks = [asyncio.create_task(worker.run()) for worker in synthetic_workers]
+        timed_out = False
+        while len(env.released_at) < total and not any(task.done() for task in worker_tasks):
+            if time.perf_counter() - started_at > DRAIN_TIMEOUT_SECONDS:
+                timed_out = True
+                break
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - started_at
+
+        for worker in synthetic_workers:
+            worker.stop()
+        await asyncio.gather(*worker_tasks)
+        await collector.stop()
+        for dispatcher in dispatchers:
+            await dispatcher.stop()
+
+        # Tenant of each job in completion order, from the arguments kept with its result
+        redis_client = env.redis("client")
+        order = []
+        for job_id, completed_at in sorted(env.completed_at.items(), key=lambda item: item[1]):
+            result = deserialize_result(await redis_client.get(result_key_prefix + job_id), deserializer=env.codec.decode)
+            tenant = result.args[1]["_concurrency_dimensions"][0].split(":", 1)[1]
+            order.append((tenant.rsplit("-", 1)[0], completed_at - started_at))
+        finished = {name: max((at for tenant, at in order if tenant == name), default=None) for name in tenants}
+        # Share of the light tenant while it competes with the heavy one, half is fair
+        first_slots = [tenant for tenant, _ in order if tenant != "urgent"][:2 * tenants["light"][1]]
+        return {
+            "drain_tasks_per_s": len(env.released_at) / elapsed,
+            "light_tenant_share": first_slots.count("light") / max(len(first_slots), 1),
+            "light_tenant_drained_ms": ms(finished["light"]),
+            "urgent_tenant_drained_ms": ms(finished["urgent"]),
+            "heavy_tenant_drained_ms": ms(finished["heavy"]),
+            "drained": len(env.released_at),
+            "timed_out": timed_out,
+        }
+
+
+async def policies(backend: RedisBackend, backlog: int, dimensions: int, limit: int, codec: str) -> dict:
+    """
+    Measure the policy lookups made for each admission, and the adaptive policy feedback made for
+    each completion.
+    """
+    async with running(backend, codec) as env:
+        dimension_names = task_dimensions(0, dimensions)
+        static = static_policy(dimensions, limit)
+        chained = RateLimitThrottlingPolicy({dimension: 100 for dimension in dimension_names}, static)
+        adaptive = AdaptiveThrottlingPolicy(
+            env.redis("client"),
+            {dimension: AdaptiveLimit(floor=1, ceiling=limit * 4, initial=limit) for dimension in dimension_names},
+            fallback_policy=static,
+        )
+        lookups = backlog * 100
+
+        started_at = time.perf_counter()
+        for i in range(lookups):
+            static.get_limit(dimension_names[i % dimensions])
+        static_elapsed = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        for i in range(lookups):
+            chained.get_limit(dimension_names[i % dimensions])
+            chained.get_rate_limit(dimension_names[i % dimensions])
+        chained_elapsed = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        for i in range(backlog):
+            await adaptive.record_completion(dimension_names[i % dimensions], 0.01, i % 10 != 0)
+        adaptive_elapsed = time.perf_counter() - started_at
+        return {
+            "static_lookup_ops_per_s": lookups / static_elapsed,
+            "rate_limit_lookup_ops_per_s": lookups / chained_elapsed,
+            "adaptive_feedback_ops_per_s": backlog / adaptive_elapsed,
+            **per_task(env, ("client",), backlog),
+        }
+
+
+SCENARIOS = {
+    "submit": submit,
+    "submit_quota": submit_quota,
+    "submit_batch": submit_batch,
+    "drain": drain,
+    "fairness": fairness,
+    "policies": policies,
+}